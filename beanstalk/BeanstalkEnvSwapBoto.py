@@ -13,13 +13,12 @@
 
 import sys
 import os
-import boto3
 import getopt
 
-def findLiveCName(cName, cNameSearch):
-    if cName.lower().find(cNameSearch) > -1:
-      return True
-    return False
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import eb_util
+from boto_scripts import instrument
 
 def printEnvData(x):
     if 'EnvironmentName' in x:
@@ -42,39 +41,17 @@ def printEnvData(x):
     else:
         sys.exit('No status')
 
-def swapEnvironments(eb_client, liveCName, swapCName):
-    if liveCName.lower().strip() != swapCName.lower().strip():
-        print('Changing LIVE env from from',liveCName,'to',swapCName)
-        resp = eb_client.swap_environment_cnames(
-            SourceEnvironmentName=liveCName,
-            DestinationEnvironmentName=swapCName
-        )
-        code=resp['ResponseMetadata']['HTTPStatusCode']
-        if code != 200:
-            sys.exit('Something went wrong swapping the CNAME. ' + resp)
-    else:
-        print('CName already set to', swapCName, '- Doing nothing.')
-
 def descEnvironments(eb_client, swapDest, cNameSearch, appName):
-    LIVE = ''
-    response = eb_client.describe_environments(
-      ApplicationName=appName
-    )
-
-    cName=''
-    environments=response['Environments']
-    print(environments)
-    for x in environments:
+    index = eb_util.environment_index(eb_client, appName)
+    for x in index.environments:
       printEnvData(x)
-      cName=x['CNAME']
-      if findLiveCName(cName, cNameSearch):
-        LIVE = x['EnvironmentName']
 
-    print('LIVE:',LIVE)
     print('DEST:',swapDest)
-    if LIVE=='':
-        sys.exit('Critical Error: No LIVE CName found for: '+ cNameSearch)
-    swapEnvironments(eb_client, LIVE,swapDest)
+    try:
+      live = eb_util.swap_cnames(eb_client, appName, cNameSearch, swapDest)
+    except ValueError as e:
+      sys.exit('Critical Error: ' + str(e))
+    print('LIVE was:',live)
 
 
 def main(argv):
@@ -113,27 +90,13 @@ def main(argv):
     print('cNameSearch:',cNameSearch)
     print('appName:',appName)
 
-    sts_client = boto3.client('sts')
-    response = sts_client.assume_role(
-        RoleArn=roleArn,
-        RoleSessionName='temp_sess'
-    )
-
-    ACC_KEY = response['Credentials']['AccessKeyId']
-    SEC_KEY=response['Credentials']['SecretAccessKey']
-    SESS_TOKEN=response['Credentials']['SessionToken']
-
-    print('ACC_KEY: ', ACC_KEY)
-    print('SEC_KEY: ', SEC_KEY)
-    print('SESS_TOKEN: ', SESS_TOKEN)
-
-    eb_client = boto3.client(
-        'elasticbeanstalk',
-        aws_access_key_id=ACC_KEY,
-        aws_secret_access_key=SEC_KEY,
-        aws_session_token=SESS_TOKEN
-    )
-    descEnvironments(eb_client, swapDest, cNameSearch,appName)
+    instrument.start('BeanstalkEnvSwapBoto')
+    factory = clients.factory(roleArn)
+    with instrument.phase('assume_role'):
+        factory.credentials()
+    eb_client = factory.client('elasticbeanstalk')
+    with instrument.phase('swap'):
+        descEnvironments(eb_client, swapDest, cNameSearch,appName)
     print('Finished successfully.')
 
 if __name__ == "__main__":
@@ -1,79 +1,43 @@
 # BeanstalkHealthBoto.py
 #
 # This script is invoked from Jenkins jobs. Its duty is to verify that the passed in environment name has a health of 'green' and a status of 'ready'.
-# If it is not yet green and ready, it will sleep and try again. After a set number of attempts, if the environment is still not ready,
-# it will exit with an error. This uses STS to assume a different role.
+# If it is not yet green and ready, it will wait with exponential backoff and try again, printing new environment events as they
+# happen. If the environment is still not ready when the timeout passes, or it ends up terminated or ready but red, it will exit
+# with an error. This uses STS to assume a different role.
 #
 #    -r or --role_name          : AWS Role ARN for the role you want to assume.
 #    -a or --application_name   : Name of the Beanstalk application to query
 #    -e or --environment_name   : Name of the Beanstalk environment to query
+#    -t or --timeout            : Optional. Seconds to wait for the environment to be ready. Defaults to 600.
+#    -f or --environments_file  : Optional. File listing more environments to check, one '<application> <environment>' per line.
+#
+# Several environments can be checked at once by passing a comma separated list to -e (all in the application given with -a)
+# and/or by using -f. They are polled together with one describe_environments call per application and a readiness table is
+# printed at the end. The script exits with an error unless every environment is ready.
 #
 # joshtkehoe@gmail.com - 1/2016
 #
 
 import sys
 import os
-import boto3
 import getopt
-import time
-
-def goodHealth(str):
-    if str.lower().find('green') > -1:
-      return True
-    return False
-
-def goodStatus(str):
-    if str.lower().find('ready') > -1:
-      return True
-    return False
-
-def printEnvData(x):
-    if 'EnvironmentName' in x:
-        print('environment name:',x['EnvironmentName'])
-    else:
-        sys.exit('No environment name')
-
-    if 'CNAME' in x:
-        print('CNAME:',x['CNAME'])
-    else:
-        sys.exit('No CName')
-
-    if 'Health' in x:
-        print('health:',x['Health'])
-    else:
-        sys.exit('No health')
-
-    if 'Status' in x:
-        print('status:',x['Status'])
-    else:
-        sys.exit('No status')
-
-
-def descEnvironments(eb_client, appName, envName):
-    response = eb_client.describe_environments(
-      ApplicationName=appName,
-      EnvironmentNames=[envName]
-    )
-
-    cName=''
-    health=''
-    status=''
-
-    environments=response['Environments']
-    if not environments:
-        sys.exit('Environment not found: '+ envName +' in app: ' + appName)
-
-    for x in environments:
-      printEnvData(x)
-      cName=x['CNAME']
-      health=x['Health']
-      status=x['Status']
-
-      if goodHealth(health):
-        if goodStatus(status):
-          return True
-    return False
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import eb_util
+from boto_scripts import instrument
+
+def readEnvironmentsFile(path):
+    targets=[]
+    with open(path) as f:
+      for line in f:
+        line=line.split('#')[0].replace(',', ' ').split()
+        if not line:
+          continue
+        if len(line) != 2:
+          sys.exit('Expected "<application> <environment>" in ' + path + ', got: ' + ' '.join(line))
+        targets.append((line[0], line[1]))
+    return targets
 
 def main(argv):
     print ('Number of arguments:', len(sys.argv), 'arguments.')
@@ -82,13 +46,16 @@ def main(argv):
     appName=''
     envName=''
     roleArn=''
+    timeout=eb_util.DEFAULT_TIMEOUT
+    envFile=''
     try:
-      opts, args = getopt.getopt(argv,"a:e:r:",
-        ["application_name=","environment_name=","role_arn="])
+      opts, args = getopt.getopt(argv,"a:e:r:t:f:",
+        ["application_name=","environment_name=","role_arn=","timeout=","environments_file="])
       print('opts',opts)
       print('args',args)
     except getopt.GetoptError:
-      print('BeanstalkHealthBoto.py -a <application_name> -e <environment_name> -r <role_arn>')
+      print('BeanstalkHealthBoto.py -a <application_name> -e <environment_name>[,<environment_name>...] -r <role_arn> ' +
+        '[-t <timeout seconds>] [-f <environments file>]')
       sys.exit(2)
     for opt, arg in opts:
       if opt in ("-e", "--environment_name"):
@@ -97,50 +64,52 @@ def main(argv):
         appName=arg
       elif opt in ("-r", "--role_arn"):
         roleArn=arg
-
-    if envName=='' or appName=='' or roleArn=='':
+      elif opt in ("-t", "--timeout"):
+        timeout=int(arg)
+      elif opt in ("-f", "--environments_file"):
+        envFile=arg
+
+    targets=[]
+    if envName!='':
+      if appName=='':
+        sys.exit('An application name (-a) is required with -e')
+      targets=[(appName, e.strip()) for e in envName.split(',') if e.strip()]
+    if envFile!='':
+      targets.extend(readEnvironmentsFile(envFile))
+
+    if not targets or roleArn=='':
       sys.exit('BeanstalkHealthBoto.py -a <application_name> -e <environment_name> -r <role_arn>')
 
-    print('environment_name:',envName)
-    print('application_name:',appName)
+    print('environments:',', '.join(app + '/' + env for app, env in targets))
     print('role_arn:',roleArn)
-
-    sts_client = boto3.client('sts')
-    response = sts_client.assume_role(
-      RoleArn=roleArn,
-      RoleSessionName='temp_sess'
-    )
-
-    ACC_KEY = response['Credentials']['AccessKeyId']
-    SEC_KEY=response['Credentials']['SecretAccessKey']
-    SESS_TOKEN=response['Credentials']['SessionToken']
-
-    print('ACC_KEY: ', ACC_KEY)
-    print('SEC_KEY: ', SEC_KEY)
-    print('SESS_TOKEN: ', SESS_TOKEN)
-
-    eb_client = boto3.client(
-       'elasticbeanstalk',
-       aws_access_key_id=ACC_KEY,
-       aws_secret_access_key=SEC_KEY,
-       aws_session_token=SESS_TOKEN
-    )
-
-    ready=False
-    for x in range(1,10):
-      print('Run',x,'of 10')
-      greenAndReady=descEnvironments(eb_client, appName, envName)
-      if greenAndReady:
+    print('timeout:',timeout)
+
+    instrument.start('BeanstalkHealthBoto')
+    factory = clients.factory(roleArn)
+    with instrument.phase('assume_role'):
+      factory.credentials()
+    eb_client = factory.client('elasticbeanstalk')
+
+    if len(targets) == 1:
+      appName, envName = targets[0]
+      with instrument.phase('wait_for_health'):
+        state, env = eb_util.wait_for_environment(eb_client, appName, envName, timeout)
+      if state == eb_util.READY:
         print('Env',envName,'is ready to go')
-        ready=True
-        break
+      elif state == eb_util.MISSING:
+        sys.exit('Environment not found: '+ envName +' in app: ' + appName)
+      elif state == eb_util.FAILED:
+        sys.exit('Environment ' + envName + ' is ' + env['Status'] + ' with health ' + env['Health'] + '.')
       else:
-        print('Env',envName,'is NOT ready to go')
-      print('Sleep and try again')
-      time.sleep(20)
-
-    if not ready:
-      sys.exit("Environment not starting up in alotted time or environment is not healthy.")
+        sys.exit("Environment not starting up in alotted time or environment is not healthy.")
+    else:
+      with instrument.phase('wait_for_health'):
+        results = eb_util.wait_for_environments(eb_client, targets, timeout)
+      eb_util.print_readiness_table(results)
+      notReady = [app + '/' + env for (app, env), (state, desc) in results.items() if state != eb_util.READY]
+      if notReady:
+        sys.exit('Environments not ready: ' + ', '.join(sorted(notReady)))
+      print('All', len(targets), 'environments are ready to go')
 
 if __name__ == "__main__":
   main(sys.argv[1:])
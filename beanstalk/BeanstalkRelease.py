@@ -0,0 +1,101 @@
+# BeanstalkRelease.py
+#
+# This script is invoked from Jenkins jobs. It runs a whole blue/green release in one go: it uploads the artifact,
+# creates an application version and a new environment from it, waits for the environment to be green and ready, swaps
+# the live CNAME over to it and checks that the swap took. If the swap does not complete, or the new environment turns
+# red, the CNAMEs are swapped back and the script exits with an error. It does what DeployBeanstalkEnv.py,
+# BeanstalkHealthBoto.py and BeanstalkEnvSwapBoto.py do one after the other, but assumes the role and sets up its
+# clients once, checks the template and the live CNAME while the artifact uploads, and verifies the swap. This uses STS
+# to assume a different role.
+#
+#    -r or --role_arn           : AWS Role ARN for the role you want to assume.
+#    -a or --app_name           : Name of the Beanstalk application
+#    -e or --env_name           : Name of the new environment
+#    -t or --template           : Name of the template used to create the environment
+#    -b or --bucket             : Bucket the artifact is uploaded to
+#    -s or --source             : Local path of the artifact
+#    -f or --file_name          : Name of the artifact in the bucket. The build number and .zip are appended to it.
+#    -c or --cname_search       : The live CNAME to find
+#    -n or --build_number       : Optional. Defaults to the BUILD_NUMBER environment variable Jenkins sets.
+#    -g or --region             : Optional. Region of the Beanstalk application. Defaults to us-east-1.
+#    --timeout                  : Optional. Seconds to wait for the new environment to be ready. Defaults to 600.
+#    --verify_timeout           : Optional. Seconds to wait for the swap to complete. Defaults to 300.
+#    --dedup                    : Optional. Store the artifact under its SHA-256 and reuse an existing upload and
+#                                 application version of it (see DeployBeanstalkEnv.py).
+#
+# PART_SIZE_MB, UPLOAD_WORKERS and UPLOAD_STATE work as for DeployBeanstalkEnv.py, and RUN_REPORT, STATSD_HOST and
+# PROM_TEXTFILE as for every script (see boto_scripts/instrument.py). The work is done by boto_scripts/release.py.
+#
+
+import sys
+import os
+import getopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import eb_util
+from boto_scripts import instrument
+from boto_scripts import multipart
+from boto_scripts import release
+
+USAGE = ('BeanstalkRelease.py -r <role ARN> -a <application name> -e <environment name> -t <template> -b <bucket> ' +
+         '-s <artifact path> -f <file name> -c <cname for live env> [-n <build number>] [-g <region>] ' +
+         '[--timeout <seconds>] [--verify_timeout <seconds>] [--dedup]')
+
+def main(argv):
+    print ('Number of arguments:', len(sys.argv), 'arguments.')
+    print ('Argument List:', str(sys.argv))
+
+    options = {
+        'role_arn': '', 'app_name': '', 'env_name': '', 'template': '', 'bucket': '', 'source': '', 'file_name': '',
+        'cname_search': '', 'build_number': os.environ.get('BUILD_NUMBER', ''), 'region': 'us-east-1'
+    }
+    shortOpts = {'r': 'role_arn', 'a': 'app_name', 'e': 'env_name', 't': 'template', 'b': 'bucket', 's': 'source',
+                 'f': 'file_name', 'c': 'cname_search', 'n': 'build_number', 'g': 'region'}
+    timeout=eb_util.DEFAULT_TIMEOUT
+    verifyTimeout=release.DEFAULT_VERIFY_TIMEOUT
+    dedup=False
+    try:
+        opts, args = getopt.getopt(argv, "r:a:e:t:b:s:f:c:n:g:",
+            [name + '=' for name in options] + ["timeout=", "verify_timeout=", "dedup"])
+    except getopt.GetoptError:
+        print(USAGE)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--timeout":
+            timeout=int(arg)
+        elif opt == "--verify_timeout":
+            verifyTimeout=int(arg)
+        elif opt == "--dedup":
+            dedup=True
+        elif opt.startswith('--'):
+            options[opt[2:]]=arg
+        else:
+            options[shortOpts[opt[1:]]]=arg
+
+    missing = [name for name, value in options.items() if value == '']
+    if missing:
+        sys.exit('Missing ' + ', '.join(missing) + '\n' + USAGE)
+    for name in sorted(options):
+        print(name + ':', options[name])
+
+    partSize = int(os.environ.get('PART_SIZE_MB', multipart.DEFAULT_PART_SIZE // (1024 * 1024))) * 1024 * 1024
+    uploadWorkers = int(os.environ.get('UPLOAD_WORKERS', multipart.DEFAULT_PART_WORKERS))
+    uploadState = os.environ.get('UPLOAD_STATE', options['source'] + '.upload-state')
+
+    instrument.start('BeanstalkRelease')
+    factory = clients.factory(options['role_arn'], region=options['region'])
+    with instrument.phase('assume_role'):
+        factory.credentials()
+    try:
+        result = release.release(factory, options['bucket'], options['source'], options['file_name'],
+                                 options['build_number'], options['app_name'], options['env_name'],
+                                 options['template'], options['cname_search'], timeout, verifyTimeout, partSize,
+                                 uploadWorkers, uploadState, dedup)
+    except release.ReleaseError as e:
+        sys.exit('Critical Error: ' + str(e))
+    print('Released', result.version_label, 'to', options['env_name'], '- LIVE was:', result.previous_live)
+    print('Finished successfully.')
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
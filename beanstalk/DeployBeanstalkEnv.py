@@ -4,7 +4,8 @@
 # using the newly created application version. 
 #    
 #    ROLE_ARN - AWS Role ARN for the role you want to assume.
-#    ROLE_SESS_NAME - You will give the assumed role a unique session name - can be anything. 
+#    ROLE_SESS_NAME - You will give the assumed role a unique session name - can be anything. Credentials for the role are
+#                     cached and shared with the other scripts until shortly before they expire.
 #    FILE_NAME - What we will name the uploaded artifact in S3. We will also append the build number and .zip to the name.
 #    BUCKET_NAME - Name of the bucket we will upload the application to.
 #    SOURCE - Local path for the artifact we are uploading
@@ -12,68 +13,103 @@
 #    EB_TEMPLATE - The name of the template that will be used for the create environment process.
 #    EB_ENV_NAME - The name for the new environment. Must be unique. We will append the build number to it.
 #    BUILD_NUMBER - Jenkins environment variable.
+#    PART_SIZE_MB - Optional. Artifacts bigger than this are sent as a multipart upload in parts of this size. Defaults to 64.
+#    UPLOAD_WORKERS - Optional. Number of parts to upload at once. Defaults to 4.
+#    UPLOAD_STATE - Optional. File used to resume an interrupted multipart upload. Defaults to SOURCE + '.upload-state'.
+#    DEDUP_ARTIFACT - Optional. If 'true', the artifact is stored under its SHA-256 instead of the build number. An
+#                     artifact that is already in the bucket is not uploaded again, and an existing application version
+#                     built from it is reused instead of creating a new one.
+#    EB_REGION - Optional. Region of the Beanstalk application. Defaults to us-east-1.
+#    DEPLOY_TARGETS - Optional. A JSON file listing several account/region targets to deploy to at once (see
+#                     boto_scripts/deploy.py for the format). ROLE_ARN, ROLE_SESS_NAME, EB_REGION, BUCKET_NAME,
+#                     EB_APP_NAME, EB_TEMPLATE and EB_ENV_NAME are then only defaults for fields a target leaves out.
+#                     The artifact is uploaded once per region, a result line is printed per target and the script
+#                     exits with an error if any target failed.
+#    DEPLOY_PARALLELISM - Optional. Most targets deployed at once. Defaults to 8.
+#    RUN_REPORT, STATSD_HOST, PROM_TEXTFILE - Optional. Where to write timings of each step and AWS call. See
+#                                             boto_scripts/instrument.py.
 # 
+# The work is done by boto_scripts/deploy.py, which can also be imported and called directly.
+#
 # KEHOEJO - 10/2015
 #
 
 import os
-from io import StringIO
-import hashlib
 import sys
 
-import boto
-from boto.sts import STSConnection
-from boto.s3.connection import S3Connection
-from boto import beanstalk 
-from boto.beanstalk.layer1 import Layer1
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import deploy
+from boto_scripts import instrument
+from boto_scripts import multipart
+
+
+def deployTargets(targetsFile, source, fileName, buildNumber, partSize, uploadWorkers, uploadState, dedup):
+    defaults = {
+        'role_arn': os.environ.get('ROLE_ARN'),
+        'role_session_name': os.environ.get('ROLE_SESS_NAME'),
+        'region': os.environ.get('EB_REGION', 'us-east-1'),
+        'bucket': os.environ.get('BUCKET_NAME'),
+        'app_name': os.environ.get('EB_APP_NAME'),
+        'template': os.environ.get('EB_TEMPLATE'),
+        'env_name': os.environ.get('EB_ENV_NAME')
+    }
+    try:
+        targets = deploy.load_targets(targetsFile, defaults)
+    except ValueError as e:
+        sys.exit('Critical Error: ' + str(e))
+    parallelism = int(os.environ.get('DEPLOY_PARALLELISM', deploy.DEFAULT_PARALLELISM))
 
-print ('Assuming role to access AWS on a different account')
-ROLE_ARN = os.environ['ROLE_ARN']
-ROLE_SESS_NAME = os.environ['ROLE_SESS_NAME']
-BUCKET_PARAM = os.environ['BUCKET_NAME']
-FILE_NAME = os.environ['FILE_NAME']
-SOURCE = os.environ['SOURCE']
-APP_NAME = os.environ['EB_APP_NAME']
-BUILD_NUMBER = os.environ['BUILD_NUMBER']
-TEMPLATE_NAME = os.environ['EB_TEMPLATE']
-ENVIRONMENT_NAME = os.environ['EB_ENV_NAME']
+    results = deploy.deploy_targets(targets, source, fileName, buildNumber, parallelism, partSize, uploadWorkers,
+                                    uploadState, dedup)
+    print('{:<30} {:<12} {:<9} {:<30} {}'.format('target', 'region', 'artifact', 'version', 'result'))
+    for r in results:
+        print('{:<30} {:<12} {:<9} {:<30} {}'.format(r.target.name, r.target.region, r.staged or '-',
+                                                     r.version_label or '-', r.error or 'environment created'))
+    failed = [r.target.name for r in results if r.error is not None]
+    if failed:
+        sys.exit(str(len(failed)) + ' of ' + str(len(results)) + ' targets failed: ' + ', '.join(failed))
 
-sts_connection = STSConnection()
-assumedRoleObject = sts_connection.assume_role(
-    role_arn=ROLE_ARN,
-    role_session_name=ROLE_SESS_NAME
-)
 
-ACCESS_KEY = assumedRoleObject.credentials.access_key
-SECRET_KEY = assumedRoleObject.credentials.secret_key
-TOKEN = assumedRoleObject.credentials.session_token
+def main():
+    SOURCE = os.environ['SOURCE']
+    FILE_NAME = os.environ['FILE_NAME']
+    BUILD_NUMBER = os.environ['BUILD_NUMBER']
+    PART_SIZE = int(os.environ.get('PART_SIZE_MB', multipart.DEFAULT_PART_SIZE // (1024 * 1024))) * 1024 * 1024
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', multipart.DEFAULT_PART_WORKERS))
+    UPLOAD_STATE = os.environ.get('UPLOAD_STATE', SOURCE + '.upload-state')
+    DEDUP_ARTIFACT = os.environ.get('DEDUP_ARTIFACT', 'false').lower() == 'true'
+    DEPLOY_TARGETS = os.environ.get('DEPLOY_TARGETS')
 
-# Connect to S3. Upload .zip to S3 bucket.
-connection = S3Connection(
-    aws_access_key_id=ACCESS_KEY,
-    aws_secret_access_key=SECRET_KEY,
-    security_token=TOKEN,
-    calling_format=boto.s3.connection.OrdinaryCallingFormat()
-)
+    instrument.start('DeployBeanstalkEnv')
+    if DEPLOY_TARGETS:
+        deployTargets(DEPLOY_TARGETS, SOURCE, FILE_NAME, BUILD_NUMBER, PART_SIZE, UPLOAD_WORKERS, UPLOAD_STATE,
+                      DEDUP_ARTIFACT)
+        print('done')
+        return
 
-bucket = connection.get_bucket(BUCKET_PARAM, validate=False)
-	
-k = boto.s3.key.Key(bucket)
-k.key=FILE_NAME + '-' + BUILD_NUMBER + '.zip'
-print('source ', SOURCE)
-print('bucket ', BUCKET_PARAM)
-print('file name ', FILE_NAME)
-print('template name ', TEMPLATE_NAME)
-print('build number ', BUILD_NUMBER)
-k.set_contents_from_filename(SOURCE)
+    print ('Assuming role to access AWS on a different account')
+    ROLE_ARN = os.environ['ROLE_ARN']
+    ROLE_SESS_NAME = os.environ['ROLE_SESS_NAME']
+    BUCKET_PARAM = os.environ['BUCKET_NAME']
+    APP_NAME = os.environ['EB_APP_NAME']
+    TEMPLATE_NAME = os.environ['EB_TEMPLATE']
+    ENVIRONMENT_NAME = os.environ['EB_ENV_NAME']
+    EB_REGION = os.environ.get('EB_REGION', 'us-east-1')
 
-# Connect to Layer1
-l = Layer1(aws_access_key_id=ACCESS_KEY,aws_secret_access_key=SECRET_KEY,security_token=TOKEN)
+    factory = clients.factory(ROLE_ARN, ROLE_SESS_NAME, EB_REGION)
+    with instrument.phase('assume_role'):
+        factory.credentials()
 
-# Create a new application version using the file we just uploaded to S3
-verName = APP_NAME + '-boto-' + BUILD_NUMBER
-l.create_application_version(APP_NAME,verName,description='eb app ver created via boto',s3_bucket=BUCKET_PARAM,s3_key=k.key,auto_create_application=False)
-l.create_environment(APP_NAME,ENVIRONMENT_NAME,template_name=TEMPLATE_NAME,version_label=verName)
+    print('source ', SOURCE)
+    print('bucket ', BUCKET_PARAM)
+    print('file name ', FILE_NAME)
+    print('template name ', TEMPLATE_NAME)
+    print('build number ', BUILD_NUMBER)
+    deploy.deploy(factory, BUCKET_PARAM, SOURCE, FILE_NAME, BUILD_NUMBER, APP_NAME, ENVIRONMENT_NAME, TEMPLATE_NAME,
+                  PART_SIZE, UPLOAD_WORKERS, UPLOAD_STATE, DEDUP_ARTIFACT)
+    print('done')
 
-print('done')
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+#
+# Runs the S3 sync, Beanstalk deploy and multi-target deploy, SQS save/restore/generate/move/inspect, Beanstalk
+# health/swap and blue/green release code paths against the in-memory AWS stand-ins in this directory (fake_s3.py,
+# fake_sqs.py and fake_eb.py) and prints throughput and request latency for each. The workloads call the boto_scripts
+# library functions the scripts are built on (sync.sync, deploy.deploy, sqs_ops, eb_util and release.release) with
+# stand-in clients, so nothing is sent to AWS and neither boto nor boto3 has to be installed.
+#
+#    --workloads    : Comma separated workloads to run. Defaults to all of s3_sync, deploy, deploy_fanout,
+#                     sqs_generate, sqs_save, sqs_restore, sqs_move, sqs_inspect, health, swap and release.
+#    --latency      : Simulated per-request latency in seconds. Defaults to 0.02.
+#    --throttle     : Fraction of requests that are throttled. Defaults to 0.
+#    --capacity     : Requests each stand-in service takes at once before it throttles the rest. Defaults to no limit.
+#    --workers      : Concurrency used by every workload (upload/delete/list workers, part workers, SQS producers,
+#                     receivers and senders). Defaults to 16.
+#    --files, --size, --changed    : s3_sync: number of files, bytes per file and fraction of them that changed since
+#                                    the last sync. Defaults to 500, 20000 and 0.1.
+#    --artifact_mb, --part_mb      : deploy and release: artifact size and multipart part size in MB. Defaults to 64
+#                                    and 8.
+#    --targets, --regions          : deploy_fanout: number of targets, each with its own bucket, spread over this many
+#                                    regions. Defaults to 8 and 4.
+#    --messages, --msg_size        : SQS workloads: number of messages and body size in bytes. Defaults to 5000 and
+#                                    1024.
+#    --envs, --ready_after         : health: number of environments and the most seconds one takes to become ready.
+#                                    Defaults to 20 and 1. release: the seconds the new environment takes.
+#    --poll_delay                  : health and release: initial delay between polls in seconds. Defaults to 0.1. A
+#                                    release's CNAME swap takes twice this long to complete.
+#    --swaps                       : swap: number of CNAME swaps among --envs environments. Defaults to 10.
+#    --json         : Also write the parameters and results to this file.
+#    --baseline     : Results file from an earlier --json run. Exits with an error if any workload is more than
+#                     --tolerance (default 0.2) slower than it was, or failed where it ran before. A failed workload
+#                     is an error with or without a baseline.
+#
+# Example: python aws_bench.py --workloads s3_sync,sqs_save --latency 0.05 --workers 32 --json after.json \
+#              --baseline before.json
+#
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'sqs'))
+
+from boto_scripts import deploy
+from boto_scripts import eb_util
+from boto_scripts import multipart
+from boto_scripts import release
+from boto_scripts import s3_util
+from boto_scripts import sqs_inspect
+from boto_scripts import sqs_ops
+from boto_scripts import sync
+from boto_scripts import throttle
+from fake_service import FakeClientFactory
+import fake_eb
+import fake_s3
+import fake_sqs
+
+WORKLOADS = ('s3_sync', 'deploy', 'deploy_fanout', 'sqs_generate', 'sqs_save', 'sqs_restore', 'sqs_move', 'sqs_inspect', 'health', 'swap',
+             'release')
+BUCKET = 'bench'
+QUEUE = 'bench-queue'
+RESTORE_QUEUE = 'bench-restore-queue'
+MOVE_QUEUE = 'bench-move-queue'
+APP = 'bench-app'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workloads", default=','.join(WORKLOADS))
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--changed", type=float, default=0.1)
+    parser.add_argument("--artifact_mb", type=int, default=64)
+    parser.add_argument("--part_mb", type=int, default=8)
+    parser.add_argument("--targets", type=int, default=8)
+    parser.add_argument("--regions", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--msg_size", type=int, default=1024)
+    parser.add_argument("--envs", type=int, default=20)
+    parser.add_argument("--ready_after", type=float, default=1.0)
+    parser.add_argument("--poll_delay", type=float, default=0.1)
+    parser.add_argument("--swaps", type=int, default=10)
+    parser.add_argument("--json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+@contextlib.contextmanager
+def _quiet():
+    # The code under test prints a line per file or batch, which would swamp the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _result(service, items, unit, elapsed, *others):
+    requests = service.requests + sum(o.requests for o in others)
+    throttled = service.throttled + sum(o.throttled for o in others)
+    return {
+        'items': items,
+        'unit': unit,
+        'seconds': round(elapsed, 3),
+        'rate': round(items / elapsed, 1) if elapsed > 0 else 0,
+        'requests': requests,
+        'throttled': throttled,
+        'p50_ms': round(service.percentile(50) * 1000, 1),
+        'p99_ms': round(service.percentile(99) * 1000, 1)
+    }
+
+
+def _bench_s3_sync(args, tmp):
+    root = os.path.join(tmp, 'site')
+    for i in range(args.files):
+        d = os.path.join(root, 'dir{}'.format(i % 20))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        with open(os.path.join(d, 'file{}.js'.format(i)), 'wb') as f:
+            f.write(os.urandom(args.size))
+
+    # The bucket holds the previous deploy: most files unchanged, some changed and some no longer in the site
+    s3 = fake_s3.FakeS3(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    changed = int(args.files * args.changed)
+    for i, f in enumerate(s3_util.build_local_manifest(root).values()):
+        s3.put_object(BUCKET, f.key, f.size, f.md5 if i >= changed else 'stale')
+    for i in range(changed):
+        s3.put_object(BUCKET, 'old/file{}.js'.format(i), args.size, 'orphan')
+    s3.requests = 0
+
+    start = time.time()
+    with _quiet():
+        sync.sync(FakeClientFactory(s3), BUCKET, root, delete_workers=args.workers, upload_workers=args.workers,
+                  list_workers=args.workers)
+    return _result(s3, args.files, 'files', time.time() - start)
+
+
+def _bench_deploy(args, tmp):
+    artifact = os.path.join(tmp, 'artifact.zip')
+    with open(artifact, 'wb') as f:
+        for _ in range(args.artifact_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    s3 = fake_s3.FakeS3(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    eb = fake_eb.FakeEB(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    multipart._multipart_upload = fake_s3.multipart_upload
+    factory = FakeClientFactory(s3, elasticbeanstalk=eb)
+    start = time.time()
+    with _quiet():
+        deploy.deploy(factory, BUCKET, artifact, 'bench', '1', APP, 'bench-env-1', 'bench',
+                      args.part_mb * 1024 * 1024, args.workers)
+    return _result(s3, args.artifact_mb, 'MB', time.time() - start, eb)
+
+
+def _bench_deploy_fanout(args, tmp):
+    artifact = os.path.join(tmp, 'artifact.zip')
+    with open(artifact, 'wb') as f:
+        for _ in range(args.artifact_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    # One S3 and one Beanstalk stand-in serve every account and region
+    s3 = fake_s3.FakeS3(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    eb = fake_eb.FakeEB(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    multipart._multipart_upload = fake_s3.multipart_upload
+    factory = FakeClientFactory(s3, elasticbeanstalk=eb)
+    targets = [deploy.Target('target-{}'.format(i), None, None, 'region-{}'.format(i % args.regions),
+                             '{}-{}'.format(BUCKET, i), APP, 'bench-env-{}'.format(i), 'bench')
+               for i in range(args.targets)]
+    start = time.time()
+    with _quiet():
+        results = deploy.deploy_targets(targets, artifact, 'bench', '1', args.workers, args.part_mb * 1024 * 1024,
+                                        args.workers, factory_for=lambda target: factory)
+    failed = [r for r in results if r.error is not None]
+    if failed:
+        raise RuntimeError('{} targets failed, first: {}'.format(len(failed), failed[0].error))
+    return _result(s3, args.targets, 'targets', time.time() - start, eb)
+
+
+def _fill_queue(sqs, count, size):
+    sqs.create_queue(QUEUE)
+    body = ''.join(random.choice(string.ascii_letters) for _ in range(size))
+    for _ in range(count):
+        sqs.add_message(QUEUE, body, {'source': {'DataType': 'String', 'StringValue': 'bench'}})
+
+
+def _bench_sqs_generate(args, tmp):
+    sqs = fake_sqs.FakeSQS(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    sqs.create_queue(QUEUE)
+    import sqs_util
+    sqs_util._sqs_client = lambda aws_region, workers: sqs.client(aws_region)
+    start = time.time()
+    with _quiet():
+        sqs_util._put_random_msgs_on_queue(QUEUE, args.messages, 'us-east-1', producers=args.workers,
+                                           min_size=args.msg_size, max_size=args.msg_size, dist='fixed',
+                                           report_interval=3600)
+    return _result(sqs, args.messages, 'msgs', time.time() - start)
+
+
+def _bench_sqs_save(args, tmp):
+    sqs = fake_sqs.FakeSQS(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    _fill_queue(sqs, args.messages, args.msg_size)
+    out = os.path.join(tmp, 'archive')
+    os.mkdir(out)
+    start = time.time()
+    with _quiet():
+        sqs_ops.archive_messages(sqs.client(), QUEUE, out, args.messages, args.workers)
+    return _result(sqs, args.messages, 'msgs', time.time() - start)
+
+
+def _bench_sqs_restore(args, tmp):
+    # Archive a queue first, then time restoring the archive into a second queue
+    sqs = fake_sqs.FakeSQS(latency=0, throttle_rate=0)
+    _fill_queue(sqs, args.messages, args.msg_size)
+    out = os.path.join(tmp, 'restore')
+    os.mkdir(out)
+    with _quiet():
+        sqs_ops.archive_messages(sqs.client(), QUEUE, out, args.messages, args.workers)
+
+    sqs = fake_sqs.FakeSQS(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    sqs.create_queue(RESTORE_QUEUE)
+    start = time.time()
+    with _quiet():
+        sqs_ops.restore_messages(sqs.client(), RESTORE_QUEUE, out, args.messages, args.workers)
+    return _result(sqs, args.messages, 'msgs', time.time() - start)
+
+
+def _bench_sqs_move(args, tmp):
+    sqs = fake_sqs.FakeSQS(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    _fill_queue(sqs, args.messages, args.msg_size)
+    sqs.create_queue(MOVE_QUEUE)
+    start = time.time()
+    with _quiet():
+        sqs_ops.move_messages(sqs.client(), QUEUE, MOVE_QUEUE, args.messages, args.workers)
+    return _result(sqs, args.messages, 'msgs', time.time() - start)
+
+
+def _bench_sqs_inspect(args, tmp):
+    sqs = fake_sqs.FakeSQS(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    _fill_queue(sqs, args.messages, args.msg_size)
+    start = time.time()
+    with _quiet():
+        sqs_inspect.inspect_queue(sqs.client(), QUEUE, args.messages, args.workers, 'attr.source = bench', tmp)
+    return _result(sqs, args.messages, 'msgs', time.time() - start)
+
+
+def _bench_health(args, tmp):
+    eb = fake_eb.FakeEB(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    targets = []
+    for i in range(args.envs):
+        # Spread the environments over a few applications, like a multi-service release
+        app = '{}-{}'.format(APP, i % 4)
+        eb.add_environment(app, 'env-{}'.format(i), ready_after=random.uniform(0, args.ready_after))
+        targets.append((app, 'env-{}'.format(i)))
+    start = time.time()
+    with _quiet():
+        eb_util.wait_for_environments(eb.client(), targets, timeout=args.ready_after * 10 + 60,
+                                      initial_delay=args.poll_delay, max_delay=args.poll_delay * 8)
+    return _result(eb, args.envs, 'envs', time.time() - start)
+
+
+def _bench_swap(args, tmp):
+    eb = fake_eb.FakeEB(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    for i in range(max(2, args.envs)):
+        eb.add_environment(APP, 'env-{}'.format(i), ready_after=0)
+    live = 'env-0.fake.elasticbeanstalk.com'
+    client = eb.client()
+    start = time.time()
+    with _quiet():
+        for i in range(args.swaps):
+            # Swap env-0 and env-1 back and forth behind the live CNAME
+            eb_util.swap_cnames(client, APP, live, 'env-{}'.format((i + 1) % 2))
+    return _result(eb, args.swaps, 'swaps', time.time() - start)
+
+
+def _bench_release(args, tmp):
+    artifact = os.path.join(tmp, 'artifact.zip')
+    with open(artifact, 'wb') as f:
+        for _ in range(args.artifact_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    s3 = fake_s3.FakeS3(latency=args.latency, throttle_rate=args.throttle, capacity=args.capacity)
+    eb = fake_eb.FakeEB(latency=args.latency, throttle_rate=args.throttle, ready_after=args.ready_after,
+                        capacity=args.capacity, swap_after=args.poll_delay * 2)
+    eb.add_environment(APP, 'bench-blue', cname='bench-live.fake.elasticbeanstalk.com', ready_after=0)
+    multipart._multipart_upload = fake_s3.multipart_upload
+    factory = FakeClientFactory(s3, elasticbeanstalk=eb)
+    start = time.time()
+    with _quiet():
+        release.release(factory, BUCKET, artifact, 'bench', '1', APP, 'bench-green', 'bench',
+                        'bench-live.fake.elasticbeanstalk.com', timeout=args.ready_after * 10 + 60, verify_timeout=60,
+                        part_size=args.part_mb * 1024 * 1024, upload_workers=args.workers,
+                        initial_delay=args.poll_delay, max_delay=args.poll_delay * 8)
+    return _result(s3, 1, 'releases', time.time() - start, eb)
+
+
+def _compare(names, results, baseline, tolerance):
+    # Returns the workloads in names that are slower than in the baseline, or that failed but ran in the baseline
+    slower = []
+    for name in sorted(names):
+        before = baseline.get(name)
+        if not before or not before['rate']:
+            continue
+        r = results.get(name)
+        if r is None:
+            print('{:<14} {:>10} -> {:>10}'.format(name, before['rate'], 'failed'))
+            slower.append(name)
+            continue
+        change = (r['rate'] - before['rate']) / before['rate']
+        print('{:<14} {:>10} -> {:>10} {}/s ({:+.0%})'.format(name, before['rate'], r['rate'], r['unit'], change))
+        if change < -tolerance:
+            slower.append(name)
+    return slower
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    benches = {
+        's3_sync': _bench_s3_sync,
+        'deploy': _bench_deploy,
+        'deploy_fanout': _bench_deploy_fanout,
+        'sqs_generate': _bench_sqs_generate,
+        'sqs_save': _bench_sqs_save,
+        'sqs_restore': _bench_sqs_restore,
+        'sqs_move': _bench_sqs_move,
+        'sqs_inspect': _bench_sqs_inspect,
+        'health': _bench_health,
+        'swap': _bench_swap,
+        'release': _bench_release
+    }
+    results = {}
+    failed = []
+    names = args.workloads.split(',')
+    for name in names:
+        if name not in benches:
+            sys.exit('Unknown workload ' + name + ', expected one of ' + ', '.join(WORKLOADS))
+        tmp = tempfile.mkdtemp()
+        # Each workload starts with fresh limiters, as a new process would
+        throttle.reset()
+        try:
+            results[name] = benches[name](args, tmp)
+        except Exception as e:
+            # A workload can still fail when throttled more often than its retries allow. Report that rather than
+            # stopping, and exit with an error once every workload has run.
+            print('{} failed: {}: {}'.format(name, type(e).__name__, e))
+            failed.append(name)
+        finally:
+            shutil.rmtree(tmp)
+
+    print('{:<14} {:>8} {:>6} {:>9} {:>10} {:>9} {:>9} {:>8} {:>8}'.format(
+        'workload', 'items', 'unit', 'seconds', 'rate/s', 'requests', 'throttled', 'p50 ms', 'p99 ms'))
+    for name, r in results.items():
+        print('{:<14} {:>8} {:>6} {:>9.2f} {:>10.1f} {:>9} {:>9} {:>8.1f} {:>8.1f}'.format(
+            name, r['items'], r['unit'], r['seconds'], r['rate'], r['requests'], r['throttled'], r['p50_ms'],
+            r['p99_ms']))
+
+    if args.json:
+        params = dict((k, v) for k, v in vars(args).items() if k not in ('json', 'baseline'))
+        with open(args.json, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = _compare(names, results, json.load(f)['results'], args.tolerance)
+        if slower:
+            sys.exit('Slower than the baseline: ' + ', '.join(slower))
+    if failed:
+        sys.exit('Failed: ' + ', '.join(failed))
@@ -0,0 +1,131 @@
+#
+# An in-memory stand-in for the boto3 Elastic Beanstalk client calls made by the deploy, health, swap and release code.
+# A new environment reports Launching/Grey until ready_after seconds have passed and Ready/Green after that. Both
+# environments of a CNAME swap report Updating for swap_after seconds, with the new CNAMEs already in place. As in
+# Beanstalk, CNAMEs can only be swapped between environments that are Ready. Every template validates. Throttled
+# requests fail with a Throttling client error.
+#
+
+import collections
+import datetime
+import random
+import threading
+import time
+
+from fake_service import FakeClientError, FakeMeta, FakeService
+
+PAGE_SIZE = 100
+
+
+class FakeEB(FakeService):
+    def __init__(self, latency=0.05, throttle_rate=0.0, ready_after=0.5, capacity=None, swap_after=0.0):
+        FakeService.__init__(self, latency, throttle_rate=throttle_rate, capacity=capacity)
+        self.ready_after = ready_after
+        self.swap_after = swap_after
+        self.environments = collections.OrderedDict()
+        self.versions = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    def throttle_error(self, operation):
+        return FakeClientError('Throttling', operation)
+
+    def add_environment(self, app_name, env_name, cname=None, ready_after=None, version_label=None):
+        with self._lock:
+            self.environments[env_name] = {
+                'ApplicationName': app_name,
+                'EnvironmentName': env_name,
+                'EnvironmentId': 'e-{:010d}'.format(random.randint(0, 10 ** 10 - 1)),
+                'CNAME': cname or '{}.fake.elasticbeanstalk.com'.format(env_name),
+                'VersionLabel': version_label,
+                'ready_at': time.time() + (self.ready_after if ready_after is None else ready_after),
+                'updated_at': 0
+            }
+            self._event(app_name, env_name, 'createEnvironment is starting.')
+
+    def _event(self, app_name, env_name, message):
+        self.events.append({'EventDate': datetime.datetime.now(datetime.timezone.utc), 'ApplicationName': app_name,
+                            'EnvironmentName': env_name, 'Severity': 'INFO', 'Message': message})
+
+    def describe(self, env):
+        now = time.time()
+        ready = now >= env['ready_at']
+        description = dict((k, v) for k, v in env.items() if k not in ('ready_at', 'updated_at'))
+        description['Status'] = ('Ready' if now >= env['updated_at'] else 'Updating') if ready else 'Launching'
+        description['Health'] = 'Green' if ready else 'Grey'
+        return description
+
+    def client(self, region_name='us-east-1'):
+        return FakeEBClient(self, region_name)
+
+
+class FakeEBClient(object):
+    def __init__(self, eb, region_name):
+        self.eb = eb
+        self.meta = FakeMeta(region_name)
+
+    def describe_environments(self, ApplicationName, EnvironmentNames=None, IncludeDeleted=True, MaxRecords=None,
+                              NextToken=None):
+        self.eb.request('DescribeEnvironments')
+        with self.eb._lock:
+            envs = [e for e in self.eb.environments.values() if e['ApplicationName'] == ApplicationName and
+                    (not EnvironmentNames or e['EnvironmentName'] in EnvironmentNames)]
+        start = int(NextToken or 0)
+        end = start + (MaxRecords or len(envs))
+        response = {'Environments': [self.eb.describe(e) for e in envs[start:end]]}
+        if end < len(envs):
+            response['NextToken'] = str(end)
+        return response
+
+    def describe_events(self, ApplicationName, EnvironmentName=None, StartTime=None, MaxRecords=None,
+                        NextToken=None):
+        self.eb.request('DescribeEvents')
+        with self.eb._lock:
+            events = [e for e in self.eb.events if e['ApplicationName'] == ApplicationName and
+                      (EnvironmentName is None or e['EnvironmentName'] == EnvironmentName) and
+                      (StartTime is None or e['EventDate'] >= StartTime)]
+        events.reverse()
+        start = int(NextToken or 0)
+        end = start + (MaxRecords or PAGE_SIZE)
+        response = {'Events': events[start:end]}
+        if end < len(events):
+            response['NextToken'] = str(end)
+        return response
+
+    def swap_environment_cnames(self, SourceEnvironmentName, DestinationEnvironmentName):
+        self.eb.request('SwapEnvironmentCNAMEs')
+        with self.eb._lock:
+            source = self.eb.environments[SourceEnvironmentName]
+            dest = self.eb.environments[DestinationEnvironmentName]
+            for env in (source, dest):
+                if self.eb.describe(env)['Status'] != 'Ready':
+                    error = FakeClientError('InvalidParameterValue', 'SwapEnvironmentCNAMEs')
+                    error.response['Error']['Message'] = ('Environment named ' + env['EnvironmentName'] +
+                                                          ' is in an invalid state for this operation. Must be Ready.')
+                    raise error
+            source['CNAME'], dest['CNAME'] = dest['CNAME'], source['CNAME']
+            source['updated_at'] = dest['updated_at'] = time.time() + self.eb.swap_after
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def create_application_version(self, ApplicationName, VersionLabel, SourceBundle=None, **kwargs):
+        self.eb.request('CreateApplicationVersion')
+        with self.eb._lock:
+            self.eb.versions[(ApplicationName, VersionLabel)] = dict(SourceBundle or {})
+        return {'ApplicationVersion': {'ApplicationName': ApplicationName, 'VersionLabel': VersionLabel,
+                                       'SourceBundle': SourceBundle}}
+
+    def describe_application_versions(self, ApplicationName, NextToken=None):
+        self.eb.request('DescribeApplicationVersions')
+        with self.eb._lock:
+            versions = [{'ApplicationName': app, 'VersionLabel': label, 'SourceBundle': bundle}
+                        for (app, label), bundle in self.eb.versions.items() if app == ApplicationName]
+        return {'ApplicationVersions': versions}
+
+    def validate_configuration_settings(self, ApplicationName, OptionSettings, TemplateName=None, **kwargs):
+        self.eb.request('ValidateConfigurationSettings')
+        return {'Messages': []}
+
+    def create_environment(self, ApplicationName, EnvironmentName, VersionLabel=None, **kwargs):
+        self.eb.request('CreateEnvironment')
+        self.eb.add_environment(ApplicationName, EnvironmentName, version_label=VersionLabel)
+        return self.eb.describe(self.eb.environments[EnvironmentName])
@@ -0,0 +1,179 @@
+#
+# An in-memory stand-in for the parts of the boto S3 API the scripts use: single PUT and multipart uploads, server
+# side copies, listing with or without a delimiter, HEAD and batched deletes. Requests go through the latency and throttling model in
+# fake_service.py and throttled requests fail with 503 SlowDown, so the S3 pipelines can be benchmarked without
+# touching AWS.
+#
+# boto_scripts.multipart builds its MultiPartUpload objects from boto directly. Benchmarks point it at this module
+# instead with:
+#
+#    multipart._multipart_upload = fake_s3.multipart_upload
+#
+
+import collections
+import hashlib
+import itertools
+import os
+import threading
+
+from fake_service import FakeService
+
+FakeKeyInfo = collections.namedtuple('FakeKeyInfo', ['name', 'size', 'etag', 'last_modified'])
+FakePrefix = collections.namedtuple('FakePrefix', ['name'])
+FakePart = collections.namedtuple('FakePart', ['part_number', 'etag', 'size'])
+FakeDeleteResult = collections.namedtuple('FakeDeleteResult', ['deleted', 'errors'])
+
+LAST_MODIFIED = '2015-09-01T12:00:00.000Z'
+
+
+class FakeS3Error(Exception):
+    def __init__(self, status, error_code):
+        Exception.__init__(self, '{} {}'.format(status, error_code))
+        self.status = status
+        self.error_code = error_code
+
+
+class FakeS3(FakeService):
+    def __init__(self, latency=0.02, bandwidth=50 * 1024 * 1024, throttle_rate=0.0, capacity=None):
+        FakeService.__init__(self, latency, bandwidth, throttle_rate, capacity)
+        self.buckets = collections.defaultdict(dict)
+        self.uploads = {}
+        self._upload_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def objects(self):
+        # All objects of all buckets, for benchmarks that only use one
+        result = {}
+        for objects in self.buckets.values():
+            result.update(objects)
+        return result
+
+    def throttle_error(self, operation):
+        return FakeS3Error(503, 'SlowDown')
+
+    def connect(self):
+        return FakeS3Connection(self)
+
+    def put_object(self, bucket_name, name, size, etag):
+        self.buckets[bucket_name][name] = (size, etag)
+
+
+class FakeS3Connection(object):
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def get_bucket(self, name, validate=True):
+        return FakeBucket(self.s3, name)
+
+
+class FakeBucket(object):
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+
+    @property
+    def objects(self):
+        return self.s3.buckets[self.name]
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def get_key(self, name):
+        self.s3.request('HeadObject')
+        if name not in self.objects:
+            return None
+        key = FakeKey(self, name)
+        key.size, etag = self.objects[name]
+        key.etag = '"{}"'.format(etag)
+        return key
+
+    def list(self, prefix='', delimiter='', marker=''):
+        # Like boto, pages of 1000 keys are fetched as the listing is iterated
+        names = sorted(n for n in self.objects if n.startswith(prefix) and n > marker)
+        seen_prefixes = set()
+        for i, name in enumerate(names):
+            if i % 1000 == 0:
+                self.s3.request('ListObjects')
+            if delimiter:
+                cut = name.find(delimiter, len(prefix))
+                if cut != -1:
+                    common = name[:cut + len(delimiter)]
+                    if common not in seen_prefixes:
+                        seen_prefixes.add(common)
+                        yield FakePrefix(common)
+                    continue
+            size, etag = self.objects[name]
+            yield FakeKeyInfo(name, size, '"{}"'.format(etag), LAST_MODIFIED)
+        if not names:
+            self.s3.request('ListObjects')
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name, metadata=None, preserve_acl=False):
+        self.s3.request('CopyObject')
+        source = self.s3.buckets[src_bucket_name].get(src_key_name)
+        if source is None:
+            raise FakeS3Error(404, 'NoSuchKey')
+        self.objects[new_key_name] = source
+        return FakeKey(self, new_key_name)
+
+    def delete_keys(self, names, quiet=False):
+        self.s3.request('DeleteObjects')
+        for name in names:
+            self.objects.pop(name, None)
+        return FakeDeleteResult([], [])
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        self.s3.request('CreateMultipartUpload')
+        with self.s3._lock:
+            upload = FakeMultiPartUpload(self, key_name, str(next(self.s3._upload_ids)))
+            self.s3.uploads[upload.id] = upload
+        return upload
+
+    def list_multipart_uploads(self):
+        self.s3.request('ListMultipartUploads')
+        return [u for u in list(self.s3.uploads.values()) if u.bucket.name == self.name]
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket, key_name, upload_id):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = upload_id
+        self.parts = {}
+
+    def __iter__(self):
+        return iter([self.parts[n] for n in sorted(self.parts)])
+
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        data = fp.read(size) if size is not None else fp.read()
+        self.bucket.s3.request('UploadPart', len(data))
+        etag = md5[0] if md5 else hashlib.md5(data).hexdigest()
+        self.parts[part_num] = FakePart(part_num, '"{}"'.format(etag), len(data))
+
+    def complete_upload(self):
+        self.bucket.s3.request('CompleteMultipartUpload')
+        parts = list(self)
+        digest = hashlib.md5(b''.join(bytes.fromhex(p.etag.strip('"')) for p in parts)).hexdigest()
+        self.bucket.objects[self.key_name] = (sum(p.size for p in parts), '{}-{}'.format(digest, len(parts)))
+        self.bucket.s3.uploads.pop(self.id, None)
+
+
+def multipart_upload(bucket, key_name, upload_id):
+    # Replacement for boto_scripts.multipart._multipart_upload
+    return bucket.s3.uploads[upload_id]
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.etag = None
+
+    def set_contents_from_filename(self, filename, policy=None, md5=None, headers=None):
+        size = os.path.getsize(filename)
+        self.bucket.s3.request('PutObject', size)
+        if md5 is None:
+            with open(filename, 'rb') as f:
+                md5 = (hashlib.md5(f.read()).hexdigest(), None)
+        self.bucket.objects[self.name] = (size, md5[0])
@@ -0,0 +1,91 @@
+#
+# Latency and throttling model shared by the in-memory AWS stand-ins in this directory. Every request sleeps for a
+# fixed latency plus the time it would take to move its body at the given bandwidth, and a fraction of requests fail
+# the way the real service fails when it throttles. With a capacity, requests are also throttled while more than that
+# many are in flight at once, which is what an adaptive client has to find. Request counts and latencies are kept so
+# benchmarks can report them.
+#
+
+import abc
+import random
+import threading
+import time
+
+
+class FakeClientError(Exception):
+    # Same shape as botocore's ClientError, for the boto3 stand-ins
+    def __init__(self, code, operation):
+        Exception.__init__(self, 'An error occurred ({}) when calling the {} operation'.format(code, operation))
+        self.response = {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+        self.operation_name = operation
+
+
+class FakeEvents(object):
+    # boto_scripts.instrument registers botocore event handlers on every client. The stand-ins have no HTTP layer to
+    # fire them from, so registering is accepted and ignored.
+    def register(self, event_name, handler, unique_id=None):
+        pass
+
+
+class FakeMeta(object):
+    def __init__(self, region_name):
+        self.region_name = region_name
+        self.events = FakeEvents()
+
+
+class FakeService(abc.ABC):
+    def __init__(self, latency=0.02, bandwidth=50 * 1024 * 1024, throttle_rate=0.0, capacity=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.capacity = capacity
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.latencies = []
+        self._stats_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def throttle_error(self, operation):
+        # The exception the service raises when it throttles operation
+        pass
+
+    def request(self, operation='', body_size=0):
+        with self._stats_lock:
+            self.requests += 1
+            self.in_flight += 1
+            throttle = random.random() < self.throttle_rate or (self.capacity and self.in_flight > self.capacity)
+            if throttle:
+                self.throttled += 1
+        delay = self.latency + float(body_size) / self.bandwidth
+        time.sleep(delay)
+        with self._stats_lock:
+            self.in_flight -= 1
+            self.latencies.append(delay)
+        if throttle:
+            raise self.throttle_error(operation)
+
+    def percentile(self, pct):
+        with self._stats_lock:
+            values = sorted(self.latencies)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class FakeClientFactory(object):
+    # Stands in for boto_scripts.clients.ClientFactory, handing out stand-in clients by service name. s3 is a
+    # fake_s3.FakeS3 for bucket_getter.
+    def __init__(self, s3=None, **services):
+        self.s3 = s3
+        self.services = services
+
+    def credentials(self):
+        return None
+
+    def client(self, service_name, region=None, pool_size=None):
+        return self.services[service_name].client(region or 'us-east-1')
+
+    def bucket_getter(self, bucket_name):
+        bucket = self.s3.connect().get_bucket(bucket_name, validate=False)
+        return lambda: bucket
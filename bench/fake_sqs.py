@@ -0,0 +1,180 @@
+#
+# An in-memory stand-in for the boto3 SQS client calls boto_scripts/sqs_ops.py and sqs/sqs_util.py make. Received messages stay in flight until
+# they are deleted or their visibility timeout runs out, as on a real queue. A long poll on an empty queue returns as
+# soon as nothing is left in flight instead of waiting out WaitTimeSeconds, so benchmarks that drain a queue finish
+# promptly. Throttled requests fail with a ThrottlingException client error.
+#
+# The sqs_ops functions take a client, so benchmarks pass them sqs.client().
+#
+
+import collections
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+from fake_service import FakeClientError, FakeMeta, FakeService
+
+QUEUE_URL_PREFIX = 'https://sqs.fake.amazonaws.com/000000000000/'
+DEFAULT_VISIBILITY_TIMEOUT = 30
+
+
+class FakeQueue(object):
+    def __init__(self, name):
+        self.name = name
+        self.fifo = name.endswith('.fifo')
+        self.visible = collections.deque()
+        self.in_flight = {}
+        self._timeouts = []  # (visible_at, handle), may hold stale entries for deleted or changed handles
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.visible) + len(self.in_flight)
+
+    def hide(self, handle, message, visible_at):
+        self.in_flight[handle] = (message, visible_at)
+        heapq.heappush(self._timeouts, (visible_at, handle))
+
+    def _expire(self, now):
+        while self._timeouts and self._timeouts[0][0] <= now:
+            visible_at, handle = heapq.heappop(self._timeouts)
+            entry = self.in_flight.get(handle)
+            if entry is not None and entry[1] == visible_at:
+                del self.in_flight[handle]
+                self.visible.appendleft(entry[0])
+
+
+class FakeSQS(FakeService):
+    def __init__(self, latency=0.01, bandwidth=50 * 1024 * 1024, throttle_rate=0.0, capacity=None):
+        FakeService.__init__(self, latency, bandwidth, throttle_rate, capacity)
+        self.queues = {}
+        self._receipts = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def throttle_error(self, operation):
+        return FakeClientError('ThrottlingException', operation)
+
+    def create_queue(self, name):
+        with self._lock:
+            return self.queues.setdefault(name, FakeQueue(name))
+
+    def add_message(self, queue_name, body, attributes=None, system_attributes=None):
+        queue = self.create_queue(queue_name)
+        message = {
+            'MessageId': str(uuid.uuid4()),
+            'Body': body,
+            'MD5OfBody': hashlib.md5(body.encode('utf-8')).hexdigest(),
+            'MessageAttributes': dict(attributes or {}),
+            'Attributes': dict({'SentTimestamp': str(int(time.time() * 1000)), 'ApproximateReceiveCount': '0'},
+                               **(system_attributes or {}))
+        }
+        with queue.lock:
+            queue.visible.append(message)
+        return message
+
+    def client(self, region_name='us-east-1'):
+        return FakeSQSClient(self, region_name)
+
+
+class FakeSQSClient(object):
+    def __init__(self, sqs, region_name):
+        self.sqs = sqs
+        self.meta = FakeMeta(region_name)
+
+    def _queue(self, queue_url, operation):
+        queue = self.sqs.queues.get(queue_url[len(QUEUE_URL_PREFIX):])
+        if queue is None:
+            raise FakeClientError('AWS.SimpleQueueService.NonExistentQueue', operation)
+        return queue
+
+    def get_queue_url(self, QueueName):
+        self.sqs.request('GetQueueUrl')
+        if QueueName not in self.sqs.queues:
+            raise FakeClientError('AWS.SimpleQueueService.NonExistentQueue', 'GetQueueUrl')
+        return {'QueueUrl': QUEUE_URL_PREFIX + QueueName}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        size = sum(len(e['MessageBody'].encode('utf-8')) for e in Entries)
+        self.sqs.request('SendMessageBatch', size)
+        queue = self._queue(QueueUrl, 'SendMessageBatch')
+        successful = []
+        for e in Entries:
+            system_attributes = {}
+            if 'MessageGroupId' in e:
+                system_attributes['MessageGroupId'] = e['MessageGroupId']
+            message = self.sqs.add_message(queue.name, e['MessageBody'], e.get('MessageAttributes'),
+                                           system_attributes)
+            successful.append({'Id': e['Id'], 'MessageId': message['MessageId'],
+                               'MD5OfMessageBody': message['MD5OfBody']})
+        return {'Successful': successful, 'Failed': []}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        result = self.send_message_batch(QueueUrl, [dict(kwargs, Id='0', MessageBody=MessageBody,
+                                                         MessageAttributes=MessageAttributes or {})])
+        return result['Successful'][0]
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None,
+                        AttributeNames=None, MessageAttributeNames=None, **kwargs):
+        queue = self._queue(QueueUrl, 'ReceiveMessage')
+        # A throttled receive fails before it takes any messages, as on a real queue
+        self.sqs.request('ReceiveMessage')
+        timeout = DEFAULT_VISIBILITY_TIMEOUT if VisibilityTimeout is None else VisibilityTimeout
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            now = time.time()
+            with queue.lock:
+                queue._expire(now)
+                messages = []
+                while queue.visible and len(messages) < MaxNumberOfMessages:
+                    message = queue.visible.popleft()
+                    count = int(message['Attributes'].get('ApproximateReceiveCount', '0')) + 1
+                    message['Attributes']['ApproximateReceiveCount'] = str(count)
+                    handle = 'receipt-{}'.format(next(self.sqs._receipts))
+                    queue.hide(handle, message, now + timeout)
+                    messages.append(dict(message, ReceiptHandle=handle))
+                waiting = bool(queue.in_flight)
+            if messages or not waiting or now >= deadline:
+                break
+            # Messages in flight may come back when their visibility timeout runs out
+            time.sleep(min(0.05, max(0, deadline - now)))
+        if not AttributeNames:
+            messages = [dict(m, Attributes={}) for m in messages]
+        if not MessageAttributeNames:
+            messages = [dict(m, MessageAttributes={}) for m in messages]
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.sqs.request('DeleteMessageBatch')
+        queue = self._queue(QueueUrl, 'DeleteMessageBatch')
+        successful = []
+        failed = []
+        with queue.lock:
+            for e in Entries:
+                if queue.in_flight.pop(e['ReceiptHandle'], None) is not None:
+                    successful.append({'Id': e['Id']})
+                else:
+                    failed.append({'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True,
+                                   'Message': 'The receipt handle has expired'})
+        return {'Successful': successful, 'Failed': failed}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.sqs.request('ChangeMessageVisibilityBatch')
+        queue = self._queue(QueueUrl, 'ChangeMessageVisibilityBatch')
+        successful = []
+        failed = []
+        now = time.time()
+        with queue.lock:
+            for e in Entries:
+                entry = queue.in_flight.get(e['ReceiptHandle'])
+                if entry is None:
+                    failed.append({'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True,
+                                   'Message': 'The receipt handle has expired'})
+                    continue
+                queue.hide(e['ReceiptHandle'], entry[0], now + e['VisibilityTimeout'])
+                successful.append({'Id': e['Id']})
+            queue._expire(now)
+        return {'Successful': successful, 'Failed': failed}
+
@@ -0,0 +1,75 @@
+#
+# Measures how S3Sync's upload pipeline scales with the number of workers, using the in-memory S3 stand-in in
+# fake_s3.py. Nothing is sent to AWS.
+#
+#    --files        : Number of files to generate. Defaults to 500.
+#    --size         : Size of each file in bytes. Defaults to 20000.
+#    --latency      : Simulated per-request latency in seconds. Defaults to 0.02.
+#    --throttle     : Fraction of requests that fail with 503 SlowDown. Defaults to 0.
+#    --workers      : Comma separated worker counts to try. Defaults to 1,2,4,8,16,32.
+#
+# Example: python s3_upload_bench.py --files 1000 --latency 0.05 --throttle 0.01
+#
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import s3_util
+from boto_scripts import throttle
+from fake_s3 import FakeS3
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--workers", default="1,2,4,8,16,32")
+    return parser.parse_args()
+
+
+def _make_tree(root, count, size):
+    for i in range(count):
+        d = os.path.join(root, 'dir{}'.format(i % 20))
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        with open(os.path.join(d, 'file{}.js'.format(i)), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    root = tempfile.mkdtemp()
+    try:
+        _make_tree(root, args.files, args.size)
+        manifest = s3_util.build_local_manifest(root)
+        files = [manifest[k] for k in sorted(manifest)]
+
+        results = []
+        stdout = sys.stdout
+        for workers in [int(w) for w in args.workers.split(',')]:
+            s3 = FakeS3(latency=args.latency, throttle_rate=args.throttle)
+            get_bucket = s3_util.thread_local_bucket(s3.connect, 'bench')
+            # Start every worker count from a fresh limiter rather than what the last run learned
+            throttle.reset()
+            sys.stdout = open(os.devnull, 'w')
+            start = time.time()
+            failures = s3_util.upload_files(get_bucket, files, workers)
+            elapsed = time.time() - start
+            sys.stdout.close()
+            sys.stdout = stdout
+            results.append((workers, elapsed, len(files) / elapsed, args.files * args.size / elapsed / 1024 / 1024,
+                            s3.throttled, len(failures)))
+
+        print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('workers', 'seconds', 'files/s', 'MB/s', 'throttled',
+                                                             'failed'))
+        for r in results:
+            print('{:>8} {:>10.2f} {:>10.1f} {:>10.2f} {:>10} {:>8}'.format(*r))
+    finally:
+        shutil.rmtree(root)
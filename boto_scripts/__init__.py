@@ -0,0 +1,4 @@
+#
+# Shared helpers for the scripts in beanstalk/, s3/ and sqs/. The scripts add the repository root to sys.path so
+# this package can be imported no matter which directory Jenkins launches them from.
+#
@@ -0,0 +1,137 @@
+#
+# Shared AWS sessions and clients for the scripts and for anything that imports boto_scripts as a library.
+#
+# A ClientFactory holds one boto3 session per role and region and hands out one client per service, so a process that
+# runs many operations builds each of them only once. Clients get a connection pool sized for the number of threads
+# that will share them, TCP keep-alive, and the timing hooks from instrument.py. Credentials for a role come from
+# credentials.assume_role; when they are refreshed the session and its clients are rebuilt on next use.
+#
+# The older boto library is still used for S3 (multipart.py and s3_util.py are written against it). s3_connection
+# returns a new boto S3Connection with the same credentials, and bucket_getter wraps that in a per-thread bucket.
+# cloudfront_connection does the same for CloudFront.
+#
+# botocore's own retries are turned off: calls that should be retried go through a limiter from throttle.py instead.
+#
+# boto and boto3 are only imported the first time a client is needed, so scripts that fail argument checking, or only
+# use one of the two libraries, do not pay for loading the other.
+#
+#    from boto_scripts import clients
+#    factory = clients.factory(role_arn='arn:aws:iam::775678901234:role/MyARN', region='us-east-1')
+#    eb = factory.client('elasticbeanstalk')
+#
+
+import threading
+
+from boto_scripts import credentials
+from boto_scripts import instrument
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+_factories = {}
+_factories_lock = threading.Lock()
+
+
+class ClientFactory(object):
+    def __init__(self, role_arn=None, session_name=None, region=None, pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        # With no role_arn the default credential chain (environment, profile, instance role) is used
+        self.role_arn = role_arn
+        self.session_name = session_name
+        self.region = region
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._creds = None
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def credentials(self):
+        # The assumed role's credentials, or None when using the default credential chain
+        if self.role_arn is None:
+            return None
+        return credentials.assume_role(self.role_arn, self.session_name)
+
+    def session(self):
+        creds = self.credentials()
+        with self._lock:
+            if self._session is None or creds is not self._creds:
+                import boto3
+                kwargs = credentials.boto3_kwargs(creds) if creds is not None else {}
+                self._session = boto3.session.Session(region_name=self.region, **kwargs)
+                self._creds = creds
+                self._clients = {}
+            return self._session
+
+    def _config(self, pool_size):
+        from botocore.config import Config
+        kwargs = {
+            'max_pool_connections': pool_size or self.pool_size,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            # Retrying is left to throttle.py so its limiters see every throttle. A botocore retry would hide them.
+            'retries': {'mode': 'standard', 'total_max_attempts': 1}
+        }
+        if self.keep_alive:
+            kwargs['tcp_keepalive'] = True
+        return Config(**kwargs)
+
+    def client(self, service_name, region=None, pool_size=None):
+        # boto3 clients are safe to share between threads, unlike the session that creates them
+        session = self.session()
+        region = region or self.region
+        key = (service_name, region, pool_size)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = instrument.instrument_client(
+                    session.client(service_name, region_name=region, config=self._config(pool_size)))
+                self._clients[key] = client
+            return client
+
+    def s3_connection(self, creds=None):
+        # A new boto S3Connection, to the factory's region if it has one. boto connections must not be shared between
+        # threads.
+        import boto.s3.connection
+        kwargs = {'calling_format': boto.s3.connection.OrdinaryCallingFormat()}
+        if self.region and self.region != 'us-east-1':
+            # Path style requests for a bucket outside us-east-1 have to go to its region's endpoint
+            kwargs['host'] = 's3.' + self.region + '.amazonaws.com'
+        creds = creds or self.credentials()
+        if creds is not None:
+            kwargs.update(credentials.boto_kwargs(creds))
+        return boto.s3.connection.S3Connection(**kwargs)
+
+    def cloudfront_connection(self):
+        import boto
+        creds = self.credentials()
+        if creds is None:
+            return boto.connect_cloudfront()
+        return boto.connect_cloudfront(creds['AccessKeyId'], creds['SecretAccessKey'],
+                                       security_token=creds['SessionToken'])
+
+    def bucket_getter(self, bucket_name):
+        # Like s3_util.thread_local_bucket, but a thread's connection is replaced once the credentials are refreshed
+        local = threading.local()
+
+        def get_bucket():
+            creds = self.credentials()
+            if not hasattr(local, 'bucket') or local.creds is not creds:
+                local.bucket = self.s3_connection(creds).get_bucket(bucket_name, validate=False)
+                local.creds = creds
+            return local.bucket
+        return get_bucket
+
+
+def factory(role_arn=None, session_name=None, region=None, **kwargs):
+    # Returns the same ClientFactory for the same role and region for the life of the process. Options other than
+    # the role and region only apply when the factory is first created.
+    key = (role_arn, region)
+    with _factories_lock:
+        f = _factories.get(key)
+        if f is None:
+            f = _factories[key] = ClientFactory(role_arn, session_name, region, **kwargs)
+        return f
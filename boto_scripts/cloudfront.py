@@ -0,0 +1,134 @@
+#
+# Works out which CloudFront paths to invalidate after a sync, and sends and optionally waits for the invalidations.
+#
+# Only the keys the sync uploaded or deleted are invalidated. A directory with at least collapse_threshold changed
+# entries is invalidated with a single '/dir/*' wildcard instead, since CloudFront charges per path and a wildcard
+# counts as one path. The top of the bucket is never collapsed this way, since '/*' empties every edge cache of the
+# distribution; it only comes to that when the limits below leave nothing else. If there are still more than max_paths
+# paths, the directories with the most changes are collapsed until there are not. CloudFront also allows only
+# MAX_WILDCARD_PATHS wildcard paths and MAX_FILE_PATHS file paths in progress per distribution, so wildcards are merged
+# further up the tree until there are at most MAX_WILDCARD_PATHS of them, ending at '/*' if need be, and max_paths is
+# capped at MAX_FILE_PATHS. The result is sent in requests of at most MAX_PATHS_PER_REQUEST paths, through the
+# distribution's limiter (see throttle.py) since CloudFront throttles invalidations hard.
+#
+
+import collections
+import time
+
+from boto_scripts import instrument
+from boto_scripts import throttle
+
+DEFAULT_COLLAPSE_THRESHOLD = 10
+MIN_COLLAPSE_THRESHOLD = 2
+DEFAULT_MAX_PATHS = 1000
+MAX_PATHS_PER_REQUEST = 1000
+MAX_WILDCARD_PATHS = 15  # wildcard paths CloudFront allows in progress at once
+MAX_FILE_PATHS = 3000  # file paths CloudFront allows in progress at once
+DEFAULT_WAIT_TIMEOUT = 900
+WAIT_INITIAL_DELAY = 5
+WAIT_MAX_DELAY = 30
+
+
+def _parent(path):
+    # '/a/b/c.js' and '/a/b/*' are both entries of '/a/b/'. Parent of '/a/b/*' itself is '/a/'.
+    if path.endswith('/*'):
+        path = path[:-2]
+    return path[:path.rstrip('/').rfind('/') + 1]
+
+
+def _collapse_group(paths, directory):
+    kept = set(p for p in paths if not p.startswith(directory))
+    kept.add(directory + '*')
+    return kept
+
+
+def _limit_wildcards(paths, max_wildcards):
+    while '/*' not in paths:
+        wildcards = [p for p in paths if p.endswith('*')]
+        if len(wildcards) <= max_wildcards:
+            break
+        by_parent = collections.defaultdict(list)
+        for w in wildcards:
+            by_parent[_parent(w)].append(w)
+        busiest = max(by_parent, key=lambda d: (len(by_parent[d]), len(d)))
+        if len(by_parent[busiest]) == 1:
+            # No two wildcards share a parent, so move the deepest one up a level
+            busiest = _parent(max(wildcards, key=len))
+        paths = _collapse_group(paths, busiest)
+    return paths
+
+
+def invalidation_paths(keys, collapse_threshold=DEFAULT_COLLAPSE_THRESHOLD, max_paths=DEFAULT_MAX_PATHS,
+                       max_wildcards=MAX_WILDCARD_PATHS):
+    # Raises ValueError if collapse_threshold is below MIN_COLLAPSE_THRESHOLD, since a directory with a single change
+    # would then collapse into a wildcard of its own, and that into its parent's, up to the top of the bucket.
+    if collapse_threshold < MIN_COLLAPSE_THRESHOLD:
+        raise ValueError('The collapse threshold must be at least ' + str(MIN_COLLAPSE_THRESHOLD) + ', not ' +
+                         str(collapse_threshold))
+    max_paths = min(max_paths, MAX_FILE_PATHS)
+    paths = set('/' + k.lstrip('/') for k in keys)
+    if not paths:
+        return []
+
+    while '/*' not in paths:
+        by_dir = collections.defaultdict(list)
+        for p in paths:
+            by_dir[_parent(p)].append(p)
+        # Deepest directories first so a collapse can make its parent eligible on the next pass. '/' is left to the
+        # path limits.
+        crowded = [d for d in sorted(by_dir, key=len, reverse=True)
+                   if d != '/' and len(by_dir[d]) >= collapse_threshold]
+        if crowded:
+            paths = _collapse_group(paths, crowded[0])
+            continue
+        if len(paths) <= max_paths:
+            break
+        busiest = max(by_dir, key=lambda d: (len(by_dir[d]), len(d)))
+        if len(by_dir[busiest]) == 1 and busiest == '/':
+            break
+        if len(by_dir[busiest]) == 1:
+            # Every directory has a single change, so move the deepest one up a level
+            busiest = _parent(max(paths, key=len))
+        paths = _collapse_group(paths, busiest)
+    paths = _limit_wildcards(paths, max_wildcards)
+    # '/*' covers everything else
+    return ['/*'] if '/*' in paths else sorted(paths)
+
+
+def create_invalidations(cf, dist_id, paths):
+    # cf is a boto CloudFrontConnection. Returns the ids of the invalidation requests.
+    limiter = throttle.limiter('cloudfront', dist_id)
+    ids = []
+    for i in range(0, len(paths), MAX_PATHS_PER_REQUEST):
+        chunk = paths[i:i + MAX_PATHS_PER_REQUEST]
+        print('Invalidating', len(chunk), 'paths:', ', '.join(chunk[:10]) + (' ...' if len(chunk) > 10 else ''))
+
+        def create():
+            with instrument.timed('cloudfront', 'CreateInvalidation'):
+                return cf.create_invalidation_request(dist_id, chunk).id
+        ids.append(limiter.call('CreateInvalidation', create))
+    return ids
+
+
+def _invalidation_status(cf, dist_id, invalidation_id):
+    def get():
+        with instrument.timed('cloudfront', 'GetInvalidation'):
+            return cf.invalidation_request_status(dist_id, invalidation_id).status
+    return throttle.limiter('cloudfront', dist_id).call('GetInvalidation', get)
+
+
+def wait_for_invalidations(cf, dist_id, ids, timeout=DEFAULT_WAIT_TIMEOUT):
+    deadline = time.time() + timeout
+    pending = list(ids)
+    delay = WAIT_INITIAL_DELAY
+    while pending:
+        pending = [i for i in pending if _invalidation_status(cf, dist_id, i) != 'Completed']
+        if not pending:
+            break
+        if time.time() + delay > deadline:
+            return False
+        print('Waiting for', len(pending), 'invalidation(s) to complete')
+        time.sleep(delay)
+        delay = min(WAIT_MAX_DELAY, delay * 2)
+    print('Invalidation complete')
+    return True
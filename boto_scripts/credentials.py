@@ -0,0 +1,137 @@
+#
+# Cached STS credentials shared by all of the scripts.
+#
+# A Jenkins pipeline that runs the deploy, health and swap scripts one after another would otherwise call
+# assume_role for the same role several times within a few seconds. Credentials are kept in memory for the life of
+# the process and in a file per role under ~/.cache/boto-scripts/sts (or BOTO_SCRIPTS_CACHE), readable only by the
+# current user. They are refreshed once they are within REFRESH_MARGIN seconds of their Expiration. The cache file is
+# locked while it is checked and refreshed, so jobs that start together make a single STS call between them.
+#
+# Set BOTO_SCRIPTS_NO_CACHE=true to skip the file cache and always call STS.
+#
+
+import getpass
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from boto_scripts import instrument
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on Windows. Writes are still atomic, so the worst case is a few extra STS calls.
+    fcntl = None
+
+DEFAULT_DURATION = 3600
+REFRESH_MARGIN = 300
+
+_memory_cache = {}
+_lock = threading.Lock()
+
+
+def _cache_dir():
+    return os.environ.get('BOTO_SCRIPTS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'boto-scripts', 'sts'))
+
+
+def _use_file_cache():
+    return os.environ.get('BOTO_SCRIPTS_NO_CACHE', 'false').lower() != 'true'
+
+
+def default_session_name():
+    name = os.environ.get('ROLE_SESS_NAME') or 'boto-scripts-' + getpass.getuser()
+    # RoleSessionName only allows these characters and must be at most 64 long
+    return re.sub(r'[^\w+=,.@-]', '-', name)[:64]
+
+
+def _fresh(creds):
+    return creds is not None and creds['Expiration'] - REFRESH_MARGIN > time.time()
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write(path, creds):
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(creds, f)
+    os.replace(tmp, path)
+
+
+def _call_sts(role_arn, session_name, duration):
+    import boto3
+    print('Assuming role ', role_arn, ' as ', session_name)
+    response = instrument.instrument_client(boto3.client('sts')).assume_role(
+        RoleArn=role_arn,
+        RoleSessionName=session_name,
+        DurationSeconds=duration
+    )
+    creds = response['Credentials']
+    return {
+        'AccessKeyId': creds['AccessKeyId'],
+        'SecretAccessKey': creds['SecretAccessKey'],
+        'SessionToken': creds['SessionToken'],
+        'Expiration': creds['Expiration'].timestamp()
+    }
+
+
+def _assume_role_file_cached(role_arn, session_name, duration):
+    cache_dir = _cache_dir()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    path = os.path.join(cache_dir, hashlib.sha1(role_arn.encode('utf-8')).hexdigest() + '.json')
+    with open(path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            creds = _read(path)
+            if _fresh(creds):
+                print('Using cached credentials for ', role_arn)
+                instrument.count('sts_cache_hits')
+                return creds
+            creds = _call_sts(role_arn, session_name, duration)
+            _write(path, creds)
+            return creds
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def assume_role(role_arn, session_name=None, duration=DEFAULT_DURATION):
+    # Returns a dict with AccessKeyId, SecretAccessKey, SessionToken and Expiration (seconds since the epoch)
+    with _lock:
+        creds = _memory_cache.get(role_arn)
+        if not _fresh(creds):
+            session_name = session_name or default_session_name()
+            if _use_file_cache():
+                creds = _assume_role_file_cached(role_arn, session_name, duration)
+            else:
+                creds = _call_sts(role_arn, session_name, duration)
+            _memory_cache[role_arn] = creds
+        return creds
+
+
+def boto3_kwargs(creds):
+    return {
+        'aws_access_key_id': creds['AccessKeyId'],
+        'aws_secret_access_key': creds['SecretAccessKey'],
+        'aws_session_token': creds['SessionToken']
+    }
+
+
+def boto_kwargs(creds):
+    # The older boto library calls the session token security_token
+    return {
+        'aws_access_key_id': creds['AccessKeyId'],
+        'aws_secret_access_key': creds['SecretAccessKey'],
+        'security_token': creds['SessionToken']
+    }
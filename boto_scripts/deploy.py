@@ -0,0 +1,261 @@
+#
+# Uploads a Beanstalk application bundle, creates an application version from it and launches an environment on
+# that version. beanstalk/DeployBeanstalkEnv.py is a thin wrapper around deploy() that reads its settings from
+# environment variables.
+#
+# The bundle goes up with multipart.upload_file, so big artifacts are sent in parallel parts and an interrupted upload
+# resumes. With dedup the artifact is stored under its SHA-256: an artifact already in the bucket is not uploaded
+# again, and an application version already built from it is reused instead of creating a new one.
+#
+#    from boto_scripts import clients, deploy
+#    factory = clients.factory(role_arn, region='us-east-1')
+#    result = deploy.deploy(factory, 'my-bucket', 'build/app.zip', 'my-app', '42', 'My_EB_App', 'my-env-42',
+#                           'my-template')
+#
+# deploy_targets rolls the same artifact out to many account/region targets at once, read with load_targets from a
+# JSON list such as:
+#
+#    [{"name": "prod-us", "role_arn": "arn:aws:iam::775678901234:role/MyARN", "region": "us-east-1",
+#      "bucket": "my-bucket-us", "app_name": "My_EB_App", "env_name": "my-env-42", "template": "my-template"},
+#     {"name": "prod-eu", "role_arn": "arn:aws:iam::775678901235:role/MyARN", "region": "eu-west-1",
+#      "bucket": "my-bucket-eu", "app_name": "My_EB_App", "env_name": "my-env-42", "template": "my-template"}]
+#
+# The artifact is uploaded once per region, to the first bucket of that region, and copied server side from there to
+# the region's other buckets. A copy that fails (the target's role cannot read the first bucket, say) falls back to
+# uploading. Each target's application version and environment are created as soon as its bucket has the artifact,
+# with at most `parallelism` targets in flight, so the release takes about as long as its slowest target. A failed
+# target does not stop the others; its error is kept in its TargetResult.
+#
+
+import collections
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from boto_scripts import clients
+from boto_scripts import eb_util
+from boto_scripts import instrument
+from boto_scripts import multipart
+from boto_scripts import s3_util
+
+VERSION_DESCRIPTION = 'eb app ver created via boto'
+DEFAULT_PARALLELISM = 8
+
+DeployResult = collections.namedtuple('DeployResult', ['key_name', 'version_label', 'uploaded', 'version_created',
+                                                       'environment'])
+Target = collections.namedtuple('Target', ['name', 'role_arn', 'session_name', 'region', 'bucket_name', 'app_name',
+                                           'env_name', 'template_name'])
+# staged is 'uploaded', 'copied' or 'existing', or None if the artifact never reached the target's bucket
+TargetResult = collections.namedtuple('TargetResult', ['target', 'key_name', 'staged', 'version_label',
+                                                       'version_created', 'environment', 'error'])
+
+# Target fields by their name in a targets file
+TARGET_KEYS = collections.OrderedDict([
+    ('name', 'name'),
+    ('role_arn', 'role_arn'),
+    ('role_session_name', 'session_name'),
+    ('region', 'region'),
+    ('bucket', 'bucket_name'),
+    ('app_name', 'app_name'),
+    ('env_name', 'env_name'),
+    ('template', 'template_name')
+])
+OPTIONAL_TARGET_KEYS = ('name', 'role_arn', 'role_session_name')
+
+
+def artifact_key(file_name, build_number, source, dedup=False):
+    # Returns (key name, SHA-256 of the artifact or None)
+    if dedup:
+        digest = s3_util.file_digest(source, 'sha256')
+        print('sha256 ', digest)
+        return file_name + '-' + digest + '.zip', digest
+    return file_name + '-' + build_number + '.zip', None
+
+
+def upload_artifact(get_bucket, key_name, source, part_size=multipart.DEFAULT_PART_SIZE,
+                    workers=multipart.DEFAULT_PART_WORKERS, state_path=None, digest=None):
+    # Returns False if digest is given and the bucket already has the artifact, True once it is uploaded
+    if digest is not None:
+        with instrument.timed('s3', 'HeadObject'):
+            existing = get_bucket().get_key(key_name)
+        if existing is not None:
+            print('Artifact already in bucket as ', key_name, ', skipping upload')
+            return False
+    headers = {'x-amz-meta-sha256': digest} if digest is not None else None
+    multipart.upload_file(get_bucket, key_name, source, part_size, workers, state_path, headers=headers)
+    return True
+
+
+def find_application_version(eb_client, app_name, bucket_name, key_name):
+    kwargs = {'ApplicationName': app_name}
+    while True:
+        response = eb_util.eb_call(eb_client, 'describe_application_versions', **kwargs)
+        for v in response['ApplicationVersions']:
+            bundle = v.get('SourceBundle') or {}
+            if bundle.get('S3Bucket') == bucket_name and bundle.get('S3Key') == key_name:
+                return v['VersionLabel']
+        if not response.get('NextToken'):
+            return None
+        kwargs['NextToken'] = response['NextToken']
+
+
+def create_application_version(eb_client, app_name, version_label, bucket_name, key_name):
+    eb_util.eb_call(
+        eb_client, 'create_application_version',
+        ApplicationName=app_name,
+        VersionLabel=version_label,
+        Description=VERSION_DESCRIPTION,
+        SourceBundle={'S3Bucket': bucket_name, 'S3Key': key_name},
+        AutoCreateApplication=False
+    )
+
+
+def create_environment(eb_client, app_name, env_name, template_name, version_label):
+    return eb_util.eb_call(
+        eb_client, 'create_environment',
+        ApplicationName=app_name,
+        EnvironmentName=env_name,
+        TemplateName=template_name,
+        VersionLabel=version_label
+    )
+
+
+def copy_artifact(get_bucket, key_name, source_bucket_name, digest=None):
+    # Server side copy from another bucket. Returns False if digest is given and the bucket already has the artifact.
+    if digest is not None:
+        with instrument.timed('s3', 'HeadObject'):
+            existing = get_bucket().get_key(key_name)
+        if existing is not None:
+            print('Artifact already in bucket as ', key_name, ', skipping copy')
+            return False
+    print('Copying ', key_name, ' from ', source_bucket_name)
+    with instrument.timed('s3', 'CopyObject'):
+        get_bucket().copy_key(key_name, source_bucket_name, key_name)
+    return True
+
+
+def create_version_and_environment(eb_client, app_name, env_name, template_name, bucket_name, key_name,
+                                   build_number, dedup=False):
+    # Returns (version label, whether the version was created, the create_environment response)
+    version_label = None
+    if dedup:
+        version_label = find_application_version(eb_client, app_name, bucket_name, key_name)
+        if version_label is not None:
+            print('Reusing application version ', version_label, ' built from the same artifact')
+    version_created = version_label is None
+    if version_created:
+        version_label = app_name + '-boto-' + build_number
+        with instrument.phase('create_application_version'):
+            create_application_version(eb_client, app_name, version_label, bucket_name, key_name)
+    with instrument.phase('create_environment'):
+        environment = create_environment(eb_client, app_name, env_name, template_name, version_label)
+    return version_label, version_created, environment
+
+
+def deploy(factory, bucket_name, source, file_name, build_number, app_name, env_name, template_name,
+           part_size=multipart.DEFAULT_PART_SIZE, upload_workers=multipart.DEFAULT_PART_WORKERS, state_path=None,
+           dedup=False):
+    # factory is a clients.ClientFactory. Returns a DeployResult.
+    get_bucket = factory.bucket_getter(bucket_name)
+    eb_client = factory.client('elasticbeanstalk')
+
+    with instrument.phase('upload'):
+        key_name, digest = artifact_key(file_name, build_number, source, dedup)
+        uploaded = upload_artifact(get_bucket, key_name, source, part_size, upload_workers, state_path, digest)
+
+    version_label, version_created, environment = create_version_and_environment(
+        eb_client, app_name, env_name, template_name, bucket_name, key_name, build_number, dedup)
+    return DeployResult(key_name, version_label, uploaded, version_created, environment)
+
+
+def load_targets(path, defaults=None):
+    # Reads a JSON list of targets. Fields missing from an entry are taken from defaults, a dict with the same keys.
+    # Raises ValueError if a target is incomplete or two targets have the same name.
+    with open(path) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError('Targets file ' + path + ' must hold a JSON list')
+    targets = []
+    names = set()
+    for i, entry in enumerate(entries):
+        values = dict((k, v) for k, v in (defaults or {}).items() if v)
+        values.update(entry)
+        unknown = set(values) - set(TARGET_KEYS)
+        if unknown:
+            raise ValueError('Target ' + str(i) + ' has unknown fields: ' + ', '.join(sorted(unknown)))
+        missing = [k for k in TARGET_KEYS if k not in OPTIONAL_TARGET_KEYS and not values.get(k)]
+        if missing:
+            raise ValueError('Target ' + str(i) + ' is missing: ' + ', '.join(missing))
+        if not values.get('name'):
+            values['name'] = values['region'] + '/' + values['app_name'] + '/' + values['env_name']
+        if values['name'] in names:
+            raise ValueError('Two targets are named ' + values['name'])
+        names.add(values['name'])
+        targets.append(Target(**dict((TARGET_KEYS[k], values.get(k)) for k in TARGET_KEYS)))
+    return targets
+
+
+def _target_factory(target):
+    return clients.factory(target.role_arn, target.session_name, target.region)
+
+
+def _stage_region(factory_for, buckets, key_name, source, digest, part_size, upload_workers, state_path):
+    # buckets maps each bucket of one region to the first target that uses it. Returns {bucket name: (staged, error)}.
+    staged = {}
+    source_bucket = None
+    for bucket_name, target in buckets.items():
+        get_bucket = factory_for(target).bucket_getter(bucket_name)
+        if source_bucket is not None:
+            try:
+                copied = copy_artifact(get_bucket, key_name, source_bucket, digest)
+                staged[bucket_name] = ('copied' if copied else 'existing', None)
+                continue
+            except Exception as e:
+                print('Could not copy to ', bucket_name, ', uploading instead: ', e)
+        try:
+            bucket_state = state_path + '.' + bucket_name if state_path else None
+            uploaded = upload_artifact(get_bucket, key_name, source, part_size, upload_workers, bucket_state, digest)
+            staged[bucket_name] = ('uploaded' if uploaded else 'existing', None)
+            source_bucket = source_bucket or bucket_name
+        except Exception as e:
+            print('Upload to ', bucket_name, ' failed: ', e)
+            staged[bucket_name] = (None, str(e))
+    return staged
+
+
+def _deploy_target(factory, target, staging, key_name, build_number, dedup):
+    staged, error = staging.result()[target.bucket_name]
+    if error is not None:
+        return TargetResult(target, key_name, None, None, False, None, error)
+    try:
+        with instrument.phase('target:' + target.name):
+            version_label, version_created, environment = create_version_and_environment(
+                factory.client('elasticbeanstalk'), target.app_name, target.env_name, target.template_name,
+                target.bucket_name, key_name, build_number, dedup)
+    except Exception as e:
+        print('Target ', target.name, ' failed: ', e)
+        return TargetResult(target, key_name, staged, None, False, None, str(e))
+    return TargetResult(target, key_name, staged, version_label, version_created, environment, None)
+
+
+def deploy_targets(targets, source, file_name, build_number, parallelism=DEFAULT_PARALLELISM,
+                   part_size=multipart.DEFAULT_PART_SIZE, upload_workers=multipart.DEFAULT_PART_WORKERS,
+                   state_path=None, dedup=False, factory_for=_target_factory):
+    # Deploys to every Target and returns their TargetResults in the same order. factory_for returns the
+    # clients.ClientFactory for a target.
+    key_name, digest = artifact_key(file_name, build_number, source, dedup)
+    regions = collections.OrderedDict()
+    for target in targets:
+        regions.setdefault(target.region, collections.OrderedDict()).setdefault(target.bucket_name, target)
+    print('Deploying ', key_name, ' to ', len(targets), ' targets in ', len(regions), ' regions')
+
+    with ThreadPoolExecutor(max_workers=max(1, len(regions))) as stagers, \
+            ThreadPoolExecutor(max_workers=max(1, parallelism)) as deployers:
+        staging = dict((region, stagers.submit(_stage_region, factory_for, buckets, key_name, source, digest,
+                                               part_size, upload_workers, state_path))
+                       for region, buckets in regions.items())
+        futures = [deployers.submit(_deploy_target, factory_for(t), t, staging[t.region], key_name, build_number,
+                                    dedup)
+                   for t in targets]
+        results = [f.result() for f in futures]
+    instrument.count('targets_failed', sum(1 for r in results if r.error is not None))
+    return results
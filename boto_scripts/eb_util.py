@@ -0,0 +1,252 @@
+#
+# Helpers for waiting on Elastic Beanstalk environments.
+#
+# wait_for_environments polls describe_environments with jittered exponential backoff until every environment is
+# green and ready, reaches a state it will not recover from (terminated, or ready but red), or the deadline passes.
+# Environments are grouped by application so each round costs one describe_environments call per application, not
+# one per environment. While it waits it follows describe_events for each application from a since-timestamp cursor,
+# so the reason an environment is stuck shows up in the job output without extra full describes.
+#
+# environment_index pages through every live environment of an application and indexes them by name and CNAME. The
+# index is cached in process for a short time so the swap, health and deploy steps of a release can share it instead
+# of each describing the application again. The cache is kept per client, and so per account and region, so clients
+# for different roles never share an index. swap_cnames uses it to find the live environment and swap its CNAME.
+#
+# Beanstalk calls go through eb_call, which shares one limiter (see throttle.py) per region between every thread and
+# every step of a release, since Beanstalk's API rate limits are per account and region. Calls that only read are
+# retried after throttles, 500s and dropped connections; calls that change something only after throttles.
+#
+
+import random
+import time
+import weakref
+
+from boto_scripts import throttle
+
+DEFAULT_TIMEOUT = 600
+DEFAULT_INITIAL_DELAY = 5
+DEFAULT_MAX_DELAY = 60
+INITIAL_EVENT_COUNT = 10
+DESCRIBE_PAGE_SIZE = 100
+INDEX_CACHE_TTL = 30
+
+TERMINAL_STATUSES = ('terminating', 'terminated')
+READ_ONLY_PREFIXES = ('describe_', 'list_', 'validate_', 'check_')
+
+READY = 'ready'
+FAILED = 'failed'
+WAITING = 'waiting'
+MISSING = 'missing'
+
+# client -> {application name: EnvironmentIndex}. A client is bound to one set of credentials and one region.
+_index_cache = weakref.WeakKeyDictionary()
+
+
+def env_state(env, fail_on_red=True):
+    health = env.get('Health', '').lower()
+    status = env.get('Status', '').lower()
+    if status in TERMINAL_STATUSES:
+        return FAILED
+    if status == 'ready':
+        if health == 'green':
+            return READY
+        if health == 'red' and fail_on_red:
+            return FAILED
+    return WAITING
+
+
+def backoff_delay(attempt, initial_delay=DEFAULT_INITIAL_DELAY, max_delay=DEFAULT_MAX_DELAY):
+    delay = min(max_delay, initial_delay * (2 ** attempt))
+    return random.uniform(delay / 2.0, delay)
+
+
+def eb_call(eb_client, method, **kwargs):
+    # Calls eb_client.<method>(**kwargs) through the region's limiter, e.g. eb_call(eb_client, 'describe_events', ...)
+    # Calls that change something are only retried when throttled: after a 500 or a lost response the change may
+    # have been made, and making it again would undo a swap or fail on a name that now exists.
+    operation = ''.join(word.capitalize() for word in method.split('_'))
+    retry_on = throttle.RETRY_ALL if method.startswith(READ_ONLY_PREFIXES) else (throttle.THROTTLED,)
+    return throttle.limiter('elasticbeanstalk', eb_client.meta.region_name).call(
+        operation, lambda: getattr(eb_client, method)(**kwargs), retry_on=retry_on)
+
+
+class EventFollower(object):
+    # Prints new events for an application, or one of its environments, oldest first. describe_events treats
+    # StartTime as inclusive, so events at the cursor timestamp that were already printed are remembered and skipped.
+
+    def __init__(self, eb_client, app_name, env_name=None):
+        self.eb_client = eb_client
+        self.app_name = app_name
+        self.env_name = env_name
+        self.since = None
+        self.seen_at_since = set()
+
+    def poll(self):
+        kwargs = {'ApplicationName': self.app_name}
+        if self.env_name is not None:
+            kwargs['EnvironmentName'] = self.env_name
+        if self.since is None:
+            kwargs['MaxRecords'] = INITIAL_EVENT_COUNT
+        else:
+            kwargs['StartTime'] = self.since
+        events = []
+        while True:
+            response = eb_call(self.eb_client, 'describe_events', **kwargs)
+            events.extend(response['Events'])
+            # The first poll only shows the latest few events. After that every page is read, or the events on the
+            # pages left out would be skipped for good once the cursor moves past them.
+            if self.since is None or not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+        new_events = []
+        for e in sorted(events, key=lambda e: e['EventDate']):
+            ident = (e['EventDate'], e['Message'])
+            if self.since is not None and e['EventDate'] == self.since and ident in self.seen_at_since:
+                continue
+            new_events.append(e)
+            if e['EventDate'] != self.since:
+                self.since = e['EventDate']
+                self.seen_at_since = set()
+            self.seen_at_since.add(ident)
+
+        for e in new_events:
+            print('  {} {} {}: {}'.format(e['EventDate'], e.get('Severity', ''),
+                                          e.get('EnvironmentName', self.app_name), e['Message']))
+        return new_events
+
+
+def describe_environments(eb_client, app_name, env_names):
+    environments = eb_call(
+        eb_client, 'describe_environments',
+        ApplicationName=app_name,
+        EnvironmentNames=list(env_names),
+        IncludeDeleted=False
+    )['Environments']
+    return dict((env['EnvironmentName'], env) for env in environments)
+
+
+def wait_for_environments(eb_client, targets, timeout=DEFAULT_TIMEOUT, initial_delay=DEFAULT_INITIAL_DELAY,
+                          max_delay=DEFAULT_MAX_DELAY, follow_events=True, fail_on_red=True):
+    # targets is a list of (application name, environment name). Returns a dict of (application, environment) to
+    # (state, environment description). The state is WAITING for anything still not ready when the deadline passed
+    # and MISSING for environments that do not exist.
+    deadline = time.time() + timeout
+    pending = {}
+    for app_name, env_name in targets:
+        pending.setdefault(app_name, set()).add(env_name)
+    followers = dict((app_name, EventFollower(eb_client, app_name)) for app_name in pending) if follow_events else {}
+    results = {}
+    attempt = 0
+    while True:
+        for app_name in list(pending):
+            found = describe_environments(eb_client, app_name, pending[app_name])
+            if app_name in followers:
+                followers[app_name].poll()
+            for env_name in list(pending[app_name]):
+                env = found.get(env_name)
+                if env is None:
+                    state, env = MISSING, {}
+                else:
+                    state = env_state(env, fail_on_red)
+                    print('{}: status {}, health {} ({})'.format(env_name, env.get('Status'), env.get('Health'),
+                                                                 state))
+                results[(app_name, env_name)] = (state, env)
+                if state != WAITING:
+                    pending[app_name].discard(env_name)
+            if not pending[app_name]:
+                del pending[app_name]
+
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            return results
+        time.sleep(min(remaining, backoff_delay(attempt, initial_delay, max_delay)))
+        attempt += 1
+
+
+def wait_for_environment(eb_client, app_name, env_name, timeout=DEFAULT_TIMEOUT, initial_delay=DEFAULT_INITIAL_DELAY,
+                         max_delay=DEFAULT_MAX_DELAY, follow_events=True, fail_on_red=True):
+    # Returns (state, environment description) for a single environment
+    results = wait_for_environments(eb_client, [(app_name, env_name)], timeout, initial_delay, max_delay,
+                                    follow_events, fail_on_red)
+    return results[(app_name, env_name)]
+
+
+def print_readiness_table(results):
+    rows = [(app, env, state, desc.get('Status', '-'), desc.get('Health', '-'))
+            for (app, env), (state, desc) in sorted(results.items())]
+    widths = [max([len(h)] + [len(str(r[i])) for r in rows])
+              for i, h in enumerate(('APPLICATION', 'ENVIRONMENT', 'STATE', 'STATUS', 'HEALTH'))]
+    line = '  '.join('{:<' + str(w) + '}' for w in widths)
+    print(line.format('APPLICATION', 'ENVIRONMENT', 'STATE', 'STATUS', 'HEALTH'))
+    for r in rows:
+        print(line.format(*r))
+
+
+def list_environments(eb_client, app_name):
+    # Terminated environments are filtered out by the service, anything still terminating is dropped here
+    kwargs = {'ApplicationName': app_name, 'IncludeDeleted': False, 'MaxRecords': DESCRIBE_PAGE_SIZE}
+    while True:
+        response = eb_call(eb_client, 'describe_environments', **kwargs)
+        for env in response['Environments']:
+            if env.get('Status', '').lower() not in TERMINAL_STATUSES:
+                yield env
+        if not response.get('NextToken'):
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+
+class EnvironmentIndex(object):
+    def __init__(self, environments):
+        self.environments = list(environments)
+        self.by_name = dict((env['EnvironmentName'], env) for env in self.environments)
+        self.by_cname = dict((env['CNAME'].lower(), env) for env in self.environments if env.get('CNAME'))
+        self.created = time.time()
+
+    def find_cname(self, cname_search):
+        # An exact CNAME match wins. Otherwise fall back to a substring match, as long as it is not ambiguous.
+        cname_search = cname_search.lower().strip()
+        if cname_search in self.by_cname:
+            return self.by_cname[cname_search]
+        matches = [env for cname, env in sorted(self.by_cname.items()) if cname_search in cname]
+        if len(matches) > 1:
+            raise ValueError('CNAME search ' + cname_search + ' matches more than one environment: ' +
+                             ', '.join(env['EnvironmentName'] for env in matches))
+        return matches[0] if matches else None
+
+
+def environment_index(eb_client, app_name, max_age=INDEX_CACHE_TTL):
+    indexes = _index_cache.setdefault(eb_client, {})
+    index = indexes.get(app_name)
+    if index is None or time.time() - index.created > max_age:
+        index = EnvironmentIndex(list_environments(eb_client, app_name))
+        indexes[app_name] = index
+    return index
+
+
+def invalidate_environment_index(eb_client, app_name):
+    _index_cache.get(eb_client, {}).pop(app_name, None)
+
+
+def swap_cnames(eb_client, app_name, cname_search, swap_dest):
+    # Swaps the CNAME of the live environment, found with EnvironmentIndex.find_cname, with swap_dest. Returns the
+    # name of the environment that was live, which is swap_dest itself if it already had the CNAME. Raises ValueError
+    # if either environment cannot be found.
+    index = environment_index(eb_client, app_name)
+    live = index.find_cname(cname_search)
+    if live is None:
+        raise ValueError('No LIVE CName found for: ' + cname_search)
+    if swap_dest not in index.by_name:
+        raise ValueError('Swap destination ' + swap_dest + ' not found in app: ' + app_name)
+    live_name = live['EnvironmentName']
+    if live_name.lower().strip() == swap_dest.lower().strip():
+        print('CName already set to', swap_dest, '- Doing nothing.')
+        return live_name
+    print('Changing LIVE env from from', live_name, 'to', swap_dest)
+    eb_call(
+        eb_client, 'swap_environment_cnames',
+        SourceEnvironmentName=live_name,
+        DestinationEnvironmentName=swap_dest
+    )
+    invalidate_environment_index(eb_client, app_name)
+    return live_name
@@ -0,0 +1,284 @@
+#
+# Timing instrumentation shared by all of the scripts.
+#
+# Every AWS call is recorded by service and operation: how many were made, how many failed, were throttled or
+# retried, and their p50/p99/max latency. bytes_sent counts request bodies and bytes_received response bodies. boto3
+# clients are timed automatically, both ways, once they are passed to instrument_client. Calls made with the older
+# boto library are timed by wrapping them in timed(), which is given the bytes sent and, where the caller knows it,
+# the bytes received.
+# Scripts also wrap their main steps (assume role, upload, create environment, wait for health...) in phase().
+# Counters (count) and gauges (gauge) record anything else worth seeing in the report, such as the decisions made by
+# the concurrency limiters in throttle.py.
+#
+# start() registers an exit handler that writes the results wherever the environment asks for them:
+#
+#    RUN_REPORT    - Path of a JSON report to write. S3Prune.py and sqs_util.py also take it as --report.
+#    STATSD_HOST   - host:port of a StatsD server to send timings and counts to. STATSD_PREFIX defaults to 'boto_scripts'.
+#    PROM_TEXTFILE - Path of a Prometheus textfile collector file to write.
+#
+# Nothing is written if none of them are set.
+#
+
+import atexit
+import contextlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+MAX_SAMPLES = 10000
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                  'RequestThrottledException', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                  'RequestLimitExceeded', 'SlowDown', 'PriorRequestNotComplete')
+
+
+class _CallStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_seconds = 0.0
+        self.samples = []
+
+    def add(self, seconds, bytes_sent, bytes_received, error_code, retries):
+        self.count += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.retries += retries
+        self.total_seconds += seconds
+        if error_code:
+            self.errors += 1
+            if error_code in THROTTLE_CODES:
+                self.throttles += 1
+        # Keep a uniform sample of latencies so long runs do not grow without bound
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            i = random.randint(0, self.count - 1)
+            if i < MAX_SAMPLES:
+                self.samples[i] = seconds
+
+    def summary(self):
+        samples = sorted(self.samples)
+
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 4) if samples else 0
+
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'throttles': self.throttles,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'total_seconds': round(self.total_seconds, 4),
+            'p50': pct(0.5),
+            'p99': pct(0.99),
+            'max': round(samples[-1], 4) if samples else 0
+        }
+
+
+_lock = threading.Lock()
+_calls = {}
+_counters = {}
+_gauges = {}
+_phases = []
+_run = {'script': None, 'started': None, 'report': None}
+
+
+def record_call(service, operation, seconds, bytes_sent=0, error_code=None, retries=0, bytes_received=0):
+    with _lock:
+        stats = _calls.get((service, operation))
+        if stats is None:
+            stats = _calls[(service, operation)] = _CallStats()
+        stats.add(seconds, bytes_sent, bytes_received, error_code, retries)
+
+
+def record_retry(service, operation):
+    # For retry loops in this repo's own code, as opposed to the retries botocore makes inside a single call. The
+    # failed attempt itself, and whether it was throttled, is already recorded by timed().
+    with _lock:
+        stats = _calls.get((service, operation))
+        if stats is None:
+            stats = _calls[(service, operation)] = _CallStats()
+        stats.retries += 1
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+@contextlib.contextmanager
+def timed(service, operation, bytes_sent=0, bytes_received=0):
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        record_call(service, operation, time.time() - start, bytes_sent,
+                    getattr(e, 'error_code', None) or type(e).__name__)
+        raise
+    record_call(service, operation, time.time() - start, bytes_sent, bytes_received=bytes_received)
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        with _lock:
+            _phases.append({'name': name, 'started': round(start, 3), 'seconds': round(time.time() - start, 4)})
+
+
+def _request_bytes(params):
+    # params is botocore's request dict. Query protocol services (Beanstalk, and SQS before its JSON protocol) leave
+    # the body as a dict of form fields, which is form encoded later.
+    length = params.get('headers', {}).get('Content-Length')
+    if length is not None:
+        return int(length)
+    body = params.get('body')
+    if isinstance(body, dict):
+        body = urllib.parse.urlencode(body)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return len(body) if isinstance(body, (bytes, bytearray)) else 0
+
+
+def _before_call(model, params, context, **kwargs):
+    # after-call-error is not given the operation model, so everything the handlers after the call need is kept here
+    context['instrument_call'] = (model.service_model.endpoint_prefix, model.name)
+    context['instrument_start'] = time.time()
+    context['instrument_sent'] = _request_bytes(params)
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    start = context.get('instrument_start')
+    if start is None:
+        return
+    metadata = parsed.get('ResponseMetadata', {})
+    error_code = parsed.get('Error', {}).get('Code')
+    received = int(http_response.headers.get('content-length', 0) or 0) if http_response is not None else 0
+    record_call(model.service_model.endpoint_prefix, model.name, time.time() - start,
+                context.get('instrument_sent', 0), error_code, metadata.get('RetryAttempts', 0), received)
+
+
+def _after_call_error(exception, context, **kwargs):
+    # Fired for errors with no HTTP response (connection refused or dropped, timeouts), which botocore then re-raises
+    start = context.get('instrument_start')
+    if start is not None:
+        service, operation = context['instrument_call']
+        record_call(service, operation, time.time() - start, context.get('instrument_sent', 0),
+                    type(exception).__name__)
+
+
+def instrument_client(client):
+    events = client.meta.events
+    events.register('before-call', _before_call, unique_id='boto_scripts.instrument.before')
+    events.register('after-call', _after_call, unique_id='boto_scripts.instrument.after')
+    events.register('after-call-error', _after_call_error, unique_id='boto_scripts.instrument.error')
+    return client
+
+
+def report():
+    with _lock:
+        calls = dict(('{}.{}'.format(s, o), stats.summary()) for (s, o), stats in sorted(_calls.items()))
+        return {
+            'script': _run['script'],
+            'started': _run['started'],
+            'seconds': round(time.time() - _run['started'], 4) if _run['started'] else None,
+            'phases': list(_phases),
+            'calls': calls,
+            'counters': dict(_counters),
+            'gauges': dict(_gauges)
+        }
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _send_statsd(address, prefix, data):
+    host, port = address.rsplit(':', 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    lines = ['{}.{}.run:{}|ms'.format(prefix, data['script'], int(data['seconds'] * 1000))]
+    for p in data['phases']:
+        lines.append('{}.{}.phase.{}:{}|ms'.format(prefix, data['script'], p['name'], int(p['seconds'] * 1000)))
+    for name, c in data['calls'].items():
+        for field in ('count', 'errors', 'throttles', 'retries', 'bytes_sent', 'bytes_received'):
+            lines.append('{}.{}.{}.{}:{}|c'.format(prefix, data['script'], name, field, c[field]))
+        for field in ('p50', 'p99'):
+            lines.append('{}.{}.{}.{}:{}|ms'.format(prefix, data['script'], name, field, int(c[field] * 1000)))
+    for name, value in data['counters'].items():
+        lines.append('{}.{}.{}:{}|c'.format(prefix, data['script'], name, value))
+    for name, value in data['gauges'].items():
+        lines.append('{}.{}.{}:{}|g'.format(prefix, data['script'], name, value))
+    try:
+        for line in lines:
+            sock.sendto(line.encode('utf-8'), (host, int(port)))
+    finally:
+        sock.close()
+
+
+def _prometheus_text(data):
+    script = data['script']
+    lines = ['# TYPE boto_scripts_run_seconds gauge',
+             'boto_scripts_run_seconds{{script="{}"}} {}'.format(script, data['seconds']),
+             '# TYPE boto_scripts_phase_seconds gauge']
+    for p in data['phases']:
+        lines.append('boto_scripts_phase_seconds{{script="{}",phase="{}"}} {}'.format(script, p['name'], p['seconds']))
+    for metric in ('count', 'errors', 'throttles', 'retries', 'bytes_sent', 'bytes_received', 'p50', 'p99'):
+        lines.append('# TYPE boto_scripts_call_{} gauge'.format(metric))
+        for name, c in data['calls'].items():
+            service, operation = name.split('.', 1)
+            lines.append('boto_scripts_call_{}{{script="{}",service="{}",operation="{}"}} {}'.format(
+                metric, script, service, operation, c[metric]))
+    for kind in ('counters', 'gauges'):
+        if data[kind]:
+            lines.append('# TYPE boto_scripts_{} gauge'.format(kind[:-1]))
+        for name, value in sorted(data[kind].items()):
+            lines.append('boto_scripts_{}{{script="{}",name="{}"}} {}'.format(kind[:-1], script, name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def finish():
+    outputs = (_run['report'] or os.environ.get('RUN_REPORT'), os.environ.get('STATSD_HOST'),
+               os.environ.get('PROM_TEXTFILE'))
+    if not any(outputs) or _run['started'] is None:
+        return
+    data = report()
+    try:
+        if outputs[0]:
+            _write_json(outputs[0], data)
+            print('Wrote run report to', outputs[0])
+        if outputs[1]:
+            _send_statsd(outputs[1], os.environ.get('STATSD_PREFIX', 'boto_scripts'), data)
+        if outputs[2]:
+            tmp = outputs[2] + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(_prometheus_text(data))
+            os.replace(tmp, outputs[2])
+    except Exception as e:
+        # A broken metrics destination should never fail a deploy
+        print('Could not write run report:', e)
+
+
+def start(script, report=None):
+    _run['script'] = script
+    _run['report'] = report
+    _run['started'] = round(time.time(), 3)
+    atexit.register(finish)
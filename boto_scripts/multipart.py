@@ -0,0 +1,163 @@
+#
+# Multipart upload for large artifacts such as the Beanstalk application bundle.
+#
+# The file is split into fixed-size parts that are uploaded in parallel, each on its own connection. A worker never
+# holds more than one READ_CHUNK_SIZE buffer of its part in memory: the part's MD5 is computed by streaming it, then
+# boto streams it again from the same file offset while sending it. S3 checks every part against its Content-MD5.
+#
+# Progress is written to a small JSON state file after each part completes. If the upload is interrupted, running it
+# again with the same state file resumes the same multipart upload and only sends the parts that are missing. The
+# state file is removed once the upload is complete.
+#
+# Every request goes through the bucket's limiter (see throttle.py), which retries throttled parts and holds back the
+# workers while S3 is pushing back.
+#
+
+import base64
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from boto_scripts import instrument
+from boto_scripts import s3_util
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except for the last one
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_PART_WORKERS = 4
+PART_RETRIES = 5
+
+
+def part_md5(fp, offset, length):
+    md5 = hashlib.md5()
+    fp.seek(offset)
+    remaining = length
+    while remaining > 0:
+        chunk = fp.read(min(s3_util.READ_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        md5.update(chunk)
+        remaining -= len(chunk)
+    return md5
+
+
+def _load_state(state_path, key_name, path, part_size):
+    if not state_path or not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except ValueError:
+        print('Ignoring unreadable upload state file ', state_path)
+        return None
+    st = os.stat(path)
+    if (state.get('key') != key_name or state.get('size') != st.st_size or state.get('mtime') != st.st_mtime or
+            state.get('part_size') != part_size):
+        print('Upload state file ', state_path, ' is for a different upload, starting over')
+        return None
+    return state
+
+
+def _save_state(state_path, state):
+    if not state_path:
+        return
+    tmp = state_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, state_path)
+
+
+def _multipart_upload(bucket, key_name, upload_id):
+    from boto.s3.multipart import MultiPartUpload
+    mp = MultiPartUpload(bucket)
+    mp.key_name = key_name
+    mp.id = upload_id
+    return mp
+
+
+def _resume(bucket, state):
+    # Only trust the parts S3 actually has, with the checksum we recorded for them
+    with instrument.timed('s3', 'ListMultipartUploads'):
+        uploads = list(bucket.list_multipart_uploads())
+    for mp in uploads:
+        if mp.id == state['upload_id']:
+            # Iterating the upload lists its parts
+            with instrument.timed('s3', 'ListParts'):
+                uploaded = dict((str(p.part_number), p.etag.strip('"')) for p in mp)
+            return dict((n, md5) for n, md5 in state['parts'].items() if uploaded.get(n) == md5)
+    return None
+
+
+def _upload_part(get_bucket, state, path, part_number, part_size):
+    offset = (part_number - 1) * part_size
+    length = min(part_size, state['size'] - offset)
+    with open(path, 'rb') as fp:
+        md5 = part_md5(fp, offset, length)
+
+        def put():
+            fp.seek(offset)
+            mp = _multipart_upload(get_bucket(), state['key'], state['upload_id'])
+            with instrument.timed('s3', 'UploadPart', length):
+                mp.upload_part_from_file(fp, part_number, md5=(md5.hexdigest(),
+                                         base64.b64encode(md5.digest()).decode('ascii')), size=length)
+        s3_util.bucket_limiter(get_bucket).call('UploadPart', put, PART_RETRIES)
+        return md5.hexdigest()
+
+
+def upload_file(get_bucket, key_name, path, part_size=DEFAULT_PART_SIZE, max_workers=DEFAULT_PART_WORKERS,
+                state_path=None, headers=None):
+    part_size = max(part_size, MIN_PART_SIZE)
+    st = os.stat(path)
+    bucket = get_bucket()
+    limiter = s3_util.bucket_limiter(get_bucket)
+    if st.st_size <= part_size:
+        print('Uploading ', path, ' to ', key_name, ' in a single request')
+
+        def put():
+            with instrument.timed('s3', 'PutObject', st.st_size):
+                bucket.new_key(key_name).set_contents_from_filename(path, headers=headers)
+        limiter.call('PutObject', put, PART_RETRIES)
+        return
+
+    state = _load_state(state_path, key_name, path, part_size)
+    if state is not None:
+        parts = _resume(bucket, state)
+        if parts is None:
+            print('Multipart upload ', state['upload_id'], ' no longer exists, starting over')
+            state = None
+        else:
+            print('Resuming multipart upload with ', len(parts), ' parts already uploaded')
+            state['parts'] = parts
+    if state is None:
+        def initiate():
+            with instrument.timed('s3', 'CreateMultipartUpload'):
+                return bucket.initiate_multipart_upload(key_name, headers=headers)
+        mp = limiter.call('CreateMultipartUpload', initiate)
+        state = {'key': key_name, 'upload_id': mp.id, 'size': st.st_size, 'mtime': st.st_mtime,
+                 'part_size': part_size, 'parts': {}}
+        _save_state(state_path, state)
+
+    part_count = (st.st_size + part_size - 1) // part_size
+    todo = [n for n in range(1, part_count + 1) if str(n) not in state['parts']]
+    print('Uploading ', len(todo), ' of ', part_count, ' parts of ', path, ' to ', key_name)
+    lock = threading.Lock()
+
+    def upload(part_number):
+        md5 = _upload_part(get_bucket, state, path, part_number, part_size)
+        with lock:
+            state['parts'][str(part_number)] = md5
+            _save_state(state_path, state)
+        print('Uploaded part ', part_number, ' of ', part_count)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # list() re-raises the first part that failed after its retries. The state file keeps the finished parts.
+        list(pool.map(upload, todo))
+
+    def complete():
+        with instrument.timed('s3', 'CompleteMultipartUpload'):
+            _multipart_upload(bucket, key_name, state['upload_id']).complete_upload()
+    limiter.call('CompleteMultipartUpload', complete)
+    if state_path and os.path.exists(state_path):
+        os.remove(state_path)
+    print('Completed multipart upload of ', key_name)
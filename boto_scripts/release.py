@@ -0,0 +1,202 @@
+#
+# A whole blue/green release in one process: upload the artifact, launch a new environment on it, wait for it to be
+# healthy, swap the live CNAME over to it and check that the swap took. beanstalk/BeanstalkRelease.py is a thin wrapper
+# around release(); the steps are the same ones DeployBeanstalkEnv.py, BeanstalkHealthBoto.py and
+# BeanstalkEnvSwapBoto.py run one at a time.
+#
+# One ClientFactory, and so one assumed role, S3 connection per thread and Beanstalk client, is used for every step.
+# While the artifact uploads, the environment template is checked with validate_configuration_settings and the live
+# environment is looked up, so a bad template, a CNAME search that finds nothing or an environment name that is taken
+# fails the release before anything is created. Health is printed, with new environment events, while the environment
+# launches (see eb_util.wait_for_environments).
+#
+# After the swap the new environment is polled until it holds the live CNAME and both environments are Ready again.
+# If that does not happen within verify_timeout, the new environment turns red, or the swap or the checks fail, the
+# CNAMEs are swapped back and ReleaseError is raised. An interrupt during these steps swaps back too before it ends the
+# release. The new environment is left running in every case so it can be looked at.
+#
+#    from boto_scripts import clients, release
+#    factory = clients.factory(role_arn, region='us-east-1')
+#    result = release.release(factory, 'my-bucket', 'build/app.zip', 'my-app', '42', 'My_EB_App', 'my-env-42',
+#                             'my-template', 'my-app.elasticbeanstalk.com')
+#
+
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto_scripts import deploy
+from boto_scripts import eb_util
+from boto_scripts import instrument
+from boto_scripts import multipart
+
+DEFAULT_VERIFY_TIMEOUT = 300
+
+ReleaseResult = collections.namedtuple('ReleaseResult', ['key_name', 'version_label', 'uploaded', 'version_created',
+                                                         'environment', 'previous_live', 'live_cname'])
+
+
+class ReleaseError(Exception):
+    pass
+
+
+def validate_template(eb_client, app_name, template_name):
+    # Raises ReleaseError if Beanstalk reports errors in the template. Warnings are only printed.
+    messages = eb_util.eb_call(eb_client, 'validate_configuration_settings', ApplicationName=app_name,
+                               TemplateName=template_name, OptionSettings=[])['Messages']
+    for m in messages:
+        print('Template', m.get('Severity'), m.get('Namespace', ''), m.get('OptionName', ''), m.get('Message'))
+    errors = [m.get('Message', '') for m in messages if m.get('Severity') == 'error']
+    if errors:
+        raise ReleaseError('Template ' + template_name + ' is not valid: ' + '; '.join(errors))
+
+
+def find_live(eb_client, app_name, cname_search, max_age=eb_util.INDEX_CACHE_TTL):
+    # Returns the live environment's description. Raises ReleaseError if there is not exactly one.
+    try:
+        live = eb_util.environment_index(eb_client, app_name, max_age).find_cname(cname_search)
+    except ValueError as e:
+        raise ReleaseError(str(e))
+    if live is None:
+        raise ReleaseError('No LIVE CName found for: ' + cname_search)
+    return live
+
+
+def preflight(eb_client, app_name, env_name, template_name, cname_search):
+    # Everything that can be checked before the release creates anything. Returns the live environment's description.
+    validate_template(eb_client, app_name, template_name)
+    live = find_live(eb_client, app_name, cname_search, max_age=0)
+    if env_name in eb_util.environment_index(eb_client, app_name).by_name:
+        raise ReleaseError('Environment ' + env_name + ' already exists in app: ' + app_name)
+    print('Live environment is', live['EnvironmentName'], 'at', live['CNAME'])
+    return live
+
+
+def _upload(get_bucket, source, file_name, build_number, part_size, upload_workers, state_path, dedup):
+    key_name, digest = deploy.artifact_key(file_name, build_number, source, dedup)
+    uploaded = deploy.upload_artifact(get_bucket, key_name, source, part_size, upload_workers, state_path, digest)
+    return key_name, uploaded
+
+
+def wait_for_cname(eb_client, app_name, env_name, other_name, cname, timeout,
+                   initial_delay=eb_util.DEFAULT_INITIAL_DELAY, max_delay=eb_util.DEFAULT_MAX_DELAY):
+    # Polls until env_name holds cname and both environments are Ready. Returns (state, reason): eb_util.READY, FAILED
+    # or MISSING if env_name is gone or unhealthy, or WAITING if timeout passed first.
+    deadline = time.time() + timeout
+    attempt = 0
+    while True:
+        found = eb_util.describe_environments(eb_client, app_name, [env_name, other_name])
+        env = found.get(env_name)
+        if env is None:
+            return eb_util.MISSING, env_name + ' not found in app: ' + app_name
+        state = eb_util.env_state(env)
+        print('{}: {}, status {}, health {}'.format(env_name, env.get('CNAME'), env.get('Status'), env.get('Health')))
+        if state == eb_util.FAILED:
+            return state, env_name + ' is ' + env.get('Status', '') + ' with health ' + env.get('Health', '')
+        other_ready = found.get(other_name, {}).get('Status', '').lower() == 'ready'
+        if state == eb_util.READY and other_ready and (env.get('CNAME') or '').lower() == cname:
+            return state, None
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return eb_util.WAITING, env_name + ' did not take over ' + cname + ' in time'
+        time.sleep(min(remaining, eb_util.backoff_delay(attempt, initial_delay, max_delay)))
+        attempt += 1
+
+
+def wait_for_ready(eb_client, app_name, env_names, timeout, initial_delay=eb_util.DEFAULT_INITIAL_DELAY,
+                   max_delay=eb_util.DEFAULT_MAX_DELAY):
+    # Polls until every environment has Status Ready, whatever its health. Returns None, or why they are not.
+    deadline = time.time() + timeout
+    attempt = 0
+    while True:
+        found = eb_util.describe_environments(eb_client, app_name, env_names)
+        missing = [name for name in env_names if name not in found]
+        if missing:
+            return ', '.join(missing) + ' not found in app: ' + app_name
+        busy = [name + ' is ' + found[name].get('Status', '') for name in env_names
+                if found[name].get('Status', '').lower() != 'ready']
+        if not busy:
+            return None
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return '; '.join(busy)
+        time.sleep(min(remaining, eb_util.backoff_delay(attempt, initial_delay, max_delay)))
+        attempt += 1
+
+
+def swap_back(eb_client, app_name, cname_search, env_name, previous_live, live_cname, timeout,
+              initial_delay=eb_util.DEFAULT_INITIAL_DELAY, max_delay=eb_util.DEFAULT_MAX_DELAY):
+    # Gives the live CNAME back to previous_live. Returns None once it has it again, or why that could not be checked.
+    # Beanstalk only swaps CNAMEs between Ready environments, and after a swap that timed out they are usually still
+    # Updating, so wait for that first.
+    print('Swapping', live_cname, 'back to', previous_live)
+    eb_util.invalidate_environment_index(eb_client, app_name)
+    try:
+        with instrument.phase('swap_back'):
+            busy = wait_for_ready(eb_client, app_name, [env_name, previous_live], timeout, initial_delay, max_delay)
+            if busy is not None:
+                return busy
+            eb_util.swap_cnames(eb_client, app_name, cname_search, previous_live)
+            state, reason = wait_for_cname(eb_client, app_name, previous_live, env_name, live_cname, timeout,
+                                           initial_delay, max_delay)
+    except Exception as e:
+        return str(e)
+    return reason
+
+
+def release(factory, bucket_name, source, file_name, build_number, app_name, env_name, template_name, cname_search,
+            timeout=eb_util.DEFAULT_TIMEOUT, verify_timeout=DEFAULT_VERIFY_TIMEOUT,
+            part_size=multipart.DEFAULT_PART_SIZE, upload_workers=multipart.DEFAULT_PART_WORKERS, state_path=None,
+            dedup=False, initial_delay=eb_util.DEFAULT_INITIAL_DELAY, max_delay=eb_util.DEFAULT_MAX_DELAY):
+    # factory is a clients.ClientFactory. Returns a ReleaseResult once env_name is live. Raises ReleaseError if the
+    # release stopped, saying whether the CNAMEs were swapped back.
+    get_bucket = factory.bucket_getter(bucket_name)
+    eb_client = factory.client('elasticbeanstalk')
+
+    with instrument.phase('upload_and_validate'):
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            upload = pool.submit(_upload, get_bucket, source, file_name, build_number, part_size, upload_workers,
+                                 state_path, dedup)
+            # A failed check still waits for the upload, which a later run can then reuse or resume
+            preflight(eb_client, app_name, env_name, template_name, cname_search)
+            key_name, uploaded = upload.result()
+
+    version_label, version_created, environment = deploy.create_version_and_environment(
+        eb_client, app_name, env_name, template_name, bucket_name, key_name, build_number, dedup)
+    eb_util.invalidate_environment_index(eb_client, app_name)
+
+    with instrument.phase('wait_for_health'):
+        state, env = eb_util.wait_for_environment(eb_client, app_name, env_name, timeout, initial_delay, max_delay)
+    if state != eb_util.READY:
+        raise ReleaseError('Environment ' + env_name + ' is not ready (' + state + ', status ' +
+                           str(env.get('Status')) + ', health ' + str(env.get('Health')) + '), the live CNAME was not '
+                           'swapped')
+
+    # The live environment can have changed during a long launch, so look it up again
+    live = find_live(eb_client, app_name, cname_search, max_age=0)
+    live_cname = live['CNAME'].lower()
+    previous_live = live['EnvironmentName']
+    # From here on the CNAMEs may have been swapped, so any way out other than success swaps them back
+    try:
+        with instrument.phase('swap'):
+            previous_live = eb_util.swap_cnames(eb_client, app_name, cname_search, env_name)
+        with instrument.phase('verify_swap'):
+            state, reason = wait_for_cname(eb_client, app_name, env_name, previous_live, live_cname, verify_timeout,
+                                           initial_delay, max_delay)
+    except Exception as e:
+        state, reason = eb_util.FAILED, 'Swapping ' + live_cname + ' to ' + env_name + ' failed: ' + str(e)
+    except BaseException:
+        failure = swap_back(eb_client, app_name, cname_search, env_name, previous_live, live_cname, verify_timeout,
+                            initial_delay, max_delay)
+        if failure is not None:
+            print('Swapping back to', previous_live, 'failed, fix the CNAMEs by hand:', failure)
+        raise
+    if state != eb_util.READY:
+        failure = swap_back(eb_client, app_name, cname_search, env_name, previous_live, live_cname, verify_timeout,
+                            initial_delay, max_delay)
+        if failure is not None:
+            raise ReleaseError(reason + '. Swapping back to ' + previous_live +
+                               ' failed too, fix the CNAMEs by hand: ' + failure)
+        raise ReleaseError(reason + '. Swapped back to ' + previous_live)
+    print(env_name, 'is live at', live_cname, 'replacing', previous_live)
+    return ReleaseResult(key_name, version_label, uploaded, version_created, environment, previous_live, live_cname)
@@ -0,0 +1,116 @@
+#
+# Compression and header rules for files S3Sync uploads.
+#
+# Rules come from a JSON file such as:
+#
+#    {"rules": [
+#        {"pattern": "*", "cache_control": "public, max-age=300"},
+#        {"pattern": "bundles/*", "cache_control": "public, max-age=31536000, immutable"},
+#        {"pattern": "*.js", "content_type": "application/javascript", "compress": "gzip"},
+#        {"pattern": "*.css", "compress": "gzip"}
+#    ]}
+#
+# Every rule whose pattern (fnmatch style, against the S3 key) matches a file applies to it, and later rules win. A
+# file without a content_type gets the one guessed from its name. compress can be 'gzip' or 'br'; brotli needs the
+# brotli package. Each file is stored under a single encoding with a matching Content-Encoding header, so only use
+# 'br' if every client of the site accepts it.
+#
+# Compressed output is written to a cache directory keyed by the MD5 of the source, so a file that has not changed
+# is not compressed again, and the output is byte for byte the same each time so its ETag still matches the object
+# already in the bucket. Files that need compressing are compressed on one thread per CPU. zlib and brotli release
+# the GIL while they compress, so this scales like worker processes without S3Sync having to be safe to re-import
+# for multiprocessing on Windows.
+#
+# Changing only the headers of a file does not change its ETag, so run a 'full' sync after changing the rules for
+# existing files.
+#
+
+import fnmatch
+import gzip
+import json
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from boto_scripts import s3_util
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024
+DEFAULT_COMPRESS_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'boto-scripts', 'compressed')
+ENCODINGS = ('gzip', 'br')
+
+
+def load_rules(path):
+    with open(path) as f:
+        rules = json.load(f)['rules']
+    for rule in rules:
+        if rule.get('compress') and rule['compress'] not in ENCODINGS:
+            raise ValueError('Unknown compression ' + rule['compress'] + ' for pattern ' + rule['pattern'])
+        if rule.get('compress') == 'br' and brotli is None:
+            raise ValueError('The brotli package is needed to compress ' + rule['pattern'] + ' with br')
+    return rules
+
+
+def file_settings(key, rules):
+    settings = {}
+    for rule in rules:
+        if fnmatch.fnmatch(key, rule['pattern']):
+            settings.update(rule)
+    return settings
+
+
+def _compress(job):
+    source, dest, encoding = job
+    with open(source, 'rb') as f:
+        data = f.read()
+    if encoding == 'br':
+        data = brotli.compress(data)
+    else:
+        # mtime=0 and no file name keep the output identical between runs
+        data = gzip.compress(data, compresslevel=9, mtime=0)
+    tmp = dest + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, dest)
+    return dest
+
+
+def apply_rules(manifest, rules, cache_dir=DEFAULT_COMPRESS_CACHE, workers=None):
+    # Returns a new manifest where each LocalFile carries its upload headers and, if it was compressed, points at the
+    # compressed copy with that copy's size and MD5.
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    jobs = []
+    headers = {}
+    for key, f in manifest.items():
+        settings = file_settings(key, rules)
+        h = {'Content-Type': settings.get('content_type') or mimetypes.guess_type(key)[0] or 'binary/octet-stream'}
+        if settings.get('cache_control'):
+            h['Cache-Control'] = settings['cache_control']
+        if settings.get('compress') and f.size >= MIN_COMPRESS_SIZE:
+            h['Content-Encoding'] = settings['compress']
+            jobs.append((f.path, os.path.join(cache_dir, f.md5 + '.' + settings['compress']), settings['compress']))
+        headers[key] = h
+
+    # Files with the same content share one compressed copy
+    todo = dict((job[1], job) for job in jobs if not os.path.exists(job[1])).values()
+    print('Compressing', len(todo), 'files,', len(jobs) - len(todo), 'already compressed')
+    if todo:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            list(pool.map(_compress, todo))
+
+    compressed = dict((job[0], job[1]) for job in jobs)
+    result = {}
+    for key, f in manifest.items():
+        h = headers[key]
+        dest = compressed.get(f.path)
+        if dest is not None and os.path.getsize(dest) < f.size:
+            f = f._replace(path=dest, size=os.path.getsize(dest), md5=s3_util.file_md5(dest))
+        else:
+            h.pop('Content-Encoding', None)
+        result[key] = f._replace(headers=h)
+    return result
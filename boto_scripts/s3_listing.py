@@ -0,0 +1,243 @@
+#
+# Streaming, sharded bucket listing with an optional local manifest cache, used by s3/S3Sync.py.
+#
+# The top level of the bucket is listed once with a '/' delimiter to find its prefixes (shards). Each shard is then
+# listed in full by a pool of worker threads, which hand keys to the caller through a bounded queue. Memory stays the
+# same however many keys the bucket holds, and a bucket with many top level prefixes lists many times faster than a
+# single paged listing.
+#
+# With a ManifestCache, the keys of every shard are also stored in a local sqlite database together with the time the
+# shard was listed. Shards listed less than max_age seconds ago are read from the database instead of S3. S3Sync
+# records its own uploads and deletes in the cache, so as long as nothing else writes to the bucket only new or stale
+# prefixes have to be listed again.
+#
+# A shard whose listing is throttled or fails part way is listed again from after the last key it returned, with the
+# backoff from throttle.py. If the caller stops reading early, or a shard fails for good, the workers are told to stop
+# and give up within PUT_TIMEOUT instead of staying blocked on the full queue.
+#
+
+import collections
+import queue
+import sqlite3
+import threading
+import time
+
+from boto_scripts import instrument
+from boto_scripts import s3_util
+from boto_scripts import throttle
+
+DEFAULT_LIST_WORKERS = 8
+DEFAULT_MAX_AGE = 3600
+LIST_RETRIES = 5
+QUEUE_SIZE = 10000
+PUT_TIMEOUT = 0.5
+INSERT_CHUNK = 1000
+ROOT_SHARD = ''
+
+ListedKey = collections.namedtuple('ListedKey', ['name', 'size', 'etag', 'last_modified'])
+
+
+def _listed_key(key):
+    return ListedKey(key.name, int(key.size), key.etag, key.last_modified)
+
+
+def _is_prefix(item):
+    # bucket.list() with a delimiter yields Prefix objects for common prefixes, which only have a name
+    return getattr(item, 'etag', None) is None
+
+
+class ManifestCache(object):
+    def __init__(self, path, bucket_name):
+        self.bucket_name = bucket_name
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (bucket TEXT, name TEXT, shard TEXT, size INTEGER, '
+                        'etag TEXT, last_modified TEXT, PRIMARY KEY (bucket, name))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS objects_shard ON objects (bucket, shard)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS shards (bucket TEXT, shard TEXT, listed_at REAL, '
+                        'PRIMARY KEY (bucket, shard))')
+        self.db.commit()
+
+    def shards(self):
+        rows = self.db.execute('SELECT shard, listed_at FROM shards WHERE bucket = ?', (self.bucket_name,))
+        return dict(rows.fetchall())
+
+    def keys(self, shard):
+        rows = self.db.execute('SELECT name, size, etag, last_modified FROM objects WHERE bucket = ? AND shard = ?',
+                               (self.bucket_name, shard))
+        for row in rows:
+            yield ListedKey(*row)
+
+    def start_shard(self, shard):
+        self.db.execute('DELETE FROM objects WHERE bucket = ? AND shard = ?', (self.bucket_name, shard))
+        self.db.execute('DELETE FROM shards WHERE bucket = ? AND shard = ?', (self.bucket_name, shard))
+
+    def add_keys(self, shard, keys):
+        self.db.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                            [(self.bucket_name, k.name, shard, k.size, k.etag, k.last_modified) for k in keys])
+
+    def finish_shard(self, shard):
+        self.db.execute('INSERT OR REPLACE INTO shards VALUES (?, ?, ?)', (self.bucket_name, shard, time.time()))
+        self.db.commit()
+
+    def drop_shard(self, shard):
+        self.start_shard(shard)
+        self.db.commit()
+
+    def put(self, name, size, etag):
+        # Records an object this process uploaded. last_modified is only used for multipart ETags, which a single
+        # PUT never produces, so the current time is close enough.
+        shard = shard_of(name)
+        self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                        (self.bucket_name, name, shard, size, etag, time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                                                   time.gmtime())))
+
+    def delete(self, name):
+        self.db.execute('DELETE FROM objects WHERE bucket = ? AND name = ?', (self.bucket_name, name))
+
+    def clear(self):
+        self.db.execute('DELETE FROM objects WHERE bucket = ?', (self.bucket_name,))
+        self.db.execute('DELETE FROM shards WHERE bucket = ?', (self.bucket_name,))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def shard_of(name):
+    # The top level prefix a key is listed under, or ROOT_SHARD for keys at the top of the bucket
+    if '/' not in name:
+        return ROOT_SHARD
+    return name.split('/', 1)[0] + '/'
+
+
+def _put(out, stop, item):
+    # Returns False, without queueing item, once stop is set
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _list_shard(get_bucket, shard, out, stop):
+    # boto pages through the listing inside the iterator, so a failed page cannot be retried on its own and the
+    # listing is started again after the last key received. Listing does not go through the bucket's limiter: a
+    # worker blocked on a full queue would hold its slot while the caller waits on uploads or deletes that need one.
+    marker = ''
+    attempt = 0
+    while True:
+        start = time.time()
+        try:
+            for key in get_bucket().list(prefix=shard, marker=marker):
+                if not _put(out, stop, ('key', shard, _listed_key(key))):
+                    return
+                marker = key.name
+            # Time the whole shard rather than each page
+            instrument.record_call('s3', 'ListObjects', time.time() - start)
+            _put(out, stop, ('done', shard, None))
+            return
+        except Exception as e:
+            instrument.record_call('s3', 'ListObjects', time.time() - start,
+                                   error_code=getattr(e, 'error_code', None) or type(e).__name__)
+            if attempt >= LIST_RETRIES or throttle.classify(e) is None:
+                _put(out, stop, ('error', shard, e))
+                return
+            instrument.record_retry('s3', 'ListObjects')
+            if stop.wait(throttle.backoff_delay(attempt)):
+                return
+            attempt += 1
+
+
+def list_bucket(get_bucket, workers=DEFAULT_LIST_WORKERS, cache=None, max_age=DEFAULT_MAX_AGE):
+    # Yields a ListedKey for every key in the bucket, in no particular order. get_bucket must return a bucket for the
+    # calling thread (see s3_util.thread_local_bucket). The cache, if given, is only used from the calling thread.
+    cached_shards = cache.shards() if cache is not None else {}
+    now = time.time()
+    to_list = []
+    from_cache = []
+    root_keys = []
+    if cache is not None:
+        cache.start_shard(ROOT_SHARD)
+    for item in s3_util.timed_listing(get_bucket().list(delimiter='/')):
+        if not _is_prefix(item):
+            key = _listed_key(item)
+            if cache is not None:
+                root_keys.append(key)
+                if len(root_keys) >= INSERT_CHUNK:
+                    cache.add_keys(ROOT_SHARD, root_keys)
+                    root_keys = []
+            yield key
+        elif item.name in cached_shards and now - cached_shards[item.name] < max_age:
+            from_cache.append(item.name)
+        else:
+            to_list.append(item.name)
+
+    if cache is not None:
+        cache.add_keys(ROOT_SHARD, root_keys)
+        cache.finish_shard(ROOT_SHARD)
+        # Prefixes that no longer exist in the bucket
+        for shard in set(cached_shards) - set(from_cache) - set(to_list) - set([ROOT_SHARD]):
+            cache.drop_shard(shard)
+    print('Listing', len(to_list), 'prefixes from S3,', len(from_cache), 'from the manifest cache')
+    instrument.count('shards_listed', len(to_list))
+    instrument.count('shards_from_cache', len(from_cache))
+
+    for shard in from_cache:
+        for k in cache.keys(shard):
+            yield k
+
+    if not to_list:
+        return
+    out = queue.Queue(QUEUE_SIZE)
+    stop = threading.Event()
+    pending = collections.deque(to_list)
+    running = 0
+    buffers = {}
+
+    def start_next():
+        shard = pending.popleft()
+        if cache is not None:
+            cache.start_shard(shard)
+            buffers[shard] = []
+        t = threading.Thread(target=_list_shard, args=(get_bucket, shard, out, stop))
+        t.daemon = True
+        t.start()
+
+    while pending and running < workers:
+        start_next()
+        running += 1
+    try:
+        while running:
+            kind, shard, value = out.get()
+            if kind == 'key':
+                if cache is not None:
+                    buffers[shard].append(value)
+                    if len(buffers[shard]) >= INSERT_CHUNK:
+                        cache.add_keys(shard, buffers[shard])
+                        buffers[shard] = []
+                yield value
+            elif kind == 'done':
+                if cache is not None:
+                    cache.add_keys(shard, buffers.pop(shard))
+                    cache.finish_shard(shard)
+                running -= 1
+                if pending:
+                    start_next()
+                    running += 1
+            else:
+                raise value
+    finally:
+        # Also reached when the caller stops reading or a shard failed, with workers still listing. Tell them to stop
+        # and empty the queue so none stays blocked on it.
+        stop.set()
+        try:
+            while True:
+                out.get_nowait()
+        except queue.Empty:
+            pass
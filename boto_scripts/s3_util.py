@@ -0,0 +1,230 @@
+#
+# Helpers used by s3/S3Sync.py to sync a local directory to a bucket without emptying it first.
+#
+# A manifest of the local files (key, size, MD5 and mtime) is built up front. The bucket listing is then streamed
+# and compared against it one key at a time: keys that match are left alone, keys with no local file are deleted
+# and anything new or different is uploaded. The MD5 of a file uploaded in a single PUT is its S3 ETag, so an
+# unchanged file costs nothing but its line in the listing.
+#
+# Uploads run on a pool of worker threads. Only a couple of files per worker are queued at once so memory stays flat
+# however big the tree is. Every request goes through the bucket's limiter (see throttle.py), which retries throttling
+# (503 SlowDown) and 500 responses with jittered backoff and cuts how many requests are in flight when S3 pushes back.
+#
+# Deletes are sent as DeleteObjects requests of up to 1000 keys, several at a time. boto connections are not safe to
+# share between threads, so the concurrent helpers take a function that returns a bucket for the calling thread (see
+# thread_local_bucket).
+#
+
+import base64
+import binascii
+import calendar
+import collections
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from boto_scripts import instrument
+from boto_scripts import throttle
+
+READ_CHUNK_SIZE = 1024 * 1024
+DELETE_BATCH_SIZE = 1000  # The most keys a single DeleteObjects request accepts
+DEFAULT_DELETE_WORKERS = 8
+DEFAULT_UPLOAD_WORKERS = 16
+UPLOAD_RETRIES = 5
+
+LocalFile = collections.namedtuple('LocalFile', ['key', 'path', 'size', 'md5', 'mtime', 'headers'], defaults=[None])
+SyncPlan = collections.namedtuple('SyncPlan', ['uploads', 'deletes', 'unchanged'])
+DeleteFailure = collections.namedtuple('DeleteFailure', ['key', 'code', 'message'])
+UploadFailure = collections.namedtuple('UploadFailure', ['key', 'error'])
+
+
+def file_digest(path, algorithm='md5'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_md5(path):
+    return file_digest(path, 'md5')
+
+
+def key_path(file_root, path):
+    return os.path.relpath(path, file_root).replace('\\', '/')
+
+
+def build_local_manifest(file_root):
+    manifest = {}
+    for (root, dirs, files) in os.walk(file_root):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            key = key_path(file_root, path)
+            manifest[key] = LocalFile(key, path, st.st_size, file_md5(path), st.st_mtime)
+    return manifest
+
+
+def _s3_timestamp(last_modified):
+    # The bucket listing returns ISO 8601 timestamps such as 2015-09-01T12:00:00.000Z
+    return calendar.timegm(time.strptime(last_modified.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S'))
+
+
+def remote_matches(local, size, etag, last_modified):
+    if local.size != size:
+        return False
+    etag = etag.strip('"')
+    if '-' not in etag:
+        return etag == local.md5
+    # Multipart uploads have an ETag that is not the MD5 of the content. The best we can do is assume the object
+    # is current if the local file has not been touched since it was uploaded.
+    return local.mtime <= _s3_timestamp(last_modified)
+
+
+def diff_bucket(local_manifest, remote_keys):
+    # remote_keys is any iterable of boto Key objects (e.g. bucket.list()). It is consumed once and never held in
+    # memory as a whole, only the names of keys that need deleting are kept.
+    matched = set()
+    deletes = []
+    for key in remote_keys:
+        local = local_manifest.get(key.name)
+        if local is None:
+            deletes.append(key.name)
+        elif remote_matches(local, key.size, key.etag, key.last_modified):
+            matched.add(key.name)
+
+    uploads = [local_manifest[k] for k in sorted(local_manifest) if k not in matched]
+    return SyncPlan(uploads, deletes, len(matched))
+
+
+def thread_local_bucket(connect, bucket_name):
+    # connect() must return a new S3Connection. Each thread calling the returned function gets its own connection.
+    local = threading.local()
+
+    def get_bucket():
+        if not hasattr(local, 'bucket'):
+            local.bucket = connect().get_bucket(bucket_name, validate=False)
+        return local.bucket
+    return get_bucket
+
+
+def timed_listing(keys, operation='ListObjects'):
+    # Yields the keys of a boto listing, e.g. bucket.list(prefix). boto fetches the pages inside the iterator, so the
+    # time spent in it is recorded as one call once the listing ends, leaving out the caller's time between keys.
+    spent = 0.0
+    keys = iter(keys)
+    while True:
+        start = time.time()
+        try:
+            key = next(keys)
+        except StopIteration:
+            instrument.record_call('s3', operation, spent + time.time() - start)
+            return
+        except Exception as e:
+            instrument.record_call('s3', operation, spent + time.time() - start,
+                                   error_code=getattr(e, 'error_code', None) or type(e).__name__)
+            raise
+        spent += time.time() - start
+        yield key
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bucket_limiter(get_bucket):
+    # How long a PUT takes depends on the size of the object more than on how busy S3 is, so the limiter only goes by
+    # throttles
+    return throttle.limiter('s3', get_bucket().name, latency_factor=None)
+
+
+def _upload_file(get_bucket, f, policy, retries):
+    # Passing the MD5 we already have stops boto from reading the file a second time to compute it
+    md5 = (f.md5, base64.b64encode(binascii.unhexlify(f.md5)).decode('ascii'))
+
+    def put():
+        print('Uploading ', f.key)
+        key = get_bucket().new_key(f.key)
+        with instrument.timed('s3', 'PutObject', f.size):
+            key.set_contents_from_filename(f.path, headers=f.headers, policy=policy, md5=md5)
+    try:
+        bucket_limiter(get_bucket).call('PutObject', put, retries)
+    except Exception as e:
+        return UploadFailure(f.key, e)
+    return None
+
+
+def upload_files(get_bucket, files, max_workers=DEFAULT_UPLOAD_WORKERS, policy='public-read', retries=UPLOAD_RETRIES):
+    # files is an iterable of LocalFile. Returns the uploads that still failed after retrying.
+    failures = []
+    uploaded = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for f in files:
+            pending.add(pool.submit(_upload_file, get_bucket, f, policy, retries))
+            if len(pending) >= max_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                uploaded += _collect_uploads(done, failures)
+        uploaded += _collect_uploads(pending, failures)
+    print('Uploaded', uploaded, 'files,', len(failures), 'failed')
+    return failures
+
+
+def _collect_uploads(done, failures):
+    uploaded = 0
+    for future in done:
+        failure = future.result()
+        if failure is None:
+            uploaded += 1
+        else:
+            print('Failed to upload ', failure.key, failure.error)
+            failures.append(failure)
+    return uploaded
+
+
+def _delete_batch(get_bucket, batch):
+    def delete():
+        with instrument.timed('s3', 'DeleteObjects'):
+            return get_bucket().delete_keys(batch, quiet=True)
+    try:
+        result = bucket_limiter(get_bucket).call('DeleteObjects', delete)
+    except Exception as e:
+        return [DeleteFailure(name, type(e).__name__, str(e)) for name in batch]
+    return [DeleteFailure(err.key, err.code, err.message) for err in result.errors]
+
+
+def delete_keys(get_bucket, key_names, max_workers=DEFAULT_DELETE_WORKERS):
+    # key_names can be a generator, e.g. (k.name for k in bucket.list(prefix)). At most two batches per worker are
+    # queued at a time so clearing a huge bucket does not pull the whole listing into memory.
+    failures = []
+    deleted = 0
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for batch in batches(key_names, DELETE_BATCH_SIZE):
+            pending[pool.submit(_delete_batch, get_bucket, batch)] = len(batch)
+            if len(pending) >= max_workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                deleted += _collect_deletes(done, pending, failures)
+        deleted += _collect_deletes(list(pending), pending, failures)
+    print('Deleted', deleted, 'keys,', len(failures), 'failed')
+    return failures
+
+
+def _collect_deletes(done, pending, failures):
+    deleted = 0
+    for future in done:
+        batch_failures = future.result()
+        deleted += pending.pop(future) - len(batch_failures)
+        for f in batch_failures:
+            print('Failed to delete ', f.key, f.code, f.message)
+        failures.extend(batch_failures)
+    return deleted
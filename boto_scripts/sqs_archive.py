@@ -0,0 +1,187 @@
+#
+# Line-delimited archive files for SQS messages, used by sqs/sqs_util.py.
+#
+# Every line is one JSON message with the same 'id', 'attributes' and 'body' keys as the one-file-per-message format
+# written by mode S, plus the message's system attributes (SentTimestamp, MessageGroupId, ...). Files can be gzip
+# compressed and are rotated once they reach a size limit. write_batch only returns once the batch is flushed and
+# fsync'd, so it is safe to delete the messages from the queue as soon as it returns.
+#
+# Binary message attribute values are stored base64 encoded. RestoreCheckpoint records which lines of each archive
+# have been sent back to a queue so an interrupted restore can pick up where it left off.
+#
+
+import base64
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+DEFAULT_ROTATE_BYTES = 256 * 1024 * 1024
+ARCHIVE_SUFFIXES = ('.jsonl', '.jsonl.gz')
+
+
+def _encode_attributes(attributes):
+    encoded = {}
+    for name, attr in attributes.items():
+        attr = dict(attr)
+        if isinstance(attr.get('BinaryValue'), bytes):
+            attr['BinaryValue'] = base64.b64encode(attr['BinaryValue']).decode('ascii')
+        attr.pop('BinaryListValues', None)
+        attr.pop('StringListValues', None)
+        encoded[name] = attr
+    return encoded
+
+
+def sendable_attributes(attributes):
+    # Turns saved attributes back into what send_message expects. Saved files from older versions of mode S may
+    # contain None or empty list values, which SQS rejects.
+    sendable = {}
+    for name, attr in (attributes or {}).items():
+        value = {'DataType': attr['DataType']}
+        if attr.get('StringValue') is not None:
+            value['StringValue'] = attr['StringValue']
+        elif attr.get('BinaryValue') is not None:
+            binary = attr['BinaryValue']
+            value['BinaryValue'] = base64.b64decode(binary) if not isinstance(binary, bytes) else binary
+        else:
+            continue
+        sendable[name] = value
+    return sendable
+
+
+def message_size(body, attributes):
+    # The size SQS counts against the 256KB message and batch limits
+    size = len(body.encode('utf-8'))
+    for name, attr in attributes.items():
+        size += len(name.encode('utf-8')) + len(attr['DataType'].encode('utf-8'))
+        value = attr.get('StringValue', attr.get('BinaryValue'))
+        size += len(value.encode('utf-8')) if not isinstance(value, bytes) else len(value)
+    return size
+
+
+def message_record(message):
+    # message is a message dict as returned by the receive_message client call
+    return {
+        'id': message['MessageId'],
+        'attributes': _encode_attributes(message.get('MessageAttributes', {})),
+        'system_attributes': message.get('Attributes', {}),
+        'body': message['Body']
+    }
+
+
+class ArchiveWriter(object):
+    def __init__(self, output_dir, prefix, compress=False, rotate_bytes=DEFAULT_ROTATE_BYTES):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.files_written = []
+        self._raw = None
+        self._out = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self._seq += 1
+        name = '{}-{}-{:05d}.jsonl'.format(self.prefix, time.strftime('%Y%m%dT%H%M%S'), self._seq)
+        if self.compress:
+            name += '.gz'
+        path = os.path.join(self.output_dir, name)
+        self._raw = open(path, 'wb')
+        self._out = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw, mtime=0) if self.compress else self._raw
+        self.files_written.append(path)
+        print("Writing archive {}".format(path))
+
+    def _close(self):
+        if self._out is not self._raw:
+            self._out.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        self._raw = None
+        self._out = None
+
+    def write_batch(self, records):
+        data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records).encode('utf-8')
+        with self._lock:
+            if self._raw is None:
+                self._open()
+            self._out.write(data)
+            if self._out is not self._raw:
+                # A sync flush ends the deflate block so everything written so far can be read back after a crash
+                self._out.flush(zlib.Z_SYNC_FLUSH)
+            self._raw.flush()
+            os.fsync(self._raw.fileno())
+            if self._raw.tell() >= self.rotate_bytes:
+                self._close()
+
+    def close(self):
+        with self._lock:
+            if self._raw is not None:
+                self._close()
+
+
+def is_archive(filename):
+    return filename.endswith(ARCHIVE_SUFFIXES)
+
+
+def read_archive(path):
+    # Yields (line number, record). A gzip file cut short by a crash is read up to its last complete line.
+    raw = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    with raw:
+        lines = io.TextIOWrapper(raw, encoding='utf-8')
+        line_number = 0
+        try:
+            for line in lines:
+                if not line.endswith('\n'):
+                    break
+                yield line_number, json.loads(line)
+                line_number += 1
+        except EOFError:
+            print("Archive {} is truncated after line {}".format(path, line_number))
+
+
+class RestoreCheckpoint(object):
+    # Keeps, per archive file, the ranges of lines that have been sent as [start, end) pairs. Batches finish out of
+    # order, so ranges are merged as they come in rather than keeping a single high-water mark.
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)
+
+    def is_done(self, source, line):
+        # Called from the reading thread while sender threads mark batches
+        with self._lock:
+            for start, end in self.done.get(source, []):
+                if start <= line < end:
+                    return True
+            return False
+
+    def mark(self, source, lines):
+        if not lines:
+            return
+        with self._lock:
+            # Merged on copies, so the lists already in self.done are never changed
+            ranges = sorted([list(r) for r in self.done.get(source, [])] + [[line, line + 1] for line in lines])
+            merged = [ranges[0]]
+            for r in ranges[1:]:
+                if r[0] <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], r[1])
+                else:
+                    merged.append(r)
+            self.done[source] = merged
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.done, f)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
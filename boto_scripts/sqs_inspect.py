@@ -0,0 +1,299 @@
+#
+# Looks at the messages on an SQS queue without removing them, for triaging a dead letter queue that is still in use.
+# Used by mode I of sqs/sqs_util.py.
+#
+# Several receivers scan the queue at once and nothing is ever deleted. A message is hidden from other consumers only
+# while the scan runs: once it is done every message received is made visible again straight away. The visibility
+# timeout defaults to time_limit plus VISIBILITY_MARGIN, since a message that became visible mid scan would be
+# received again and the scan would stop early, taking it for the queue coming round. Each message is seen once, by
+# MessageId, and the scan stops when the queue runs dry, only messages already seen come back, max_messages have been
+# seen or time_limit runs out.
+#
+# QueueStats keeps running totals rather than the messages themselves, so memory does not grow with the size of the
+# queue (apart from the set of message ids seen): counts per message attribute value, and histograms of body size,
+# receive count (which includes the scan's own receive) and age. Messages matching a filter expression can be written
+# to archive files in the mode A format, which mode R can restore. A filter is one or more conditions joined by 'and':
+#
+#    attr.customer = acme and receive_count >= 3 and body ~ Timeout
+#
+# A value runs up to the next 'and' that is followed by a field and an operator, so 'body ~ foo and bar' searches the
+# body for 'foo and bar'.
+#
+# Fields are attr.<name> (a message attribute), body, size (body bytes), receive_count, age (seconds since sent),
+# group (MessageGroupId) and id. Operators are = != < <= > >= and ~ (regular expression search).
+#
+# Receiving counts against a message's receive count, so inspecting a queue that has a redrive policy can move
+# messages to its dead letter queue. Point this at the dead letter queue itself, or keep the scan short.
+#
+
+import collections
+import operator
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto_scripts import sqs_archive
+from boto_scripts import sqs_ops
+
+DEFAULT_RECEIVERS = 8
+DEFAULT_TIME_LIMIT = 60
+VISIBILITY_MARGIN = 30  # seconds a message stays hidden after the scan's time limit
+MAX_VISIBILITY_TIMEOUT = 12 * 3600  # the longest SQS allows
+MAX_ATTRIBUTE_VALUES = 100  # distinct values counted per attribute, the rest are counted as OTHER_VALUES
+OTHER_VALUES = '(other)'
+SIZE_BUCKETS = (256, 1024, 4096, 16 * 1024, 64 * 1024, 256 * 1024)
+AGE_BUCKETS = ((60, '1m'), (600, '10m'), (3600, '1h'), (6 * 3600, '6h'), (86400, '1d'), (4 * 86400, '4d'),
+               (14 * 86400, '14d'))
+RECEIVE_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+
+InspectResult = collections.namedtuple('InspectResult', ['stats', 'exported', 'duplicates', 'released'])
+
+_OPERATORS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '!=': operator.ne,
+    '=': operator.eq,
+    '>': operator.gt,
+    '<': operator.lt,
+    '~': None
+}
+_CONDITION = re.compile(r'^\s*([\w.\-]+)\s*(>=|<=|!=|=|>|<|~)\s*(.*?)\s*$')
+# 'and' only joins conditions when a field and an operator follow it, so a pattern can contain ' and '
+_AND = re.compile(r'\s+and\s+(?=[\w.\-]+\s*(?:>=|<=|!=|=|>|<|~))')
+_NUMERIC_FIELDS = ('size', 'receive_count', 'age')
+_FIELDS = _NUMERIC_FIELDS + ('body', 'group', 'id')
+
+
+def _receive_count(record):
+    return int(record['system_attributes'].get('ApproximateReceiveCount', 0))
+
+
+def _age(record, now):
+    sent = record['system_attributes'].get('SentTimestamp')
+    return now - int(sent) / 1000.0 if sent is not None else None
+
+
+def _field(record, name, now):
+    if name.startswith('attr.'):
+        attr = record['attributes'].get(name[len('attr.'):])
+        return attr.get('StringValue', attr.get('BinaryValue')) if attr else None
+    if name == 'size':
+        return len(record['body'].encode('utf-8'))
+    if name == 'receive_count':
+        return _receive_count(record)
+    if name == 'age':
+        return _age(record, now)
+    if name == 'group':
+        return record['system_attributes'].get('MessageGroupId')
+    return record[name]
+
+
+def _condition(text):
+    parsed = _CONDITION.match(text)
+    if parsed is None:
+        raise ValueError('Cannot parse filter condition: ' + text)
+    name, symbol, value = parsed.groups()
+    op = _OPERATORS[symbol]
+    if name not in _FIELDS and not name.startswith('attr.'):
+        raise ValueError('Unknown filter field ' + name + ', expected attr.<name> or one of ' + ', '.join(_FIELDS))
+    if op is None:
+        try:
+            pattern = re.compile(value)
+        except re.error as e:
+            raise ValueError('Bad regular expression ' + value + ': ' + str(e))
+        return lambda record, now: pattern.search(str(_field(record, name, now) or '')) is not None
+    if name in _NUMERIC_FIELDS:
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError('Filter field ' + name + ' needs a number, not ' + value)
+    elif symbol not in ('=', '!='):
+        raise ValueError('Filter field ' + name + ' can only be compared with =, != or ~')
+
+    def check(record, now):
+        actual = _field(record, name, now)
+        if actual is None:
+            return symbol == '!='
+        return op(actual, value)
+    return check
+
+
+def parse_filter(expression):
+    # Returns a function of (record, now) that is True for records matching expression. Raises ValueError if the
+    # expression cannot be parsed.
+    conditions = [_condition(part) for part in _AND.split(expression.strip()) if part]
+    if not conditions:
+        raise ValueError('Empty filter expression')
+    return lambda record, now: all(c(record, now) for c in conditions)
+
+
+class _Histogram(object):
+    # Counts of values at or under each bound, plus one for everything bigger. labels name the bounds.
+    def __init__(self, bounds, labels=None):
+        self.bounds = bounds
+        self.labels = labels or [str(b) for b in bounds]
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def rows(self):
+        labels = ['<= ' + label for label in self.labels] + ['> ' + self.labels[-1]]
+        return [(label, count) for label, count in zip(labels, self.counts) if count]
+
+
+class QueueStats(object):
+    def __init__(self):
+        self.messages = 0
+        self.body_bytes = 0
+        self.attributes = collections.defaultdict(collections.Counter)
+        self.sizes = _Histogram(SIZE_BUCKETS)
+        self.receive_counts = _Histogram(RECEIVE_COUNT_BUCKETS)
+        self.ages = _Histogram([b for b, _ in AGE_BUCKETS], [label for _, label in AGE_BUCKETS])
+        self.groups = collections.Counter()
+        self.oldest = None
+        self.newest = None
+        self._lock = threading.Lock()
+
+    def add(self, record, now):
+        size = len(record['body'].encode('utf-8'))
+        age = _age(record, now)
+        with self._lock:
+            self.messages += 1
+            self.body_bytes += size
+            self.sizes.add(size)
+            self.receive_counts.add(_receive_count(record))
+            if age is not None:
+                self.ages.add(age)
+                self.oldest = age if self.oldest is None else max(self.oldest, age)
+                self.newest = age if self.newest is None else min(self.newest, age)
+            for name, attr in record['attributes'].items():
+                values = self.attributes[name]
+                value = attr.get('StringValue', attr.get('BinaryValue'))
+                if value not in values and len(values) >= MAX_ATTRIBUTE_VALUES:
+                    value = OTHER_VALUES
+                values[value] += 1
+            group = record['system_attributes'].get('MessageGroupId')
+            if group is not None:
+                self.groups[group] += 1
+
+    def summary(self, top=10):
+        # A dict of the totals, with the top most common values of each attribute
+        with self._lock:
+            return {
+                'messages': self.messages,
+                'body_bytes': self.body_bytes,
+                'oldest_seconds': round(self.oldest, 1) if self.oldest is not None else None,
+                'newest_seconds': round(self.newest, 1) if self.newest is not None else None,
+                'size': self.sizes.rows(),
+                'receive_count': self.receive_counts.rows(),
+                'age': self.ages.rows(),
+                'attributes': dict((name, values.most_common(top)) for name, values in self.attributes.items()),
+                'groups': self.groups.most_common(top)
+            }
+
+    def print_summary(self, top=10):
+        summary = self.summary(top)
+        print("{} messages, {} body bytes, oldest {}s, newest {}s".format(
+            summary['messages'], summary['body_bytes'], summary['oldest_seconds'], summary['newest_seconds']))
+        for title in ('size', 'receive_count', 'age'):
+            print("By {}:".format(title))
+            for label, count in summary[title]:
+                print("  {:<12} {:>10}".format(label, count))
+        for name, values in sorted(summary['attributes'].items()):
+            print("Attribute {}:".format(name))
+            for value, count in values:
+                print("  {:<40} {:>10}".format(str(value)[:40], count))
+        if summary['groups']:
+            print("Message groups:")
+            for group, count in summary['groups']:
+                print("  {:<40} {:>10}".format(group[:40], count))
+
+
+def _inspect_receiver(client, queue_url, state, stats, match, writer, budget, deadline, visibility_timeout):
+    while time.time() < deadline:
+        n = budget.take(10)
+        if n == 0:
+            return
+        response = sqs_ops.queue_call(client, 'receive_message', queue_url, MaxNumberOfMessages=n, WaitTimeSeconds=1,
+                                      VisibilityTimeout=visibility_timeout, AttributeNames=['All'],
+                                      MessageAttributeNames=['All'])
+        messages = response.get('Messages', [])
+        now = time.time()
+        new = []
+        with state['lock']:
+            state['handles'].extend(m['ReceiptHandle'] for m in messages)
+            for m in messages:
+                if m['MessageId'] in state['seen']:
+                    state['duplicates'] += 1
+                else:
+                    state['seen'].add(m['MessageId'])
+                    new.append(m)
+        budget.give_back(n - len(new))
+        if not new:
+            # Either the queue is empty or the scan has come round to messages it already saw
+            return
+        records = [sqs_archive.message_record(m) for m in new]
+        for record in records:
+            stats.add(record, now)
+        if writer is not None:
+            matched = [r for r in records if match(r, now)]
+            if matched:
+                writer.write_batch(matched)
+                with state['lock']:
+                    state['exported'] += len(matched)
+
+
+def _release_batch(client, queue_url, handles):
+    entries = [{'Id': str(i), 'ReceiptHandle': h, 'VisibilityTimeout': 0} for i, h in enumerate(handles)]
+    try:
+        response = sqs_ops.queue_call(client, 'change_message_visibility_batch', queue_url, Entries=entries)
+    except Exception as e:
+        print("Failed to make {} messages visible again: {}".format(len(handles), e))
+        return 0
+    # Handles whose visibility timeout already ran out fail, but those messages are visible again anyway
+    return len(response.get('Successful', []))
+
+
+def inspect_queue(client, queue_name, max_messages, receivers=DEFAULT_RECEIVERS, filter_expression=None,
+                  output_dir=None, visibility_timeout=None, time_limit=DEFAULT_TIME_LIMIT, compress=False):
+    # Returns an InspectResult. Messages matching filter_expression are exported to output_dir, which is required
+    # when a filter is given. visibility_timeout defaults to time_limit plus VISIBILITY_MARGIN. Raises ValueError for
+    # a bad filter expression, or a visibility timeout shorter than the time limit.
+    if visibility_timeout is None:
+        visibility_timeout = min(time_limit + VISIBILITY_MARGIN, MAX_VISIBILITY_TIMEOUT)
+    if visibility_timeout < time_limit:
+        raise ValueError('The visibility timeout ({}s) must be at least the time limit ({}s), or messages come back '
+                         'during the scan'.format(visibility_timeout, time_limit))
+    match = parse_filter(filter_expression) if filter_expression else None
+    if match is not None and not output_dir:
+        raise ValueError('An output directory is needed to export the messages matching a filter')
+    queue_url = sqs_ops.get_queue_url(client, queue_name)
+    writer = sqs_archive.ArchiveWriter(output_dir, queue_name + '-inspect', compress) if match is not None else None
+    stats = QueueStats()
+    state = {'seen': set(), 'handles': [], 'duplicates': 0, 'exported': 0, 'lock': threading.Lock()}
+    budget = sqs_ops.MessageBudget(max_messages)
+    deadline = time.time() + time_limit
+    try:
+        with ThreadPoolExecutor(max_workers=receivers) as pool:
+            futures = [pool.submit(_inspect_receiver, client, queue_url, state, stats, match, writer, budget,
+                                   deadline, visibility_timeout)
+                       for _ in range(receivers)]
+            for future in futures:
+                future.result()
+    finally:
+        if writer is not None:
+            writer.close()
+        handles = state['handles']
+        with ThreadPoolExecutor(max_workers=receivers) as pool:
+            released = sum(pool.map(lambda i: _release_batch(client, queue_url, handles[i:i + 10]),
+                                    range(0, len(handles), 10)))
+
+    print("Inspected {} messages ({} seen twice), exported {}, made {} visible again".format(
+        stats.messages, state['duplicates'], state['exported'], released))
+    return InspectResult(stats, state['exported'], state['duplicates'], released)
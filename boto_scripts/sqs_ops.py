@@ -0,0 +1,346 @@
+#
+# Archive, restore and move SQS queues. Used by modes A, R and M of sqs/sqs_util.py, and usable on their own with a
+# client from clients.ClientFactory.
+#
+# archive_messages drains a queue into line-delimited archive files (see sqs_archive.py). Several receivers long poll
+# the queue at once, every received batch is appended to the archive and fsync'd, and only then removed from the queue
+# with a single delete_message_batch call.
+#
+# restore_messages streams archives, and the one-file-per-message files written by mode S, back onto a queue with
+# send_message_batch from several threads, keeping their message attributes. Progress through archive files is kept
+# in a checkpoint file in the input directory, so restoring again after a crash skips what was already sent. Single
+# message files are deleted once sent, as are archives once every message in them was sent. FIFO queues are restored
+# by a single sender to keep the original order.
+#
+# move_messages moves messages straight from one queue to another, e.g. to redrive a dead letter queue, without
+# writing them to disk. Each of several workers receives a batch, sends it on with send_message_batch and deletes
+# from the source only what the target accepted, so a message is never lost but may be delivered twice if a delete
+# fails. FIFO targets get the original message id as deduplication id, which drops such repeats within SQS's five
+# minute deduplication window. An optional transform hook sees every message as an archive record (see
+# sqs_archive.message_record) and returns the record to send, changed or not, or None to leave the message on the
+# source queue.
+#
+# Every call on a queue goes through the queue's limiter (see throttle.py and queue_call), so throttled calls are
+# retried and all the threads working on a queue slow down together.
+#
+
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from boto_scripts import sqs_archive
+from boto_scripts import throttle
+
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+SEND_RETRIES = 3
+RESTORE_CHECKPOINT = '.restore-checkpoint.json'
+DEFAULT_RECEIVERS = 4
+DEFAULT_SENDERS = 8
+DEFAULT_MOVERS = 16
+
+ArchiveResult = collections.namedtuple('ArchiveResult', ['saved', 'deleted', 'files'])
+RestoreResult = collections.namedtuple('RestoreResult', ['sent', 'failures'])
+MoveResult = collections.namedtuple('MoveResult', ['moved', 'skipped', 'failures', 'delete_failures'])
+
+
+class MessageBudget(object):
+    # Hands out how many more messages the receivers may take so that together they stop at the requested count
+    def __init__(self, total):
+        self.remaining = int(total)
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        with self.lock:
+            n = min(n, self.remaining)
+            self.remaining -= n
+            return n
+
+    def give_back(self, n):
+        with self.lock:
+            self.remaining += n
+
+
+def queue_call(client, method, queue_url, **kwargs):
+    # Calls client.<method>(QueueUrl=queue_url, **kwargs) through the queue's limiter, e.g.
+    # queue_call(client, 'receive_message', queue_url, MaxNumberOfMessages=10)
+    operation = ''.join(word.capitalize() for word in method.split('_'))
+    return throttle.limiter('sqs', queue_url).call(
+        operation, lambda: getattr(client, method)(QueueUrl=queue_url, **kwargs))
+
+
+def get_queue_url(client, queue_name):
+    return throttle.limiter('sqs').call('GetQueueUrl', lambda: client.get_queue_url(QueueName=queue_name))['QueueUrl']
+
+
+def _delete_msg_batch(client, queue_url, messages):
+    entries = [{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)]
+    response = queue_call(client, 'delete_message_batch', queue_url, Entries=entries)
+    for failed in response.get('Failed', []):
+        # The message was already archived or sent on, and will be received again once its visibility timeout expires
+        print("Failed to delete {}: {}".format(messages[int(failed['Id'])]['MessageId'], failed.get('Message')))
+    return len(response.get('Successful', []))
+
+
+def _archive_receiver(client, queue_url, writer, budget, counts):
+    while True:
+        n = budget.take(10)
+        if n == 0:
+            return
+        response = queue_call(client, 'receive_message', queue_url, MaxNumberOfMessages=n, WaitTimeSeconds=20,
+                              AttributeNames=['All'], MessageAttributeNames=['All'])
+        messages = response.get('Messages', [])
+        budget.give_back(n - len(messages))
+        if not messages:
+            # A 20 second long poll came back empty, so the queue is drained
+            return
+        writer.write_batch([sqs_archive.message_record(m) for m in messages])
+        deleted = _delete_msg_batch(client, queue_url, messages)
+        with counts['lock']:
+            counts['saved'] += len(messages)
+            counts['deleted'] += deleted
+            if counts['saved'] // 1000 != (counts['saved'] - len(messages)) // 1000:
+                print("Archived {} messages".format(counts['saved']))
+
+
+def archive_messages(client, queue_name, output_dir, max_messages, receivers=DEFAULT_RECEIVERS, compress=False,
+                     rotate_bytes=sqs_archive.DEFAULT_ROTATE_BYTES):
+    # Returns an ArchiveResult. client needs a connection pool of at least receivers connections.
+    queue_url = get_queue_url(client, queue_name)
+    writer = sqs_archive.ArchiveWriter(output_dir, queue_name, compress, rotate_bytes)
+    budget = MessageBudget(max_messages)
+    counts = {'saved': 0, 'deleted': 0, 'lock': threading.Lock()}
+    try:
+        with ThreadPoolExecutor(max_workers=receivers) as pool:
+            futures = [pool.submit(_archive_receiver, client, queue_url, writer, budget, counts)
+                       for _ in range(receivers)]
+            for future in futures:
+                future.result()
+    finally:
+        writer.close()
+    print("Archived {} messages to {} file(s), deleted {} from the queue".format(
+        counts['saved'], len(writer.files_written), counts['deleted']))
+    return ArchiveResult(counts['saved'], counts['deleted'], writer.files_written)
+
+
+def _restore_records(input_dir, checkpoint, num_msgs, file_lines):
+    # Yields (source file, line, record) for every message not restored yet, up to num_msgs of them. Archive files
+    # are streamed. file_lines gets the line count of each archive that was read to the end.
+    count = 0
+    for filename in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, filename)
+        if filename.startswith('.') or not os.path.isfile(path):
+            continue
+        if sqs_archive.is_archive(filename):
+            records = sqs_archive.read_archive(path)
+        else:
+            # A single message file written by mode S
+            try:
+                with open(path) as f:
+                    records = [(0, json.load(f))]
+            except ValueError:
+                print("Skipping {}, it is not a saved message".format(filename))
+                continue
+        lines = 0
+        for line, record in records:
+            lines = line + 1
+            if checkpoint.is_done(filename, line):
+                continue
+            if count >= num_msgs:
+                return
+            yield filename, line, record
+            count += 1
+        file_lines[filename] = lines
+
+
+def _pack_batches(records):
+    # send_message_batch takes at most 10 messages and 256KB in total
+    batch = []
+    batch_bytes = 0
+    for source, line, record in records:
+        attributes = sqs_archive.sendable_attributes(record.get('attributes'))
+        size = sqs_archive.message_size(record['body'], attributes)
+        if batch and (len(batch) == MAX_BATCH_ENTRIES or batch_bytes + size > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((source, line, record, attributes))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _batch_entry(entry_id, record, attributes, fifo):
+    entry = {'Id': entry_id, 'MessageBody': record['body']}
+    if attributes:
+        entry['MessageAttributes'] = attributes
+    if fifo:
+        entry['MessageGroupId'] = record.get('system_attributes', {}).get('MessageGroupId', 'restore')
+        entry['MessageDeduplicationId'] = record['id']
+    return entry
+
+
+def _send_batch(client, queue_url, batch, fifo):
+    # Sends a batch from _pack_batches, retrying entries that fail unless the failure is the sender's fault. Returns
+    # ({entry id: batch item} that were sent, {entry id: reason} that were not).
+    pending = dict((str(i), item) for i, item in enumerate(batch))
+    sent = {}
+    errors = {}
+    for attempt in range(SEND_RETRIES + 1):
+        entries = [_batch_entry(i, record, attributes, fifo) for i, (_, _, record, attributes) in pending.items()]
+        try:
+            response = queue_call(client, 'send_message_batch', queue_url, Entries=entries)
+        except Exception as e:
+            # The limiter has already retried the request if that could help
+            errors.update((i, str(e)) for i in pending)
+            break
+        for success in response.get('Successful', []):
+            sent[success['Id']] = pending.pop(success['Id'])
+            errors.pop(success['Id'], None)
+        for failed in response.get('Failed', []):
+            errors[failed['Id']] = failed.get('Message', failed.get('Code'))
+            if failed.get('SenderFault'):
+                # Retrying will not help, e.g. the message is too big for the target queue
+                pending.pop(failed['Id'])
+        if not pending:
+            break
+        time.sleep(throttle.backoff_delay(attempt))
+    return sent, dict((i, reason) for i, reason in errors.items() if i not in sent)
+
+
+def _send_restore_batch(client, queue_url, batch, fifo, input_dir, checkpoint):
+    # Returns (number sent, [(record id, reason)] that could not be sent)
+    sent, errors = _send_batch(client, queue_url, batch, fifo)
+    by_source = {}
+    for source, line, _, _ in sent.values():
+        by_source.setdefault(source, []).append(line)
+    for source, lines in by_source.items():
+        if sqs_archive.is_archive(source):
+            checkpoint.mark(source, lines)
+        else:
+            os.remove(os.path.join(input_dir, source))
+    return len(sent), [(batch[int(i)][2]['id'], reason) for i, reason in errors.items()]
+
+
+def restore_messages(client, queue_name, input_dir, max_messages, senders=DEFAULT_SENDERS):
+    # Returns a RestoreResult. client needs a connection pool of at least senders connections.
+    queue_url = get_queue_url(client, queue_name)
+    fifo = queue_name.endswith('.fifo')
+    if fifo:
+        # Keep the original order within each message group
+        senders = 1
+    checkpoint = sqs_archive.RestoreCheckpoint(os.path.join(input_dir, RESTORE_CHECKPOINT))
+    file_lines = {}
+    sent = 0
+    failures = []
+
+    def collect(done):
+        count = 0
+        for future in done:
+            batch_sent, batch_failures = future.result()
+            count += batch_sent
+            failures.extend(batch_failures)
+        return count
+
+    with ThreadPoolExecutor(max_workers=senders) as pool:
+        pending = set()
+        records = _restore_records(input_dir, checkpoint, int(max_messages), file_lines)
+        for batch in _pack_batches(records):
+            pending.add(pool.submit(_send_restore_batch, client, queue_url, batch, fifo, input_dir, checkpoint))
+            if len(pending) >= senders * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                before = sent // 1000
+                sent += collect(done)
+                if sent // 1000 != before:
+                    print("Restored {} messages".format(sent))
+        sent += collect(pending)
+
+    # Archives that were sent in full are removed, like the single message files are
+    for filename, lines in file_lines.items():
+        if sqs_archive.is_archive(filename) and checkpoint.done.get(filename) == [[0, lines]]:
+            os.remove(os.path.join(input_dir, filename))
+            checkpoint.done.pop(filename)
+    if not checkpoint.done:
+        checkpoint.remove()
+
+    print("Restored {} messages, {} failed".format(sent, len(failures)))
+    for message_id, reason in failures:
+        print("Failed to restore {}: {}".format(message_id, reason))
+    return RestoreResult(sent, failures)
+
+
+def _move_worker(client, source_url, target_client, target_url, fifo, transform, budget, counts, receive_options):
+    while True:
+        n = budget.take(10)
+        if n == 0:
+            return
+        response = queue_call(client, 'receive_message', source_url, MaxNumberOfMessages=n, WaitTimeSeconds=20,
+                              AttributeNames=['All'], MessageAttributeNames=['All'], **receive_options)
+        messages = response.get('Messages', [])
+        records = []
+        skipped = []
+        for i, message in enumerate(messages):
+            record = sqs_archive.message_record(message)
+            if transform is not None:
+                record = transform(record)
+            if record is not None:
+                records.append((i, None, record))
+            else:
+                skipped.append(message['MessageId'])
+        budget.give_back(n - len(records))
+        if not messages:
+            # A 20 second long poll came back empty, so the queue is drained
+            return
+        with counts['lock']:
+            new_skips = [m for m in skipped if m not in counts['skipped']]
+            counts['skipped'].update(new_skips)
+        if not records and not new_skips:
+            # Only messages skipped before came back, so everything else on the queue has been moved
+            return
+
+        sent = []
+        failures = []
+        for batch in _pack_batches(records):
+            batch_sent, errors = _send_batch(target_client, target_url, batch, fifo)
+            sent.extend(messages[item[0]] for item in batch_sent.values())
+            failures.extend((batch[int(i)][2]['id'], reason) for i, reason in errors.items())
+        # Only what the target accepted is deleted. The rest becomes visible on the source again.
+        deleted = _delete_msg_batch(client, source_url, sent) if sent else 0
+        with counts['lock']:
+            counts['moved'] += len(sent)
+            counts['failures'].extend(failures)
+            counts['delete_failures'] += len(sent) - deleted
+            if counts['moved'] // 1000 != (counts['moved'] - len(sent)) // 1000:
+                print("Moved {} messages".format(counts['moved']))
+
+
+def move_messages(client, source_queue, target_queue, max_messages, workers=DEFAULT_MOVERS, transform=None,
+                  target_client=None, visibility_timeout=None):
+    # Returns a MoveResult. target_client is for a target queue in another region or account and defaults to client.
+    # Messages the transform leaves behind stay hidden on the source for visibility_timeout seconds (the queue's own
+    # setting if None). If they come back while the move is still running they are skipped again, and a worker that
+    # receives nothing but such messages stops. Workers can all move FIFO messages at once: SQS hands
+    # out no more messages of a group while some of it is in flight, so each group keeps its order.
+    target_client = target_client or client
+    source_url = get_queue_url(client, source_queue)
+    target_url = get_queue_url(target_client, target_queue)
+    fifo = target_queue.endswith('.fifo')
+    receive_options = {} if visibility_timeout is None else {'VisibilityTimeout': visibility_timeout}
+    budget = MessageBudget(max_messages)
+    counts = {'moved': 0, 'skipped': set(), 'failures': [], 'delete_failures': 0, 'lock': threading.Lock()}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_move_worker, client, source_url, target_client, target_url, fifo, transform, budget,
+                               counts, receive_options)
+                   for _ in range(workers)]
+        for future in futures:
+            future.result()
+
+    print("Moved {} messages from {} to {}, {} skipped, {} failed, {} could not be deleted from the source".format(
+        counts['moved'], source_queue, target_queue, len(counts['skipped']), len(counts['failures']),
+        counts['delete_failures']))
+    for message_id, reason in counts['failures']:
+        print("Failed to move {}: {}".format(message_id, reason))
+    return MoveResult(counts['moved'], len(counts['skipped']), counts['failures'], counts['delete_failures'])
@@ -0,0 +1,145 @@
+#
+# Syncs a local directory to a bucket and invalidates what changed in CloudFront. s3/S3Sync.py is a thin wrapper
+# around sync() that reads its settings from environment variables; see that script for what each option does.
+#
+# In 'diff' mode only new or changed files are uploaded and only keys with no local file are deleted, and only those
+# paths are invalidated. 'full' mode empties the bucket, uploads everything and invalidates '/*'. Failures that leave
+# the bucket in a state the caller has to know about raise SyncError; keys that could not be deleted in 'diff' mode
+# are only reported in the result, since the old files do no harm.
+#
+#    from boto_scripts import clients, sync
+#    result = sync.sync(clients.factory(role_arn), 'my-bucket', 'project/deploy/', dist_id='E123456')
+#
+
+import collections
+
+from boto_scripts import cloudfront
+from boto_scripts import instrument
+from boto_scripts import s3_assets
+from boto_scripts import s3_listing
+from boto_scripts import s3_util
+
+MODES = ('diff', 'full')
+
+SyncResult = collections.namedtuple('SyncResult', ['uploaded', 'deleted', 'unchanged', 'delete_failures',
+                                                   'invalidation_paths', 'invalidation_ids'])
+
+
+class SyncError(Exception):
+    pass
+
+
+def local_manifest(file_root, rules=None, compress_cache=s3_assets.DEFAULT_COMPRESS_CACHE):
+    with instrument.phase('manifest'):
+        manifest = s3_util.build_local_manifest(file_root)
+    instrument.count('local_files', len(manifest))
+    if rules is not None:
+        with instrument.phase('compress'):
+            manifest = s3_assets.apply_rules(manifest, rules, compress_cache)
+    return manifest
+
+
+def _full_sync(get_bucket, manifest, cache, list_workers, delete_workers, upload_workers):
+    print ('Empty the bucket of all contents')
+    keys = s3_listing.list_bucket(get_bucket, list_workers)
+    with instrument.phase('empty_bucket'):
+        failures = s3_util.delete_keys(get_bucket, (key.name for key in keys), delete_workers)
+    if failures:
+        raise SyncError('Could not empty the bucket, ' + str(len(failures)) + ' keys failed to delete')
+
+    if cache is not None:
+        cache.clear()
+
+    files = [manifest[k] for k in sorted(manifest)]
+    with instrument.phase('upload'):
+        failures = s3_util.upload_files(get_bucket, files, upload_workers)
+    if failures:
+        raise SyncError(str(len(failures)) + ' files failed to upload')
+    return files, [], 0, []
+
+
+def _diff_sync(get_bucket, manifest, cache, list_workers, delete_workers, upload_workers, manifest_max_age):
+    print ('Comparing', len(manifest), 'local files against the bucket')
+    with instrument.phase('list_and_diff'):
+        plan = s3_util.diff_bucket(manifest, s3_listing.list_bucket(get_bucket, list_workers, cache, manifest_max_age))
+    print('Unchanged:', plan.unchanged, 'To upload:', len(plan.uploads), 'To delete:', len(plan.deletes))
+    instrument.count('unchanged_files', plan.unchanged)
+
+    with instrument.phase('upload'):
+        failures = s3_util.upload_files(get_bucket, plan.uploads, upload_workers)
+    if cache is not None:
+        failed = set(f.key for f in failures)
+        for f in plan.uploads:
+            if f.key not in failed:
+                cache.put(f.key, f.size, '"' + f.md5 + '"')
+        cache.commit()
+    if failures:
+        # Leave the orphaned keys alone so the old files are still there for anything that references them
+        raise SyncError(str(len(failures)) + ' files failed to upload')
+
+    with instrument.phase('delete'):
+        failures = s3_util.delete_keys(get_bucket, plan.deletes, delete_workers)
+    failed = set(f.key for f in failures)
+    deleted = [name for name in plan.deletes if name not in failed]
+    if cache is not None:
+        for name in deleted:
+            cache.delete(name)
+    if failures:
+        print('WARNING:', len(failures), 'orphaned keys could not be deleted')
+    return plan.uploads, deleted, plan.unchanged, failures
+
+
+def invalidate(factory, dist_id, paths, wait=False, wait_timeout=cloudfront.DEFAULT_WAIT_TIMEOUT):
+    # Returns the invalidation ids. Raises SyncError if wait is set and they do not complete in time.
+    if not paths:
+        print('Nothing changed, no invalidation needed')
+        return []
+    cf = factory.cloudfront_connection()
+    with instrument.phase('invalidate'):
+        ids = cloudfront.create_invalidations(cf, dist_id, paths)
+    instrument.count('invalidation_paths', len(paths))
+    if wait:
+        with instrument.phase('wait_for_invalidation'):
+            completed = cloudfront.wait_for_invalidations(cf, dist_id, ids, wait_timeout)
+        if not completed:
+            raise SyncError('CloudFront invalidation did not complete in time')
+    return ids
+
+
+def sync(factory, bucket_name, file_root, dist_id=None, mode='diff', delete_workers=s3_util.DEFAULT_DELETE_WORKERS,
+         upload_workers=s3_util.DEFAULT_UPLOAD_WORKERS, list_workers=s3_listing.DEFAULT_LIST_WORKERS,
+         manifest_cache=None, manifest_max_age=s3_listing.DEFAULT_MAX_AGE,
+         collapse_threshold=cloudfront.DEFAULT_COLLAPSE_THRESHOLD, max_paths=cloudfront.DEFAULT_MAX_PATHS,
+         wait=False, asset_rules=None, compress_cache=s3_assets.DEFAULT_COMPRESS_CACHE):
+    # factory is a clients.ClientFactory. manifest_cache and asset_rules are file paths. No invalidation is made
+    # without a dist_id. Returns a SyncResult.
+    if mode not in MODES:
+        raise ValueError('Unknown sync mode ' + mode + ', expected one of ' + ', '.join(MODES))
+    if collapse_threshold < cloudfront.MIN_COLLAPSE_THRESHOLD:
+        # Checked up front so a bad setting fails before anything is uploaded
+        raise ValueError('The collapse threshold must be at least ' + str(cloudfront.MIN_COLLAPSE_THRESHOLD))
+    get_bucket = factory.bucket_getter(bucket_name)
+    rules = s3_assets.load_rules(asset_rules) if asset_rules else None
+    cache = s3_listing.ManifestCache(manifest_cache, bucket_name) if manifest_cache else None
+    try:
+        print ('Building manifest of local files')
+        manifest = local_manifest(file_root, rules, compress_cache)
+        if mode == 'full':
+            uploads, deleted, unchanged, failures = _full_sync(get_bucket, manifest, cache, list_workers,
+                                                               delete_workers, upload_workers)
+        else:
+            uploads, deleted, unchanged, failures = _diff_sync(get_bucket, manifest, cache, list_workers,
+                                                               delete_workers, upload_workers, manifest_max_age)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if mode == 'full':
+        paths = ['/*']
+    else:
+        paths = cloudfront.invalidation_paths([f.key for f in uploads] + deleted, collapse_threshold, max_paths)
+    ids = []
+    if dist_id:
+        print('Invalidate the CloudFront cache')
+        ids = invalidate(factory, dist_id, paths, wait)
+    return SyncResult(len(uploads), len(deleted), unchanged, failures, paths, ids)
@@ -0,0 +1,193 @@
+#
+# Retries and adaptive concurrency for AWS calls, shared by the S3, SQS, Beanstalk and CloudFront code.
+#
+# classify sorts an exception from boto or boto3 into THROTTLED (SlowDown, Throttling, 429...), RETRYABLE (500s,
+# timeouts, dropped connections) or None for errors that retrying will not fix.
+#
+# A Limiter caps how many calls to one service endpoint (an S3 bucket, an SQS queue, a Beanstalk region) are in
+# flight at once and moves the cap the way TCP congestion control does. It starts low and grows by one for every call
+# that succeeds while the cap is in use, which doubles it every round trip, until the first throttle. From then on it
+# grows by about one per round trip, and it halves, at most once per round trip, whenever calls are throttled. When
+# latency_factor is set it also stops growing while the average latency is that many times the best seen, which is
+# often the first sign of a service slowing down before it throttles. The callers' thread pools are sized for the most
+# concurrency wanted and the limiter decides how much of it is used.
+#
+# Limiter.call runs a call under the cap and retries throttled and retryable failures with jittered exponential
+# backoff. A call that is not safe to repeat should pass retry_on=(THROTTLED,): a throttled request was turned away,
+# but a 500 or a lost response can come from a request that was carried out. limiter(service, endpoint) returns the
+# one Limiter for an endpoint, so every pool calling it backs off together. Decisions are counted in the run report
+# (see instrument.py) as limiter.<service>.increase, decrease, held, throttled and retried, and limiter.<service>.peak
+# is the highest cap reached.
+#
+# Calls made through a Limiter should not also be retried by botocore, or the limiter never sees the throttles;
+# clients.ClientFactory turns botocore's retries off for that reason.
+#
+
+import random
+import socket
+import threading
+import time
+
+from boto_scripts import instrument
+
+THROTTLED = 'throttled'
+RETRYABLE = 'retryable'
+RETRY_ALL = (THROTTLED, RETRYABLE)
+
+DEFAULT_RETRIES = 5
+BASE_DELAY = 0.25
+MAX_DELAY = 20
+DEFAULT_INITIAL_LIMIT = 4
+DEFAULT_MAX_LIMIT = 256
+LATENCY_FACTOR = 3.0
+LATENCY_WEIGHT = 0.2  # weight of the newest call in the moving average
+RETRYABLE_STATUS = (500, 502, 503, 504)
+RETRYABLE_CODES = ('InternalError', 'InternalFailure', 'InternalServerError', 'ServiceUnavailable',
+                   'ServiceUnavailableException', 'RequestTimeout', 'RequestTimeoutException')
+# botocore's connection errors, by name so botocore does not have to be imported to recognize them
+CONNECTION_ERRORS = ('EndpointConnectionError', 'ConnectTimeoutError', 'ReadTimeoutError', 'ConnectionClosedError')
+# Long polls take as long as the queue is empty, which says nothing about how loaded the service is
+LONG_POLL_OPERATIONS = ('ReceiveMessage',)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def classify_code(code, status=None):
+    if code in instrument.THROTTLE_CODES or (code or '').endswith('Throttled') or status == 429:
+        return THROTTLED
+    if code in RETRYABLE_CODES or status in RETRYABLE_STATUS:
+        return RETRYABLE
+    return None
+
+
+def classify(e):
+    # boto3 errors carry a response dict, boto errors have status and error_code attributes
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        outcome = classify_code(response.get('Error', {}).get('Code'),
+                                response.get('ResponseMetadata', {}).get('HTTPStatusCode'))
+    else:
+        outcome = classify_code(getattr(e, 'error_code', None), getattr(e, 'status', None))
+    if outcome is None and (isinstance(e, (socket.timeout, ConnectionError)) or
+                            any(c.__name__ in CONNECTION_ERRORS for c in type(e).__mro__)):
+        outcome = RETRYABLE
+    return outcome
+
+
+def backoff_delay(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class Limiter(object):
+    def __init__(self, service, endpoint=None, initial=DEFAULT_INITIAL_LIMIT, maximum=DEFAULT_MAX_LIMIT,
+                 retries=DEFAULT_RETRIES, latency_factor=LATENCY_FACTOR):
+        self.service = service
+        self.endpoint = endpoint
+        self.limit = float(min(initial, maximum))
+        self.maximum = maximum
+        self.retries = retries
+        self.latency_factor = latency_factor
+        self.slow_start = True
+        self.in_flight = 0
+        self.peak = int(self.limit)
+        self.best_latency = None
+        self.latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def _count(self, decision):
+        instrument.count('limiter.' + self.service + '.' + decision)
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def _decrease(self, now):
+        # Calls in flight together are throttled together, so only the first of them counts
+        if now - self._last_decrease < (self.latency or BASE_DELAY):
+            return
+        self._last_decrease = now
+        self.slow_start = False
+        self.limit = max(1.0, self.limit / 2)
+        self._count('decrease')
+
+    def _increase(self, operation, latency):
+        if operation not in LONG_POLL_OPERATIONS:
+            self.latency = latency if self.latency is None else (
+                LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency)
+            self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        if self.in_flight + 1 < int(self.limit) or self.limit >= self.maximum:
+            # The callers are not using all of the current limit, so there is nothing to learn from this call
+            return
+        if (self.latency_factor and self.best_latency and
+                self.latency > self.latency_factor * self.best_latency):
+            self._count('held')
+            return
+        before = int(self.limit)
+        self.limit = min(float(self.maximum), self.limit + (1 if self.slow_start else 1 / self.limit))
+        if int(self.limit) > before:
+            self._count('increase')
+        if int(self.limit) > self.peak:
+            self.peak = int(self.limit)
+            _record_peak(self.service, self.peak)
+
+    def release(self, outcome, operation='', latency=0.0):
+        # outcome is what classify returned for a failed call, or None for a call that succeeded
+        with self._cond:
+            if outcome == THROTTLED:
+                self._decrease(time.time())
+            elif outcome is None:
+                self._increase(operation, latency)
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def call(self, operation, fn, retries=None, retry_on=RETRY_ALL):
+        # Calls fn() under the limit and returns what it returns. Failures classified as one of retry_on are retried
+        # up to retries times (the limiter's own setting if None), after which the last error is raised.
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.time()
+            try:
+                result = fn()
+            except Exception as e:
+                outcome = classify(e)
+                self.release(outcome or 'failed', operation)
+                if outcome == THROTTLED:
+                    self._count('throttled')
+                if outcome not in retry_on or attempt >= retries:
+                    raise
+                instrument.record_retry(self.service, operation)
+                self._count('retried')
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            self.release(None, operation, time.time() - start)
+            return result
+
+
+def _record_peak(service, peak):
+    with _limiters_lock:
+        peak = max([peak] + [l.peak for (s, _), l in _limiters.items() if s == service])
+    instrument.gauge('limiter.' + service + '.peak', peak)
+
+
+def limiter(service, endpoint=None, **kwargs):
+    # Returns the same Limiter for the same service and endpoint for the life of the process. Options only apply when
+    # it is first created.
+    key = (service, endpoint)
+    with _limiters_lock:
+        l = _limiters.get(key)
+        if l is None:
+            l = _limiters[key] = Limiter(service, endpoint, **kwargs)
+        return l
+
+
+def reset():
+    # Forgets every limiter, e.g. between benchmark runs
+    with _limiters_lock:
+        _limiters.clear()
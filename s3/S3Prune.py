@@ -0,0 +1,48 @@
+#
+# Deletes every object under a prefix (or the whole bucket) using batched 1000-key DeleteObjects requests that run
+# concurrently. Keys that fail to delete are listed at the end and the script exits with an error.
+#
+#    bucket_name          : Name of the bucket to delete from.
+#    --prefix             : Only delete keys starting with this prefix. Deletes everything in the bucket if omitted.
+#    --role_arn           : Optional AWS Role ARN to assume. Your default credentials are used if omitted.
+#    --role_sess_name     : Session name for the assumed role. Defaults to 's3prune'.
+#    --workers            : Number of delete requests to run at once. Defaults to 8.
+#    --report             : Optional path of a JSON report of the time taken and AWS calls made. See boto_scripts/instrument.py.
+#
+# Example: python S3Prune.py my-bucket --prefix bundles/old/ --role_arn arn:aws:iam::775678901234:role/MyARN
+#
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import instrument
+from boto_scripts import s3_util
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bucket_name")
+    parser.add_argument("--prefix", help="Only delete keys under this prefix", default="")
+    parser.add_argument("--role_arn", help="AWS Role ARN to assume")
+    parser.add_argument("--role_sess_name", help="Session name for the assumed role", default="s3prune")
+    parser.add_argument("--workers", help="Number of concurrent delete requests", type=int,
+                        default=s3_util.DEFAULT_DELETE_WORKERS)
+    parser.add_argument("--report", help="Write a JSON report of timings and AWS calls to this file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    instrument.start('S3Prune', args.report)
+    get_bucket = clients.factory(args.role_arn or None, args.role_sess_name).bucket_getter(args.bucket_name)
+
+    print("Deleting keys under '{}' in {}".format(args.prefix, args.bucket_name))
+    with instrument.phase('delete'):
+        keys = s3_util.timed_listing(get_bucket().list(prefix=args.prefix))
+        failures = s3_util.delete_keys(get_bucket, (key.name for key in keys), args.workers)
+    if failures:
+        sys.exit("{} keys could not be deleted".format(len(failures)))
+    print("Done!")
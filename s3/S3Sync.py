@@ -3,71 +3,79 @@
 # upload objects from a file path, and invalidate a given CloudFront cache. The following env variables are required from Jenkins:
 #    
 #    ROLE_ARN - AWS Role ARN for the role you want to assume.
-#    ROLE_SESS_NAME - You will give the assumed role a unique session name - can be anything. 
+#    ROLE_SESS_NAME - You will give the assumed role a unique session name - can be anything. Credentials for the role are
+#                     cached and shared with the other scripts until shortly before they expire.
 #    WORKSPACE - The Jenkins workspace name. This will be where the deployment files are found. Jenkins injects this variable by default in every job.
 #    BUCKET_NAME - Name of the bucket you are deleting from/uploading to.
-#    CF_DIST_ID - AWS CloudFront distribution ID. Used to invalidate the CloudFront distribution cache.
+#    CF_DIST_ID - AWS CloudFront distribution ID. Used to invalidate the CloudFront distribution cache. Only the paths the
+#                 sync uploaded or deleted are invalidated (everything in 'full' mode).
+#    CF_COLLAPSE_THRESHOLD - Optional. A directory with at least this many changed files is invalidated as '/dir/*'. Defaults to 10.
+#    CF_MAX_PATHS - Optional. Directories are collapsed into wildcards until there are at most this many paths. Defaults to 1000.
+#    CF_WAIT - Optional. If 'true', wait for the invalidation to complete before exiting.
+#    ASSET_RULES - Optional. JSON file of per-pattern Cache-Control, Content-Type and gzip/brotli compression rules. See
+#                  boto_scripts/s3_assets.py for the format.
+#    COMPRESS_CACHE - Optional. Directory where compressed files are kept between runs. Defaults to ~/.cache/boto-scripts/compressed.
+#    SYNC_MODE - Optional. 'diff' (default) only uploads new or changed files and deletes keys that no longer exist
+#                locally. 'full' empties the bucket and uploads everything like older versions of this script did.
+#    DELETE_WORKERS - Optional. Number of 1000-key delete requests to run at once. Defaults to 8.
+#    UPLOAD_WORKERS - Optional. Number of files to upload at once. Defaults to 16.
+#    LIST_WORKERS - Optional. Number of top level prefixes of the bucket to list at once. Defaults to 8.
+#    MANIFEST_CACHE - Optional. Path of a sqlite file that caches the bucket listing between runs. Prefixes listed less
+#                     than MANIFEST_MAX_AGE seconds (default 3600) ago are read from it instead of S3.
+#    RUN_REPORT, STATSD_HOST, PROM_TEXTFILE - Optional. Where to write timings of each step and AWS call. See
+#                                             boto_scripts/instrument.py.
 # 
+# The work is done by boto_scripts/sync.py, which can also be imported and called directly.
+#
 # KEHOEJO - 9/2015
 #
 
 import os
-from io import StringIO
-import hashlib
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import cloudfront
+from boto_scripts import instrument
+from boto_scripts import s3_assets
+from boto_scripts import s3_listing
+from boto_scripts import s3_util
+from boto_scripts import sync
 
-import boto
-from boto.sts import STSConnection
-from boto.s3.connection import S3Connection
-
-print ('Assuming role to access S3 on a different account')
-ROLE_ARN = os.environ['ROLE_ARN']
-ROLE_SESS_NAME = os.environ['ROLE_SESS_NAME']
-FILE_ROOT = os.environ['WORKSPACE'] + '/project/deploy/'
-BUCKET_PARAM = os.environ['BUCKET_NAME']
-CF_DIST_ID = os.environ['CF_DIST_ID']
-
-sts_connection = STSConnection()
-assumedRoleObject = sts_connection.assume_role(
-    role_arn=ROLE_ARN,
-    role_session_name=ROLE_SESS_NAME
-)
-
-ACCESS_KEY = assumedRoleObject.credentials.access_key
-SECRET_KEY = assumedRoleObject.credentials.secret_key
-TOKEN = assumedRoleObject.credentials.session_token
-
-# Use the temporary credentials returned by AssumeRole to call Amazon S3
-connection = S3Connection(
-    aws_access_key_id=ACCESS_KEY,
-    aws_secret_access_key=SECRET_KEY,
-    security_token=TOKEN,
-    calling_format=boto.s3.connection.OrdinaryCallingFormat()
-)
 
-print('File Root: ', FILE_ROOT)
-print('Bucket Name ', BUCKET_PARAM)
-bucket = connection.get_bucket(BUCKET_PARAM, validate=False)
+def main():
+    print ('Assuming role to access S3 on a different account')
+    ROLE_ARN = os.environ['ROLE_ARN']
+    ROLE_SESS_NAME = os.environ['ROLE_SESS_NAME']
+    FILE_ROOT = os.environ['WORKSPACE'] + '/project/deploy/'
+    BUCKET_PARAM = os.environ['BUCKET_NAME']
+    CF_DIST_ID = os.environ['CF_DIST_ID']
+    SYNC_MODE = os.environ.get('SYNC_MODE', 'diff').lower()
+    DELETE_WORKERS = int(os.environ.get('DELETE_WORKERS', s3_util.DEFAULT_DELETE_WORKERS))
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', s3_util.DEFAULT_UPLOAD_WORKERS))
+    LIST_WORKERS = int(os.environ.get('LIST_WORKERS', s3_listing.DEFAULT_LIST_WORKERS))
+    MANIFEST_CACHE = os.environ.get('MANIFEST_CACHE', '')
+    MANIFEST_MAX_AGE = int(os.environ.get('MANIFEST_MAX_AGE', s3_listing.DEFAULT_MAX_AGE))
+    CF_COLLAPSE_THRESHOLD = int(os.environ.get('CF_COLLAPSE_THRESHOLD', cloudfront.DEFAULT_COLLAPSE_THRESHOLD))
+    CF_MAX_PATHS = int(os.environ.get('CF_MAX_PATHS', cloudfront.DEFAULT_MAX_PATHS))
+    CF_WAIT = os.environ.get('CF_WAIT', 'false').lower() == 'true'
+    ASSET_RULES = os.environ.get('ASSET_RULES', '')
+    COMPRESS_CACHE = os.environ.get('COMPRESS_CACHE', s3_assets.DEFAULT_COMPRESS_CACHE)
 
-print ('Empty the bucket of all contents')
-for key in bucket.list():
-    key.delete()
+    instrument.start('S3Sync')
+    factory = clients.factory(ROLE_ARN, ROLE_SESS_NAME)
+    with instrument.phase('assume_role'):
+        factory.credentials()
 
-fn = ''
-for (root, dirs, files) in os.walk(FILE_ROOT):
-   for name in files:
-       fn = os.path.join(root, name)
-       k = boto.s3.key.Key(bucket)
-       keyPath = fn.replace(FILE_ROOT,"")
-       keyPath = keyPath.replace("\\","/")
-       print('KeyPath ', keyPath)
-       k.key = keyPath
-       print ('Uploading ', keyPath, ' to ',  BUCKET_PARAM)
-       k.set_contents_from_filename(fn, policy='public-read')
+    print('File Root: ', FILE_ROOT)
+    print('Bucket Name ', BUCKET_PARAM)
+    try:
+        sync.sync(factory, BUCKET_PARAM, FILE_ROOT, CF_DIST_ID, SYNC_MODE, DELETE_WORKERS, UPLOAD_WORKERS,
+                  LIST_WORKERS, MANIFEST_CACHE or None, MANIFEST_MAX_AGE, CF_COLLAPSE_THRESHOLD, CF_MAX_PATHS,
+                  CF_WAIT, ASSET_RULES or None, COMPRESS_CACHE)
+    except sync.SyncError as e:
+        sys.exit(str(e))
 
-print('Invalidate the CloudFront cache')
 
-cf = boto.connect_cloudfront(ACCESS_KEY, SECRET_KEY, security_token=TOKEN)
-files = ['/bundles/modules.js','/bundles/modules.min.js','/bundles/pioneer.min.css','/bundles/thirdparty.min.js','/bundles/thirdparty.min.css','/bundles/pioneer.js','/bundles/templates.js','/bundles/pioneer.min.js']
-cf.create_invalidation_request(CF_DIST_ID, files)
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,49 @@
-import boto3
 import argparse
 import base64
+import importlib
 import uuid
 import os
+import sys
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import clients
+from boto_scripts import instrument
+from boto_scripts import sqs_archive
+from boto_scripts import sqs_inspect
+from boto_scripts import sqs_ops
+from boto_scripts import throttle
+
+MAX_PAYLOAD_BYTES = 256 * 1024
 
 #
 # This utility can be used in the following ways.
-# 1. Generate random messages on a SQS queue.
+# 1. Generate random messages on a SQS queue. This doubles as a load generator: messages are sent in batches of 10
+#    by several producers at a target rate, with a configurable body size distribution, message attributes and FIFO
+#    message groups, and the throughput and send latency are reported as it runs.
 # 2. Pull a specified amount of messages (or all messages) from a queue and save off the message body and attributes
 #    in a text file.
 # 3. Restore messages from the text files back as new SQS messages onto the same queue, or a different queue.
+#    Messages are streamed from the saved files or mode A archives and sent 10 at a time with send_message_batch from
+#    several threads, keeping their message attributes. Progress through archive files is recorded in a checkpoint
+#    file in the input directory, so restoring again after a crash skips what was already sent. Single message files
+#    are deleted once sent, as are archives once every message in them was sent.
+# 4. Drain messages at high throughput into line-delimited archive files (mode A). Several receivers long poll the
+#    queue at once, every received batch is appended to the archive and fsync'd, and only then removed from the queue
+#    with a single delete_message_batch call. Archives can be gzip compressed and are rotated by size.
+# 5. Move messages straight from one queue to another (mode M), e.g. to redrive a dead letter queue into its source
+#    queue, without writing them to disk. Several workers receive from the queue, send each batch to --target_queue
+#    with its message attributes and only then delete it from the source, so no message is lost. --transform names a
+#    function, as module:function, that is given each message as an archive record and returns the record to send
+#    (it may change it) or None to leave the message on the source queue.
+# 6. Inspect a queue without removing anything from it (mode I), e.g. to triage a dead letter queue that is in use.
+#    Several receivers scan the queue, keeping what they receive hidden, and print counts per message attribute value
+#    and histograms of body size, receive count and age. With --filter, the messages matching it are written to
+#    archive files in the path directory. Every message is made visible again when the scan ends.
 # Usage:
 # To run locally, you can run from the IDE or by running python from the command line or bash window. It is assumed
 # that you have valid AWS API credentials in your .aws directory and your user/role has list/retrieve/delete SQS
@@ -20,12 +53,22 @@ import json
 #    1. The SQS queue name to process from or to. The queue must exist in your AWS account.
 #    2. The number of random SQS messages to generate. This parameter is not considered if the mode parameter is not
 #       'G'.
-#    3. The number of messages to process (save or restore). This parameter is only used if mode is 'S' or 'R'. To
-#       process all messages, put in 'ALL'.
+#    3. The number of messages to process (save, restore or move). This parameter is only used if mode is 'S', 'R',
+#       'A' or 'M'. To process all messages, put in 'ALL'.
 #    4. The path to your input or output directory. This parameter is only used if mode is 'S' or 'R'. Make sure
 #       to take consideration which OS you are running this on. For best results, use a directory that already exists.
 #       The script will attempt to create the directory if it does not exist, but it will not work if the directory is
 #       nested.
+#    5. --receivers, --compress and --rotate_mb tune mode A: the number of concurrent receivers, whether to gzip the
+#       archive files and the size at which a new archive file is started. --senders sets how many batches mode R
+#       sends at once (always 1 for FIFO queues, to keep message order).
+#    6. --rate, --producers, --payload_min, --payload_max, --payload_dist, --msg_attributes, --fifo_groups and
+#       --report_interval control the load generated by mode G.
+#    7. --target_queue, --target_region, --movers, --transform and --visibility_timeout control mode M. The path
+#       parameter is not used by mode M.
+#    8. --filter, --time_limit, --top, --receivers and --visibility_timeout control mode I. See
+#       boto_scripts/sqs_inspect.py for the filter syntax, e.g. "attr.customer = acme and receive_count >= 3".
+#    9. --report writes a JSON report of the time taken and the SQS calls made. See boto_scripts/instrument.py.
 #
 #
 
@@ -36,60 +79,220 @@ def _parse_args():
     parser.add_argument("gen_random_msgs", help="Generate random sqs messages. 0 for none.")
     parser.add_argument("num_msgs", help="Number of messages to save or restore (depending on mode). Use 'ALL' for all.")
     parser.add_argument("mode", help="S = Poll and save messages to disk. "
+                                     "A = Poll and append messages to archive files on disk. "
                                      "R = Restore from disk to SQS. "
+                                     "M = Move messages to --target_queue. "
+                                     "I = Inspect messages without deleting them. "
                                      "G = Generate random messages.")
     parser.add_argument("path", help="OS Specific input or output path")
     parser.add_argument("--region", help="The AWS region to use", default="us-east-1")
     parser.add_argument("--verbosity", help="increase output verbosity")
+    parser.add_argument("--receivers", help="Number of concurrent receivers for mode A and I. Defaults to {} for A "
+                                            "and {} for I".format(sqs_ops.DEFAULT_RECEIVERS,
+                                                                  sqs_inspect.DEFAULT_RECEIVERS), type=int)
+    parser.add_argument("--rate", help="Mode G: target messages per second, 0 for as fast as possible", type=float,
+                        default=0)
+    parser.add_argument("--producers", help="Mode G: number of concurrent producers", type=int, default=4)
+    parser.add_argument("--payload_min", help="Mode G: smallest message body in bytes", type=int, default=64)
+    parser.add_argument("--payload_max", help="Mode G: largest message body in bytes, at most {}".format(
+        MAX_PAYLOAD_BYTES), type=int, default=1024)
+    parser.add_argument("--payload_dist", help="Mode G: body size distribution", default="uniform",
+                        choices=["uniform", "exponential", "fixed"])
+    parser.add_argument("--msg_attributes", help="Mode G: message attributes to add, as name=value,name=value")
+    parser.add_argument("--fifo_groups", help="Mode G: number of message groups to spread FIFO messages over",
+                        type=int, default=0)
+    parser.add_argument("--report_interval", help="Mode G: seconds between throughput reports", type=int, default=5)
+    parser.add_argument("--senders", help="Number of concurrent senders for mode R", type=int,
+                        default=sqs_ops.DEFAULT_SENDERS)
+    parser.add_argument("--compress", help="gzip the archive files written by mode A", action="store_true")
+    parser.add_argument("--rotate_mb", help="Start a new archive file after this many MB", type=int,
+                        default=sqs_archive.DEFAULT_ROTATE_BYTES // (1024 * 1024))
+    parser.add_argument("--target_queue", help="Mode M: queue to move the messages to")
+    parser.add_argument("--target_region", help="Mode M: region of the target queue. Defaults to --region")
+    parser.add_argument("--movers", help="Mode M: number of concurrent workers", type=int,
+                        default=sqs_ops.DEFAULT_MOVERS)
+    parser.add_argument("--transform", help="Mode M: module:function to filter or change each message")
+    parser.add_argument("--visibility_timeout", help="Mode M: seconds that messages left behind by --transform stay "
+                                                     "hidden. Defaults to the queue's setting. Mode I: seconds that "
+                                                     "messages stay hidden while the scan runs, at least "
+                                                     "--time_limit. Defaults to --time_limit plus {}".format(
+                                                         sqs_inspect.VISIBILITY_MARGIN), type=int)
+    parser.add_argument("--filter", help="Mode I: export the messages matching this expression to the path directory")
+    parser.add_argument("--time_limit", help="Mode I: stop scanning after this many seconds", type=int,
+                        default=sqs_inspect.DEFAULT_TIME_LIMIT)
+    parser.add_argument("--top", help="Mode I: number of most common values shown per attribute", type=int,
+                        default=10)
+    parser.add_argument("--report", help="Write a JSON report of timings and SQS calls to this file")
     args = parser.parse_args()
     verbose = False
     if args.verbosity:
-        print "Verbosity turned on"
+        print("Verbosity turned on")
         verbose = True
-    return args.sqs_queue_name, args.gen_random_msgs, args.num_msgs, args.mode, args.path, args.region, verbose
+    return args, verbose
 
 
-def _put_random_msgs_on_queue(queue_name, msgs_to_generate, aws_region):
-    sqs = boto3.resource('sqs', region_name=aws_region)
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    for x in range(int(msgs_to_generate)):
-        rnd_uuid = uuid.uuid4()
-        response = queue.send_message(MessageBody=base64.encodestring('Hello World {}'.format(str(rnd_uuid))))
-        print("Added {}".format(response.get('MessageId')))
+def _sqs_client(aws_region, workers):
+    # One client shared by all the worker threads, with a connection for each of them and some to spare
+    return clients.factory(region=aws_region).client('sqs', pool_size=workers * 2)
 
 
-def _put_messages_back_on_sqs(queue_name, num_msgs_to_restore, input_dir, aws_region):
-    sqs = boto3.resource('sqs', region_name=aws_region)
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    dir_files = os.listdir(input_dir)
-    dir_files.sort()
-    counter = 0
-    for filename in dir_files:
-        with open(os.path.join(input_dir, filename)) as f:
-            try:
-                msg = json.load(f)
-                queue.send_message(MessageBody=msg['body'])
-                print("Sent message: {}".format(filename))
-            except:
-                print("Something bad happened. Exiting.")
-                exit(1)
-        os.remove(os.path.join(input_dir, filename))
-        counter = counter + 1
-        if counter >= int(num_msgs_to_restore):
-            print ("Number of messages met. Exiting.")
-            break
+class _RateLimiter(object):
+    # Token bucket shared by all producers. A rate of 0 means no limit.
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = 0.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, n):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait_for = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+class _LoadStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.sent = 0
+        self.failed = 0
+        self.bytes = 0
+        self.latencies = []
+        self.interval_sent = 0
+        self.interval_latencies = []
+        self.interval_start = self.start
+
+    def record(self, sent, failed, size, latency):
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+            self.bytes += size
+            self.latencies.append(latency)
+            self.interval_sent += sent
+            self.interval_latencies.append(latency)
+
+    @staticmethod
+    def _percentile(values, pct):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+    def report(self, final=False):
+        with self.lock:
+            now = time.time()
+            if final:
+                elapsed, sent, latencies = now - self.start, self.sent, self.latencies
+            else:
+                elapsed, sent, latencies = now - self.interval_start, self.interval_sent, self.interval_latencies
+                self.interval_start, self.interval_sent, self.interval_latencies = now, 0, []
+            print("{}{} msgs/s, batch latency p50 {:.0f}ms p99 {:.0f}ms, {} sent, {} failed".format(
+                "TOTAL: " if final else "", int(sent / elapsed) if elapsed > 0 else 0,
+                self._percentile(latencies, 50) * 1000, self._percentile(latencies, 99) * 1000,
+                self.sent, self.failed))
+
+
+def _payload_size(dist, min_size, max_size):
+    if dist == 'fixed':
+        return max_size
+    if dist == 'exponential':
+        # Mostly small messages with a long tail, which is what real traffic tends to look like
+        return min(max_size, min_size + int(random.expovariate(3.0 / max(1, max_size - min_size))))
+    return random.randint(min_size, max_size)
+
+
+def _load_producer(client, queue_url, remaining, limiter, stats, options):
+    filler = options['filler']
+    while True:
+        n = remaining.take(10)
+        if n == 0:
+            return
+        entries = []
+        size = 0
+        for i in range(n):
+            msg_id = str(uuid.uuid4())
+            length = max(0, _payload_size(options['dist'], options['min_size'], options['max_size']) - len(msg_id))
+            offset = random.randint(0, len(filler) - length)
+            body = msg_id + filler[offset:offset + length]
+            if entries and size + len(body) > sqs_ops.MAX_BATCH_BYTES:
+                remaining.give_back(n - i)
+                break
+            entry = {'Id': str(i), 'MessageBody': body}
+            if options['attributes']:
+                entry['MessageAttributes'] = options['attributes']
+            if options['fifo_groups']:
+                entry['MessageGroupId'] = 'load-{}'.format(random.randint(1, options['fifo_groups']))
+                entry['MessageDeduplicationId'] = msg_id
+            entries.append(entry)
+            size += len(body)
+        limiter.acquire(len(entries))
+        start = time.time()
+        try:
+            response = sqs_ops.queue_call(client, 'send_message_batch', queue_url, Entries=entries)
+            failed = len(response.get('Failed', []))
+        except Exception as e:
+            print("send_message_batch failed: {}".format(e))
+            failed = len(entries)
+        stats.record(len(entries) - failed, failed, size, time.time() - start)
+
+
+def _parse_msg_attributes(spec):
+    attributes = {}
+    for pair in (spec or '').split(','):
+        if '=' in pair:
+            name, value = pair.split('=', 1)
+            attributes[name.strip()] = {'DataType': 'String', 'StringValue': value.strip()}
+    return attributes
+
+
+def _put_random_msgs_on_queue(queue_name, msgs_to_generate, aws_region, rate=0, producers=4, min_size=64,
+                              max_size=1024, dist='uniform', attributes=None, fifo_groups=0, report_interval=5):
+    client = _sqs_client(aws_region, producers)
+    queue_url = sqs_ops.get_queue_url(client, queue_name)
+    if queue_name.endswith('.fifo') and not fifo_groups:
+        fifo_groups = 1
+    options = {
+        'filler': base64.b64encode(os.urandom(MAX_PAYLOAD_BYTES)).decode('ascii')[:MAX_PAYLOAD_BYTES],
+        'dist': dist,
+        'min_size': min_size,
+        'max_size': min(max_size, MAX_PAYLOAD_BYTES),
+        'attributes': _parse_msg_attributes(attributes),
+        'fifo_groups': fifo_groups
+    }
+    remaining = sqs_ops.MessageBudget(msgs_to_generate)
+    limiter = _RateLimiter(rate)
+    stats = _LoadStats()
+    with ThreadPoolExecutor(max_workers=producers) as pool:
+        futures = [pool.submit(_load_producer, client, queue_url, remaining, limiter, stats, options)
+                   for _ in range(producers)]
+        while not all(f.done() for f in futures):
+            wait(futures, timeout=report_interval)
+            stats.report()
+        for f in futures:
+            f.result()
+    stats.report(final=True)
 
 
 def _poll_sqs_and_save_msgs(queue_name, num_msgs_to_save, output_dir, aws_region):
-    sqs = boto3.resource('sqs', region_name=aws_region)
+    sqs = clients.factory(region=aws_region).session().resource('sqs')
+    instrument.instrument_client(sqs.meta.client)
     queue = sqs.get_queue_by_name(QueueName=queue_name)
+    limiter = throttle.limiter('sqs', queue.url)
     counter = 0
     while True:
         if counter >= int(num_msgs_to_save):
             print ("Number of messages met. Exiting.")
             break
 
-        messages = queue.receive_messages(MaxNumberOfMessages=10, AttributeNames=['All'])
+        messages = limiter.call('ReceiveMessage', lambda: queue.receive_messages(MaxNumberOfMessages=10,
+                                                                                 AttributeNames=['All']))
         if len(messages) == 0:
             break
 
@@ -100,19 +303,59 @@ def _poll_sqs_and_save_msgs(queue_name, num_msgs_to_save, output_dir, aws_region
             print("Writing file to disk {}".format(message.message_id))
             with open(filename, 'w') as f:
                 json.dump(obj, f, indent=2)
-            message.delete()
+            limiter.call('DeleteMessage', message.delete)
             if counter >= int(num_msgs_to_save):
                 break
 
 
+def _put_messages_back_on_sqs(queue_name, num_msgs_to_restore, input_dir, aws_region, senders=8):
+    result = sqs_ops.restore_messages(_sqs_client(aws_region, senders), queue_name, input_dir, num_msgs_to_restore,
+                                      senders)
+    return not result.failures
+
+
+def _load_transform(spec):
+    # spec is module:function, with the module importable from the current directory or PYTHONPATH
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise ValueError("--transform must be given as module:function, not " + spec)
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _move_msgs(queue_name, target_queue, num_msgs_to_move, aws_region, target_region, movers, transform=None,
+               visibility_timeout=None):
+    client = _sqs_client(aws_region, movers)
+    target_client = _sqs_client(target_region, movers) if target_region and target_region != aws_region else client
+    result = sqs_ops.move_messages(client, queue_name, target_queue, num_msgs_to_move, movers, transform,
+                                   target_client, visibility_timeout)
+    return not result.failures
+
+
+def _inspect_msgs(queue_name, num_msgs_to_inspect, output_dir, aws_region, receivers, filter_expression,
+                  visibility_timeout, time_limit, top):
+    result = sqs_inspect.inspect_queue(_sqs_client(aws_region, receivers), queue_name, num_msgs_to_inspect,
+                                       receivers, filter_expression, output_dir, visibility_timeout, time_limit)
+    result.stats.print_summary(top)
+
+
+def _poll_sqs_and_archive_msgs(queue_name, num_msgs_to_save, output_dir, aws_region, receivers, compress,
+                               rotate_bytes):
+    sqs_ops.archive_messages(_sqs_client(aws_region, receivers), queue_name, output_dir, num_msgs_to_save, receivers,
+                             compress, rotate_bytes)
+
+
 if __name__ == '__main__':
-    sqs_queue, random_msgs_to_generate, num_msgs, mode, path, region, verbosity = _parse_args()
+    args, verbosity = _parse_args()
+    sqs_queue, random_msgs_to_generate, num_msgs, mode, path, region = (
+        args.sqs_queue_name, args.gen_random_msgs, args.num_msgs, args.mode, args.path, args.region)
+    instrument.start('sqs_util-' + mode, args.report)
 
     if num_msgs == "ALL":
         num_msgs = 1000000
 
-    if (mode == "S" or mode == "R") and not os.path.isdir(path):
-        print "Message directory does not exist. Creating."
+    if (mode == "S" or mode == "R" or mode == "A" or (mode == "I" and args.filter)) and not os.path.isdir(path):
+        print("Message directory does not exist. Creating.")
         try:
             os.mkdir(path)
         except OSError:
@@ -121,16 +364,52 @@ if __name__ == '__main__':
             print("Successfully created the output directory")
 
     if int(random_msgs_to_generate) > 0 and mode == "G":
-        print "Put random messages on queue: {}".format(sqs_queue)
-        _put_random_msgs_on_queue(sqs_queue, random_msgs_to_generate, region)
+        if not 0 <= args.payload_min <= args.payload_max <= MAX_PAYLOAD_BYTES:
+            sys.exit("Critical Error: --payload_min and --payload_max must be 0 <= min <= max <= {} bytes, "
+                     "not {} and {}".format(MAX_PAYLOAD_BYTES, args.payload_min, args.payload_max))
+        print("Put random messages on queue: {}".format(sqs_queue))
+        with instrument.phase('generate'):
+            _put_random_msgs_on_queue(sqs_queue, random_msgs_to_generate, region, args.rate, args.producers,
+                                      args.payload_min, args.payload_max, args.payload_dist, args.msg_attributes,
+                                      args.fifo_groups, args.report_interval)
 
-    if int(num_msgs > 0) and mode == "S":
-        print "Polling SQS queue and saving to disk: {}".format(sqs_queue)
-        _poll_sqs_and_save_msgs(sqs_queue, num_msgs, path, region)
+    if int(num_msgs) > 0 and mode == "S":
+        print("Polling SQS queue and saving to disk: {}".format(sqs_queue))
+        with instrument.phase('save'):
+            _poll_sqs_and_save_msgs(sqs_queue, num_msgs, path, region)
 
-    if int(num_msgs > 0) and mode == "R":
-        print "Restoring messages from disk to queue: {}".format(sqs_queue)
-        _put_messages_back_on_sqs(sqs_queue, num_msgs, path, region)
+    if int(num_msgs) > 0 and mode == "R":
+        print("Restoring messages from disk to queue: {}".format(sqs_queue))
+        with instrument.phase('restore'):
+            restored = _put_messages_back_on_sqs(sqs_queue, num_msgs, path, region, args.senders)
+        if not restored:
+            exit(1)
+
+    if int(num_msgs) > 0 and mode == "M":
+        if not args.target_queue:
+            sys.exit("Mode M needs --target_queue")
+        transform = _load_transform(args.transform) if args.transform else None
+        print("Moving messages from {} to {}".format(sqs_queue, args.target_queue))
+        with instrument.phase('move'):
+            moved = _move_msgs(sqs_queue, args.target_queue, num_msgs, region, args.target_region, args.movers,
+                               transform, args.visibility_timeout)
+        if not moved:
+            exit(1)
+
+    if int(num_msgs) > 0 and mode == "A":
+        print("Draining SQS queue into archive files: {}".format(sqs_queue))
+        with instrument.phase('archive'):
+            _poll_sqs_and_archive_msgs(sqs_queue, num_msgs, path, region, args.receivers or sqs_ops.DEFAULT_RECEIVERS,
+                                       args.compress, args.rotate_mb * 1024 * 1024)
+
+    if int(num_msgs) > 0 and mode == "I":
+        print("Inspecting SQS queue: {}".format(sqs_queue))
+        try:
+            with instrument.phase('inspect'):
+                _inspect_msgs(sqs_queue, num_msgs, path, region, args.receivers or sqs_inspect.DEFAULT_RECEIVERS,
+                              args.filter, args.visibility_timeout, args.time_limit, args.top)
+        except ValueError as e:
+            sys.exit("Critical Error: " + str(e))
 
-    print "Done!"
+    print("Done!")
     exit(0)
@@ -0,0 +1,68 @@
+#
+# Tests for the invalidation path planning in boto_scripts/cloudfront.py. Run with python -m unittest discover tests
+# from the repository root.
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import cloudfront
+
+
+class InvalidationPathsTest(unittest.TestCase):
+    def test_no_keys(self):
+        self.assertEqual(cloudfront.invalidation_paths([]), [])
+
+    def test_few_changes_are_listed_one_by_one(self):
+        self.assertEqual(cloudfront.invalidation_paths(['a.js', 'css/b.css']), ['/a.js', '/css/b.css'])
+
+    def test_crowded_directory_becomes_wildcard(self):
+        keys = ['js/{}.js'.format(i) for i in range(10)] + ['index.html']
+        self.assertEqual(cloudfront.invalidation_paths(keys, 10), ['/index.html', '/js/*'])
+
+    def test_threshold_below_two_is_rejected(self):
+        for threshold in (1, 0, -1):
+            with self.assertRaises(ValueError):
+                cloudfront.invalidation_paths(['a.js', 'b.js'], threshold)
+
+    def test_crowded_root_is_not_collapsed(self):
+        self.assertEqual(cloudfront.invalidation_paths(['a.js', 'b.js'], 2), ['/a.js', '/b.js'])
+
+    def test_many_collapsed_top_level_directories_are_not_collapsed(self):
+        keys = ['d{}/{}.js'.format(d, i) for d in range(12) for i in range(10)]
+        self.assertEqual(cloudfront.invalidation_paths(keys), sorted('/d{}/*'.format(d) for d in range(12)))
+
+    def test_root_ends_at_everything_only_when_max_paths_forces_it(self):
+        keys = ['{}.js'.format(i) for i in range(5)]
+        self.assertEqual(cloudfront.invalidation_paths(keys, 10, 5), sorted('/' + k for k in keys))
+        self.assertEqual(cloudfront.invalidation_paths(keys, 10, 4), ['/*'])
+
+    def test_root_ends_at_everything_when_the_wildcard_limit_forces_it(self):
+        keys = ['d{}/{}.js'.format(d, i) for d in range(cloudfront.MAX_WILDCARD_PATHS + 1) for i in range(10)]
+        self.assertEqual(cloudfront.invalidation_paths(keys), ['/*'])
+
+    def test_wildcards_are_capped(self):
+        # 40 directories with enough changes each to become '/dN/x/*'
+        keys = ['d{}/x/{}.js'.format(d, i) for d in range(40) for i in range(10)]
+        paths = cloudfront.invalidation_paths(keys)
+        wildcards = [p for p in paths if p.endswith('*')]
+        self.assertLessEqual(len(wildcards), cloudfront.MAX_WILDCARD_PATHS)
+        for key in keys:
+            self.assertTrue(any(p == '/' + key or (p.endswith('*') and ('/' + key).startswith(p[:-1]))
+                                for p in paths), key)
+
+    def test_wildcards_merge_under_a_shared_parent(self):
+        keys = ['app/m{}/x/{}.js'.format(d, i) for d in range(20) for i in range(10)] + ['index.html']
+        self.assertEqual(cloudfront.invalidation_paths(keys), ['/app/*', '/index.html'])
+
+    def test_max_paths_is_capped_at_the_cloudfront_limit(self):
+        keys = ['d{}/{}.js'.format(d, i) for d in range(1000) for i in range(5)]
+        paths = cloudfront.invalidation_paths(keys, 10, 10000)
+        self.assertLessEqual(len(paths), cloudfront.MAX_FILE_PATHS)
+        self.assertLessEqual(len([p for p in paths if p.endswith('*')]), cloudfront.MAX_WILDCARD_PATHS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#
+# Tests for following Beanstalk events in boto_scripts/eb_util.py, against a stub client that pages like
+# describe_events.
+#
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import eb_util
+from boto_scripts import throttle
+
+PAGE_SIZE = 5
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class StubMeta(object):
+    region_name = 'test-region'
+
+
+class StubEventsClient(object):
+    meta = StubMeta()
+
+    def __init__(self):
+        self.events = []
+        self.calls = []
+
+    def add(self, count):
+        for _ in range(count):
+            n = len(self.events)
+            self.events.append({'EventDate': START + datetime.timedelta(seconds=n), 'ApplicationName': 'app',
+                                'EnvironmentName': 'env', 'Severity': 'INFO', 'Message': 'event {}'.format(n)})
+
+    def describe_events(self, ApplicationName, EnvironmentName=None, StartTime=None, MaxRecords=None,
+                        NextToken=None):
+        self.calls.append(NextToken)
+        # Newest first, like the service
+        events = [e for e in reversed(self.events) if StartTime is None or e['EventDate'] >= StartTime]
+        start = int(NextToken or 0)
+        end = start + min(MaxRecords or PAGE_SIZE, PAGE_SIZE)
+        response = {'Events': events[start:end]}
+        if end < len(events):
+            response['NextToken'] = str(end)
+        return response
+
+
+class EventFollowerTest(unittest.TestCase):
+    def setUp(self):
+        throttle.reset()
+        self.client = StubEventsClient()
+        self.follower = eb_util.EventFollower(self.client, 'app')
+
+    def messages(self, events):
+        return [e['Message'] for e in events]
+
+    def test_first_poll_shows_only_the_latest_events(self):
+        self.client.add(20)
+        shown = self.follower.poll()
+        self.assertEqual(self.messages(shown), ['event {}'.format(n) for n in range(15, 20)])
+        self.assertEqual(self.client.calls, [None])
+
+    def test_every_page_of_new_events_is_read(self):
+        self.client.add(3)
+        self.follower.poll()
+        self.client.add(12)
+        shown = self.follower.poll()
+        self.assertEqual(self.messages(shown), ['event {}'.format(n) for n in range(3, 15)])
+        self.assertEqual(self.follower.since, START + datetime.timedelta(seconds=14))
+
+    def test_events_are_not_shown_twice(self):
+        self.client.add(3)
+        self.follower.poll()
+        self.assertEqual(self.follower.poll(), [])
+        self.client.add(1)
+        self.assertEqual(self.messages(self.follower.poll()), ['event 3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
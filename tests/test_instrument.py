@@ -0,0 +1,52 @@
+#
+# Tests for the botocore event handlers in boto_scripts/instrument.py. The client test needs botocore and is skipped
+# without it.
+#
+
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import instrument
+
+try:
+    import botocore.session
+    from botocore.config import Config
+except ImportError:
+    botocore = None
+
+
+def _dead_port():
+    # A port nothing listens on: bind one, then close it
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class InstrumentClientTest(unittest.TestCase):
+    def setUp(self):
+        with instrument._lock:
+            instrument._calls.clear()
+
+    @unittest.skipIf(botocore is None, 'botocore is not installed')
+    def test_connection_error_is_recorded_and_raised(self):
+        session = botocore.session.get_session()
+        client = session.create_client(
+            'sqs', region_name='us-east-1', endpoint_url='http://127.0.0.1:{}'.format(_dead_port()),
+            aws_access_key_id='test', aws_secret_access_key='test',
+            config=Config(connect_timeout=1, read_timeout=1, retries={'mode': 'standard', 'total_max_attempts': 1}))
+        instrument.instrument_client(client)
+        # The handler must not replace the connection error, which throttle.classify retries
+        with self.assertRaises(botocore.exceptions.EndpointConnectionError):
+            client.list_queues()
+        calls = instrument.report()['calls']
+        self.assertEqual(calls['sqs.ListQueues']['count'], 1)
+        self.assertEqual(calls['sqs.ListQueues']['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
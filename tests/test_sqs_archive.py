@@ -0,0 +1,101 @@
+#
+# Tests for the restore checkpoint in boto_scripts/sqs_archive.py, which decides which archived messages a resumed
+# restore skips.
+#
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import sqs_archive
+
+
+class RestoreCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_out_of_order_marks_are_merged(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        checkpoint.mark('a.jsonl', [20, 21, 22])
+        checkpoint.mark('a.jsonl', [0, 1, 2])
+        self.assertEqual(checkpoint.done['a.jsonl'], [[0, 3], [20, 23]])
+        checkpoint.mark('a.jsonl', [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19])
+        self.assertEqual(checkpoint.done['a.jsonl'], [[0, 23]])
+
+    def test_is_done(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        checkpoint.mark('a.jsonl', [5, 6, 9])
+        self.assertEqual([line for line in range(12) if checkpoint.is_done('a.jsonl', line)], [5, 6, 9])
+        self.assertFalse(checkpoint.is_done('b.jsonl', 5))
+
+    def test_sources_are_kept_apart(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        checkpoint.mark('a.jsonl', [0, 1])
+        checkpoint.mark('b.jsonl', [1, 2])
+        self.assertEqual(checkpoint.done, {'a.jsonl': [[0, 2]], 'b.jsonl': [[1, 3]]})
+
+    def test_empty_mark_is_ignored(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        checkpoint.mark('a.jsonl', [])
+        self.assertEqual(checkpoint.done, {})
+
+    def test_marked_ranges_are_not_changed_in_place(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        checkpoint.mark('a.jsonl', [0, 1])
+        before = checkpoint.done['a.jsonl']
+        first = before[0]
+        checkpoint.mark('a.jsonl', [2, 3])
+        self.assertEqual(before, [[0, 2]])
+        self.assertEqual(first, [0, 2])
+
+    def test_resume_reads_the_saved_ranges(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        checkpoint.mark('a.jsonl', [3, 1, 2])
+        checkpoint.mark('b.jsonl.gz', [7])
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'a.jsonl': [[1, 4]], 'b.jsonl.gz': [[7, 8]]})
+
+        resumed = sqs_archive.RestoreCheckpoint(self.path)
+        self.assertTrue(resumed.is_done('a.jsonl', 1))
+        self.assertTrue(resumed.is_done('a.jsonl', 3))
+        self.assertFalse(resumed.is_done('a.jsonl', 0))
+        self.assertFalse(resumed.is_done('a.jsonl', 4))
+        self.assertTrue(resumed.is_done('b.jsonl.gz', 7))
+        resumed.mark('a.jsonl', [0])
+        self.assertEqual(resumed.done['a.jsonl'], [[0, 4]])
+
+        resumed.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(sqs_archive.RestoreCheckpoint(self.path).done, {})
+
+    def test_concurrent_marks(self):
+        checkpoint = sqs_archive.RestoreCheckpoint(self.path)
+        lines = list(range(400))
+        # Batches of 10 from 8 threads, in no particular order
+        batches = [lines[i:i + 10] for i in range(0, len(lines), 10)]
+        batches.reverse()
+
+        def sender(mine):
+            for batch in mine:
+                checkpoint.mark('a.jsonl', batch)
+                checkpoint.is_done('a.jsonl', batch[0])
+        threads = [threading.Thread(target=sender, args=(batches[i::8],)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(checkpoint.done['a.jsonl'], [[0, 400]])
+        self.assertEqual(sqs_archive.RestoreCheckpoint(self.path).done['a.jsonl'], [[0, 400]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#
+# Tests for the filter grammar and the running totals in boto_scripts/sqs_inspect.py.
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import sqs_inspect
+
+NOW = 1700000000.0
+
+
+def record(body='hello', attributes=None, receive_count=1, age=30, group=None, message_id='m-1'):
+    # The shape of sqs_archive.message_record
+    system = {'ApproximateReceiveCount': str(receive_count), 'SentTimestamp': str(int((NOW - age) * 1000))}
+    if group is not None:
+        system['MessageGroupId'] = group
+    return {
+        'id': message_id,
+        'attributes': dict((name, {'DataType': 'String', 'StringValue': value})
+                           for name, value in (attributes or {}).items()),
+        'system_attributes': system,
+        'body': body
+    }
+
+
+class ParseFilterTest(unittest.TestCase):
+    def matches(self, expression, rec):
+        return sqs_inspect.parse_filter(expression)(rec, NOW)
+
+    def test_conditions_are_joined_with_and(self):
+        rec = record(attributes={'customer': 'acme'}, receive_count=3, body='Timeout talking to db')
+        self.assertTrue(self.matches('attr.customer = acme and receive_count >= 3 and body ~ Timeout', rec))
+        self.assertFalse(self.matches('attr.customer = acme and receive_count >= 4', rec))
+
+    def test_pattern_can_contain_and(self):
+        self.assertTrue(self.matches('body ~ foo and bar', record(body='x foo and bar y')))
+        self.assertFalse(self.matches('body ~ foo and bar', record(body='foo')))
+        self.assertTrue(self.matches('body ~ foo and bar and size < 100', record(body='foo and bar')))
+
+    def test_numeric_fields(self):
+        rec = record(body='x' * 100, receive_count=5, age=600)
+        self.assertTrue(self.matches('size = 100', rec))
+        self.assertTrue(self.matches('size > 99.5', rec))
+        self.assertTrue(self.matches('receive_count != 4', rec))
+        self.assertTrue(self.matches('age >= 600', rec))
+        self.assertFalse(self.matches('age < 60', rec))
+
+    def test_numeric_field_needs_a_number(self):
+        with self.assertRaises(ValueError):
+            sqs_inspect.parse_filter('size > big')
+
+    def test_string_fields_only_compare_for_equality(self):
+        rec = record(attributes={'customer': 'acme'}, group='g1', message_id='abc')
+        self.assertTrue(self.matches('attr.customer != other', rec))
+        self.assertTrue(self.matches('group = g1', rec))
+        self.assertTrue(self.matches('id = abc', rec))
+        for expression in ('body > a', 'attr.customer < b', 'group >= g'):
+            with self.assertRaises(ValueError):
+                sqs_inspect.parse_filter(expression)
+
+    def test_missing_attribute(self):
+        rec = record()
+        self.assertFalse(self.matches('attr.customer = acme', rec))
+        self.assertTrue(self.matches('attr.customer != acme', rec))
+        self.assertFalse(self.matches('attr.customer ~ .', rec))
+
+    def test_bad_expressions(self):
+        for expression in ('', 'nonsense', 'colour = red', 'size > 1 and', 'body ~ ('):
+            with self.assertRaises(ValueError):
+                sqs_inspect.parse_filter(expression)
+
+
+class QueueStatsTest(unittest.TestCase):
+    def test_histogram_bounds_are_inclusive(self):
+        histogram = sqs_inspect._Histogram((10, 100))
+        for value in (0, 10, 11, 100, 101, 5000):
+            histogram.add(value)
+        self.assertEqual(histogram.counts, [2, 2, 2])
+        self.assertEqual(histogram.rows(), [('<= 10', 2), ('<= 100', 2), ('> 100', 2)])
+
+    def test_empty_buckets_are_left_out(self):
+        histogram = sqs_inspect._Histogram((10, 100), ['ten', 'hundred'])
+        histogram.add(50)
+        self.assertEqual(histogram.rows(), [('<= hundred', 1)])
+
+    def test_totals(self):
+        stats = sqs_inspect.QueueStats()
+        stats.add(record(body='x' * 300, receive_count=1, age=30, attributes={'customer': 'acme'}, group='g1'), NOW)
+        stats.add(record(body='x' * 10, receive_count=4, age=7200, attributes={'customer': 'acme'}), NOW)
+        stats.add(record(body='x' * 5000, receive_count=100, age=90, attributes={'customer': 'globex'}), NOW)
+        summary = stats.summary()
+        self.assertEqual(summary['messages'], 3)
+        self.assertEqual(summary['body_bytes'], 5310)
+        self.assertEqual(summary['oldest_seconds'], 7200)
+        self.assertEqual(summary['newest_seconds'], 30)
+        self.assertEqual(summary['size'], [('<= 256', 1), ('<= 1024', 1), ('<= 16384', 1)])
+        self.assertEqual(summary['receive_count'], [('<= 1', 1), ('<= 5', 1), ('> 50', 1)])
+        self.assertEqual(summary['age'], [('<= 1m', 1), ('<= 10m', 1), ('<= 6h', 1)])
+        self.assertEqual(summary['attributes'], {'customer': [('acme', 2), ('globex', 1)]})
+        self.assertEqual(summary['groups'], [('g1', 1)])
+
+    def test_attribute_values_are_capped(self):
+        stats = sqs_inspect.QueueStats()
+        for i in range(sqs_inspect.MAX_ATTRIBUTE_VALUES + 5):
+            stats.add(record(attributes={'customer': 'c{}'.format(i)}), NOW)
+        values = stats.attributes['customer']
+        self.assertEqual(len(values), sqs_inspect.MAX_ATTRIBUTE_VALUES + 1)
+        self.assertEqual(values[sqs_inspect.OTHER_VALUES], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+#
+# Tests for the retry classification and the adaptive concurrency limiter in boto_scripts/throttle.py. The limiter is
+# driven by hand with a fake clock, so every decision can be checked against the counters it leaves in the report.
+#
+
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boto_scripts import instrument
+from boto_scripts import throttle
+
+try:
+    from botocore import exceptions as botocore_exceptions
+except ImportError:
+    botocore_exceptions = None
+
+
+class FakeClock(object):
+    # Stands in for the time module inside throttle
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class BotoError(Exception):
+    # Shaped like boto's S3ResponseError
+    def __init__(self, status, error_code):
+        Exception.__init__(self, error_code)
+        self.status = status
+        self.error_code = error_code
+
+
+class Boto3Error(Exception):
+    # Shaped like botocore's ClientError
+    def __init__(self, code, status=400):
+        Exception.__init__(self, code)
+        self.response = {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+
+class EndpointConnectionError(Exception):
+    pass
+
+
+class ProxyConnectionError(EndpointConnectionError):
+    pass
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_boto_errors(self):
+        self.assertEqual(throttle.classify(BotoError(503, 'SlowDown')), throttle.THROTTLED)
+        self.assertEqual(throttle.classify(BotoError(500, 'InternalError')), throttle.RETRYABLE)
+        self.assertEqual(throttle.classify(BotoError(503, None)), throttle.RETRYABLE)
+        self.assertIsNone(throttle.classify(BotoError(404, 'NoSuchKey')))
+        self.assertIsNone(throttle.classify(BotoError(403, 'AccessDenied')))
+
+    def test_boto3_errors(self):
+        self.assertEqual(throttle.classify(Boto3Error('Throttling')), throttle.THROTTLED)
+        self.assertEqual(throttle.classify(Boto3Error('ThrottlingException')), throttle.THROTTLED)
+        self.assertEqual(throttle.classify(Boto3Error('RequestLimitExceeded')), throttle.THROTTLED)
+        self.assertEqual(throttle.classify(Boto3Error('KMSThrottled')), throttle.THROTTLED)
+        self.assertEqual(throttle.classify(Boto3Error('Unknown', 429)), throttle.THROTTLED)
+        self.assertEqual(throttle.classify(Boto3Error('InternalFailure', 500)), throttle.RETRYABLE)
+        self.assertEqual(throttle.classify(Boto3Error('ServiceUnavailable', 503)), throttle.RETRYABLE)
+        self.assertIsNone(throttle.classify(Boto3Error('InvalidParameterValue')))
+        self.assertIsNone(throttle.classify(Boto3Error('AWS.SimpleQueueService.NonExistentQueue')))
+
+    def test_connection_errors(self):
+        self.assertEqual(throttle.classify(EndpointConnectionError()), throttle.RETRYABLE)
+        # Subclasses are recognized by the names in their MRO
+        self.assertEqual(throttle.classify(ProxyConnectionError()), throttle.RETRYABLE)
+        self.assertEqual(throttle.classify(socket.timeout()), throttle.RETRYABLE)
+        self.assertEqual(throttle.classify(ConnectionResetError()), throttle.RETRYABLE)
+        self.assertIsNone(throttle.classify(ValueError('bad')))
+        self.assertIsNone(throttle.classify(KeyError('x')))
+
+    @unittest.skipIf(botocore_exceptions is None, 'botocore is not installed')
+    def test_botocore_errors(self):
+        self.assertEqual(throttle.classify(botocore_exceptions.ReadTimeoutError(endpoint_url='http://x')),
+                         throttle.RETRYABLE)
+        self.assertEqual(throttle.classify(botocore_exceptions.ConnectTimeoutError(endpoint_url='http://x')),
+                         throttle.RETRYABLE)
+        self.assertEqual(throttle.classify(botocore_exceptions.EndpointConnectionError(endpoint_url='http://x')),
+                         throttle.RETRYABLE)
+        throttled = botocore_exceptions.ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                                                     'ResponseMetadata': {'HTTPStatusCode': 400}}, 'DescribeEvents')
+        self.assertEqual(throttle.classify(throttled), throttle.THROTTLED)
+
+    def test_backoff_delay_is_capped(self):
+        for attempt in range(20):
+            delay = throttle.backoff_delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(throttle.MAX_DELAY, throttle.BASE_DELAY * 2 ** attempt))
+
+
+class LimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.real_time = throttle.time
+        throttle.time = self.clock
+        throttle.reset()
+        with instrument._lock:
+            instrument._counters.clear()
+            instrument._gauges.clear()
+            instrument._calls.clear()
+
+    def tearDown(self):
+        throttle.time = self.real_time
+        throttle.reset()
+
+    def counters(self):
+        return instrument.report()['counters']
+
+    def fill(self, limiter):
+        while limiter.in_flight < int(limiter.limit):
+            limiter.acquire()
+
+    def succeed(self, limiter, latency=0.1, operation='GetObject'):
+        # One call finishing while the limit is in full use
+        self.fill(limiter)
+        self.clock.now += latency
+        limiter.release(None, operation, latency)
+
+    def throttled(self, limiter):
+        self.fill(limiter)
+        limiter.release(throttle.THROTTLED, 'GetObject')
+
+    def test_slow_start_grows_by_one_per_success(self):
+        limiter = throttle.Limiter('s3', initial=4, maximum=100, latency_factor=None)
+        for _ in range(10):
+            self.succeed(limiter)
+        self.assertEqual(int(limiter.limit), 14)
+        self.assertTrue(limiter.slow_start)
+        self.assertEqual(self.counters()['limiter.s3.increase'], 10)
+        self.assertEqual(instrument.report()['gauges']['limiter.s3.peak'], 14)
+
+    def test_no_growth_while_the_limit_is_not_used(self):
+        limiter = throttle.Limiter('s3', initial=8, latency_factor=None)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(None, 'GetObject', 0.1)
+        self.assertEqual(limiter.limit, 8)
+        self.assertNotIn('limiter.s3.increase', self.counters())
+
+    def test_throttle_halves_and_ends_slow_start(self):
+        limiter = throttle.Limiter('s3', initial=16, latency_factor=None)
+        self.throttled(limiter)
+        self.assertEqual(limiter.limit, 8)
+        self.assertFalse(limiter.slow_start)
+        self.assertEqual(self.counters()['limiter.s3.decrease'], 1)
+
+    def test_additive_increase_after_slow_start(self):
+        limiter = throttle.Limiter('s3', initial=16, latency_factor=None)
+        self.throttled(limiter)
+        # 1/limit per success, so a little under one per round trip: a round trip at a limit of 8 is not quite
+        # enough to reach 9, one more success is
+        for _ in range(8):
+            self.succeed(limiter)
+        self.assertEqual(int(limiter.limit), 8)
+        self.succeed(limiter)
+        self.assertEqual(int(limiter.limit), 9)
+        self.assertEqual(self.counters()['limiter.s3.increase'], 1)
+
+    def test_at_most_one_decrease_per_round_trip(self):
+        limiter = throttle.Limiter('s3', initial=32, latency_factor=None)
+        self.succeed(limiter, latency=1.0)
+        for _ in range(5):
+            self.throttled(limiter)
+        self.assertEqual(int(limiter.limit), 16)
+        self.clock.now += 1.5
+        self.throttled(limiter)
+        self.assertEqual(int(limiter.limit), 8)
+        self.assertEqual(self.counters()['limiter.s3.decrease'], 2)
+
+    def test_never_below_one_or_above_maximum(self):
+        limiter = throttle.Limiter('s3', initial=2, maximum=5, latency_factor=None)
+        for _ in range(5):
+            self.throttled(limiter)
+            self.clock.now += 10
+        self.assertEqual(limiter.limit, 1)
+        for _ in range(50):
+            self.succeed(limiter)
+        self.assertEqual(limiter.limit, 5)
+
+    def test_growth_held_while_latency_rises(self):
+        limiter = throttle.Limiter('sqs', initial=4, latency_factor=3.0)
+        self.succeed(limiter, latency=0.1)
+        before = limiter.limit
+        for _ in range(10):
+            self.succeed(limiter, latency=2.0)
+        self.assertGreater(self.counters()['limiter.sqs.held'], 0)
+        self.assertLess(limiter.limit, before + 10)
+
+    def test_long_polls_do_not_count_as_latency(self):
+        limiter = throttle.Limiter('sqs', initial=4, latency_factor=3.0)
+        self.succeed(limiter, latency=0.1, operation='SendMessageBatch')
+        for _ in range(5):
+            self.succeed(limiter, latency=20.0, operation='ReceiveMessage')
+        self.assertEqual(limiter.best_latency, 0.1)
+        self.assertNotIn('limiter.sqs.held', self.counters())
+
+    def test_call_retries_throttles_with_backoff(self):
+        limiter = throttle.Limiter('sqs', initial=4, retries=3)
+        failures = [Boto3Error('Throttling'), Boto3Error('InternalFailure', 500)]
+
+        def fn():
+            if failures:
+                raise failures.pop(0)
+            return 'ok'
+        self.assertEqual(limiter.call('SendMessage', fn), 'ok')
+        self.assertEqual(len(self.clock.slept), 2)
+        self.assertEqual(limiter.in_flight, 0)
+        counters = self.counters()
+        self.assertEqual(counters['limiter.sqs.throttled'], 1)
+        self.assertEqual(counters['limiter.sqs.retried'], 2)
+        self.assertEqual(instrument.report()['calls']['sqs.SendMessage']['retries'], 2)
+
+    def test_call_gives_up_after_retries(self):
+        limiter = throttle.Limiter('sqs', initial=4, retries=2)
+        calls = []
+
+        def fn():
+            calls.append(1)
+            raise Boto3Error('Throttling')
+        with self.assertRaises(Boto3Error):
+            limiter.call('SendMessage', fn)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_call_does_not_retry_other_errors(self):
+        limiter = throttle.Limiter('sqs', initial=4)
+        calls = []
+
+        def fn():
+            calls.append(1)
+            raise Boto3Error('InvalidParameterValue')
+        with self.assertRaises(Boto3Error):
+            limiter.call('SendMessage', fn)
+        self.assertEqual(len(calls), 1)
+
+    def test_call_retries_only_the_given_outcomes(self):
+        limiter = throttle.Limiter('elasticbeanstalk', initial=4)
+        calls = []
+
+        def fn():
+            calls.append(1)
+            raise Boto3Error('InternalFailure', 500)
+        with self.assertRaises(Boto3Error):
+            limiter.call('SwapEnvironmentCNAMEs', fn, retry_on=(throttle.THROTTLED,))
+        self.assertEqual(len(calls), 1)
+
+    def test_limiter_is_shared_per_endpoint(self):
+        self.assertIs(throttle.limiter('sqs', 'q1'), throttle.limiter('sqs', 'q1'))
+        self.assertIsNot(throttle.limiter('sqs', 'q1'), throttle.limiter('sqs', 'q2'))
+
+
+if __name__ == '__main__':
+    unittest.main()